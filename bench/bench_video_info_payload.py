@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark: montagem da resposta do /api/video-info a partir do info do yt-dlp
+
+Compara a tabela antiga (seis entradas por qualidade, serializada a cada
+requisição) com a resposta compacta e com a resposta já serializada em
+cache. O dicionário de informações imita um vídeo longo do YouTube: dezenas
+de formatos DASH/HLS em vários codecs, storyboards e listas de fragmentos.
+
+Uso: python bench/bench_video_info_payload.py [iterações]
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import server  # noqa: E402
+
+HEIGHTS = (144, 240, 360, 480, 720, 1080, 1440, 2160)
+VIDEO_CODECS = (('avc1.64001F', 'mp4'), ('vp09.00.40.08', 'webm'), ('av01.0.08M.08', 'mp4'))
+LEGACY_OUTPUT_FORMATS = [
+    {'ext': 'MP4', 'codec': 'h264', 'name': 'MP4 (H.264)'},
+    {'ext': 'AVI', 'codec': 'xvid', 'name': 'AVI (Xvid)'},
+    {'ext': 'MKV', 'codec': 'h264', 'name': 'MKV (H.264)'},
+    {'ext': 'MOV', 'codec': 'h264', 'name': 'MOV (H.264)'},
+    {'ext': 'WMV', 'codec': 'wmv2', 'name': 'WMV'},
+    {'ext': 'FLV', 'codec': 'flv', 'name': 'FLV'},
+]
+
+
+def fragments(count):
+    return [{'url': f'https://rr1---sn-abc.googlevideo.com/videoplayback?sq={i}', 'duration': 5.0}
+            for i in range(count)]
+
+
+def sample_info(duration=3600):
+    """Info sintético com o tamanho e a variedade de um vídeo real de 1 hora"""
+    headers = {'User-Agent': 'Mozilla/5.0', 'Accept': '*/*', 'Accept-Language': 'en-us,en;q=0.5'}
+    formats = []
+    for index, (rows, cols) in enumerate(((3, 3), (5, 5), (10, 10), (10, 10))):
+        formats.append({'format_id': f'sb{index}', 'ext': 'mhtml', 'vcodec': 'none', 'acodec': 'none',
+                        'protocol': 'mhtml', 'rows': rows, 'columns': cols,
+                        'fragments': fragments(duration // 50)})
+    for format_id, abr, ext, acodec in (('139', 48.8, 'm4a', 'mp4a.40.5'), ('140', 129.5, 'm4a', 'mp4a.40.2'),
+                                        ('249', 55.1, 'webm', 'opus'), ('250', 71.9, 'webm', 'opus'),
+                                        ('251', 135.3, 'webm', 'opus'), ('140-drc', 129.5, 'm4a', 'mp4a.40.2'),
+                                        ('251-drc', 135.3, 'webm', 'opus')):
+        formats.append({'format_id': format_id, 'ext': ext, 'vcodec': 'none', 'acodec': acodec, 'abr': abr,
+                        'protocol': 'https', 'filesize': int(abr * 125 * duration),
+                        'url': 'https://rr1---sn-abc.googlevideo.com/videoplayback?' + 'x' * 900,
+                        'http_headers': headers})
+    # IDs fora da faixa dos itags reais para não colidir com os formatos de áudio
+    format_number = 1000
+    for height in HEIGHTS:
+        for fps in (30, 60) if height >= 720 else (30,):
+            for vcodec, ext in VIDEO_CODECS:
+                tbr = height * fps / 10
+                formats.append({'format_id': str(format_number), 'ext': ext, 'vcodec': vcodec, 'acodec': 'none',
+                                'height': height, 'width': height * 16 // 9, 'fps': fps, 'tbr': tbr,
+                                'protocol': 'https', 'filesize': int(tbr * 125 * duration),
+                                'url': 'https://rr1---sn-abc.googlevideo.com/videoplayback?' + 'x' * 900,
+                                'http_headers': headers})
+                format_number += 1
+                # A mesma qualidade também em HLS
+                formats.append({'format_id': str(format_number), 'ext': 'mp4', 'vcodec': vcodec, 'acodec': 'none',
+                                'height': height, 'width': height * 16 // 9, 'fps': fps, 'tbr': tbr * 1.1,
+                                'protocol': 'm3u8_native', 'fragments': fragments(duration // 5),
+                                'http_headers': headers})
+                format_number += 1
+    for format_id, height in (('18', 360), ('22', 720), ('91', 144), ('92', 240), ('93', 360), ('94', 480)):
+        formats.append({'format_id': format_id, 'ext': 'mp4', 'vcodec': 'avc1.42001E', 'acodec': 'mp4a.40.2',
+                        'height': height, 'width': height * 16 // 9, 'fps': 30, 'tbr': height * 2,
+                        'protocol': 'https' if format_id in ('18', '22') else 'm3u8_native',
+                        'filesize_approx': height * 2 * 125 * duration, 'http_headers': headers})
+    return {
+        '_type': 'video', 'id': 'dQw4w9WgXcQ', 'title': 'Vídeo de teste longo', 'duration': duration,
+        'view_count': 1234567890, 'uploader': 'Canal', 'thumbnail': 'https://i.ytimg.com/vi/x/maxresdefault.jpg',
+        'formats': formats,
+    }
+
+
+def legacy_payload(info):
+    """Como era antes: seis entradas por qualidade muxada"""
+    video_formats = []
+    audio_formats = []
+    qualities = {}
+    for fmt in info.get('formats', []):
+        if fmt.get('vcodec') != 'none' and fmt.get('acodec') != 'none':
+            height = fmt.get('height', 0)
+            if height and height not in qualities:
+                qualities[height] = {
+                    'format_id': fmt['format_id'],
+                    'quality': f"{height}p",
+                    'resolution': f"{fmt.get('width', 0)}x{height}",
+                    'size': fmt.get('filesize_approx', 0) or fmt.get('filesize', 0) or 0,
+                    'fps': fmt.get('fps', 30),
+                }
+    for height in sorted(qualities.keys(), reverse=True):
+        fmt = qualities[height]
+        for output_fmt in LEGACY_OUTPUT_FORMATS:
+            video_formats.append({
+                'format_id': fmt['format_id'],
+                'quality': fmt['quality'],
+                'resolution': fmt['resolution'],
+                'size': server.format_size(fmt['size']) if fmt['size'] else 'N/A',
+                'fps': fmt['fps'],
+                'format': output_fmt['ext'],
+                'format_name': output_fmt['name'],
+                'codec': output_fmt['codec']
+            })
+    for fmt in info.get('formats', []):
+        if fmt.get('acodec') != 'none' and fmt.get('vcodec') == 'none':
+            bitrate = fmt.get('abr', 0)
+            if bitrate and bitrate >= 128:
+                audio_formats.append({
+                    'format_id': fmt['format_id'],
+                    'quality': f"{int(bitrate)}kbps",
+                    'size': server.format_size(fmt.get('filesize_approx', 0) or fmt.get('filesize', 0) or 0),
+                    'format': 'MP3'
+                })
+    seen = set()
+    audio_formats = [x for x in audio_formats if not (x['quality'] in seen or seen.add(x['quality']))]
+    audio_formats = sorted(audio_formats, key=lambda x: int(x['quality'].replace('kbps', '')), reverse=True)[:4]
+    return {
+        'success': True,
+        'id': info.get('id', ''),
+        'title': info.get('title', 'Sem título'),
+        'thumbnail': info.get('thumbnail', ''),
+        'duration': str(int(info.get('duration', 0) // 60)) + ':' + str(int(info.get('duration', 0) % 60)).zfill(2),
+        'views': server.format_views(info.get('view_count', 0)),
+        'channel': info.get('uploader', 'Desconhecido'),
+        'formats': {'video': video_formats, 'audio': audio_formats},
+    }
+
+
+def measure(label, func, iterations):
+    func()  # aquecimento
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    per_call = (time.perf_counter() - started) / iterations * 1e6
+    print(f"{label:<40} {per_call:10.1f} µs/requisição")
+    return per_call
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    info = sample_info()
+    url = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+    print(f"{iterations} iterações, {len(info['formats'])} formatos no info")
+
+    legacy_body = json.dumps(legacy_payload(info)).encode('utf-8')
+    entry = server.encoded_video_info(url, info)
+    print(f"Tamanho: antigo {len(legacy_body)} B, compacto {len(entry['body'])} B, gzip {len(entry['gzip'])} B")
+    print(f"Qualidades: antigo {len(legacy_payload(info)['formats']['video']) // 6}, "
+          f"compacto {len(server.build_video_info_payload(info)['formats']['video'])}\n")
+
+    legacy = measure('antigo: tabela 6x + json.dumps', lambda: json.dumps(legacy_payload(info)).encode('utf-8'), iterations)
+    compact = measure('compacto: montar + serializar + gzip',
+                      lambda: server.encode_payload(server.build_video_info_payload(info)), iterations)
+    cached = measure('compacto em cache (mesmo info)', lambda: server.encoded_video_info(url, info), iterations)
+    print(f"\nEm cache: {legacy / cached:.0f}x mais rápido que o antigo ({compact / cached:.0f}x que montar de novo)")
+
+
+if __name__ == '__main__':
+    main()
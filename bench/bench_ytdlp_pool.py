@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark: custo por requisição de criar um YoutubeDL novo x emprestar do pool
+
+Mede só o overhead local (opções, extratores, pós-processadores e leitura
+do cookies.txt), sem acesso à rede. Usa uma cópia do cookies.txt para não
+alterar o arquivo do projeto.
+
+Uso: python bench/bench_ytdlp_pool.py [iterações]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import yt_dlp  # noqa: E402
+import server  # noqa: E402
+
+
+def info_opts(cookiefile):
+    return {
+        'quiet': True,
+        'no_warnings': True,
+        'no_check_certificate': True,
+        'socket_timeout': 30,
+        'cookiefile': cookiefile,
+    }
+
+
+def audio_opts(cookiefile):
+    return dict(info_opts(cookiefile), postprocessors=[{
+        'key': 'FFmpegExtractAudio',
+        'preferredcodec': 'mp3',
+        'preferredquality': '320',
+    }])
+
+
+def fresh_instance(opts):
+    """Como era antes: um YoutubeDL novo por chamada"""
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        ydl.cookiejar  # o yt-dlp carrega os cookies na primeira requisição
+
+
+def pooled_instance(profile, opts, job):
+    with server.ydl_pool.checkout(profile, opts, **job) as ydl:
+        ydl.cookiejar
+
+
+def measure(label, func, iterations):
+    func()  # aquecimento
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    per_call = (time.perf_counter() - started) / iterations * 1000
+    print(f"{label:<32} {per_call:8.3f} ms/chamada")
+    return per_call
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    workdir = tempfile.mkdtemp(prefix='videomax-bench-')
+    cookiefile = os.path.join(workdir, 'cookies.txt')
+    shutil.copy(server.COOKIES_FILE, cookiefile)
+    server.COOKIES_FILE = cookiefile
+    job = {
+        'format': 'bestaudio/best',
+        'outtmpl': os.path.join(workdir, '%(title)s.%(ext)s'),
+        'progress_hooks': [lambda d: None],
+    }
+    try:
+        print(f"{iterations} iterações, yt-dlp {yt_dlp.version.__version__}")
+        for profile, opts in (('info', info_opts(cookiefile)), ('audio', audio_opts(cookiefile))):
+            before = measure(f"{profile}: YoutubeDL novo", lambda: fresh_instance(dict(opts)), iterations)
+            after = measure(f"{profile}: pool", lambda: pooled_instance(profile, dict(opts), job), iterations)
+            print(f"{profile}: {before / after:.1f}x menos overhead\n")
+        print(server.ydl_pool.stats())
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
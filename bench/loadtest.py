@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""
+Teste de carga do server.py sem acesso à rede
+
+Cada cenário sobe um processo novo do servidor (werkzeug com threads) com o
+yt-dlp trocado pelo StubExtractor e as instâncias do Piped/Cobalt apontando
+para o FakeUpstreams (ver bench/upstreams.py). O gerador de carga roda neste
+processo e mede cada requisição; o RSS do servidor é amostrado durante o
+cenário.
+
+Cenários:
+  info       GET /api/video-info em vários vídeos (extração + cache), como o front-end
+  fallback   o extrator sempre falha: resposta vem do Piped/Cobalt falsos
+  downloads  POST /api/download + consulta de status até concluir + download do arquivo
+  polling    muitos clientes consultando o status de um download concluído
+  cobalt     POST /api/cobalt-download
+  audio      downloads em MP3 (só com ffmpeg instalado)
+  passthrough downloads de áudio em M4A (stream original, sem ffmpeg)
+
+Relata p50/p95/p99, vazão e pico de RSS por endpoint. Nos cenários de áudio
+também confere que os jobs só buscaram o stream de áudio pedido.
+
+Uso:
+  python bench/loadtest.py [--scenarios info,downloads] [--requests 200] [--concurrency 16] ...
+  python bench/loadtest.py --record URL [URL...]   grava infos reais em bench/fixtures (precisa de rede)
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from upstreams import FakeUpstreams, StubExtractor, UpstreamBehavior, generate_media, record_fixture  # noqa: E402
+
+SCENARIOS = ('info', 'fallback', 'downloads', 'polling', 'cobalt', 'audio', 'passthrough')
+TERMINAL_STATUSES = ('completed', 'error', 'not_found')
+DEFAULT_FIXTURES = os.path.join(BENCH_DIR, 'fixtures')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def video_url(index):
+    """URL do YouTube com um ID de 11 caracteres diferente por índice"""
+    return f'https://youtu.be/bench{index:06d}'
+
+
+def percentile(values, pct):
+    """Percentil pelo método do posto mais próximo"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+# ---------------------------------------------------------------------------
+# Processo do servidor
+# ---------------------------------------------------------------------------
+
+def serve(args):
+    """Modo filho: importa o server.py com os substitutos locais e atende na porta pedida"""
+    os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+    os.environ.setdefault('MAX_JOBS_PER_CLIENT', '0')
+    os.environ.setdefault('PREFETCH_ENABLED', '0')
+    os.environ['STATE_DB_PATH'] = os.path.join(args.workdir, 'videomax.db')
+    sys.path.insert(0, os.path.dirname(BENCH_DIR))
+    import server
+    from werkzeug.serving import make_server
+
+    downloads = os.path.join(args.workdir, 'downloads')
+    os.makedirs(downloads, exist_ok=True)
+    server.DOWNLOAD_FOLDER = downloads
+    server.output_cache.folder = downloads
+    server.PIPED_INSTANCES[:] = [f'{args.upstream}/piped']
+    server.COBALT_INSTANCES[:] = [f'{args.upstream}/cobalt']
+    server.get_video_info_ytdlp = StubExtractor(
+        f'{args.upstream}/media', args.fixtures,
+        UpstreamBehavior(args.extract_latency, args.extract_latency / 2, args.extract_failure)
+    )
+    make_server('127.0.0.1', args.port, server.app, threaded=True).serve_forever()
+
+
+class ServerProcess:
+    """Servidor em processo separado, com amostragem do RSS"""
+
+    def __init__(self, upstream, fixtures, workdir, extract_latency=0.0, extract_failure=0.0, env=None):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.workdir = tempfile.mkdtemp(prefix='server-', dir=workdir)
+        command = [
+            sys.executable, os.path.abspath(__file__), '--serve',
+            '--port', str(self.port), '--upstream', upstream, '--workdir', self.workdir,
+            '--extract-latency', str(extract_latency), '--extract-failure', str(extract_failure),
+        ]
+        if fixtures:
+            command += ['--fixtures', fixtures]
+        self.log = open(os.path.join(self.workdir, 'server.log'), 'w')
+        self.process = subprocess.Popen(command, stdout=self.log, stderr=subprocess.STDOUT,
+                                        env={**os.environ, **(env or {})}, cwd=self.workdir)
+        self.peak_rss = 0
+        self._sampling = False
+        self._sampler = None
+
+    def wait_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'Servidor terminou ao iniciar (ver {self.log.name})')
+            try:
+                if requests.get(f'{self.url}/api/health', timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.1)
+        raise RuntimeError('Servidor não respondeu a tempo')
+
+    def rss(self):
+        """RSS atual em bytes (Linux; 0 se indisponível)"""
+        try:
+            with open(f'/proc/{self.process.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return 0
+
+    def start_sampling(self, interval=0.05):
+        self.peak_rss = self.rss()
+        self._sampling = True
+
+        def loop():
+            while self._sampling:
+                self.peak_rss = max(self.peak_rss, self.rss())
+                time.sleep(interval)
+        self._sampler = threading.Thread(target=loop, daemon=True)
+        self._sampler.start()
+
+    def stop_sampling(self):
+        self._sampling = False
+        if self._sampler:
+            self._sampler.join()
+        return self.peak_rss
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.log.close()
+
+
+# ---------------------------------------------------------------------------
+# Geração de carga
+# ---------------------------------------------------------------------------
+
+class Recorder:
+    """Latências por endpoint de um cenário"""
+
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, seconds, ok=True):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def add_bytes(self, count):
+        with self._lock:
+            self.bytes += count
+
+
+class LoadClient:
+    """Sessão HTTP por thread que registra cada chamada no Recorder"""
+
+    def __init__(self, base_url, recorder):
+        self.base_url = base_url
+        self.recorder = recorder
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def call(self, method, endpoint, path, ok_statuses=(200,), **kwargs):
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=120, **kwargs)
+            if kwargs.get('stream'):
+                for chunk in response.iter_content(256 * 1024):
+                    self.recorder.add_bytes(len(chunk))
+            ok = response.status_code in ok_statuses
+        except requests.RequestException:
+            response, ok = None, False
+        self.recorder.add(endpoint, time.perf_counter() - started, ok)
+        return response
+
+
+def run_parallel(concurrency, count, func):
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(func, range(count)))
+
+
+def scenario_info(client, opts):
+    def lookup(index):
+        client.call('GET', 'GET /api/video-info', '/api/video-info', params={'url': video_url(index % opts.videos)})
+    run_parallel(opts.concurrency, opts.requests, lookup)
+
+
+def scenario_cobalt(client, opts):
+    def cobalt(index):
+        client.call('POST', 'POST /api/cobalt-download', '/api/cobalt-download',
+                    json={'url': video_url(index % opts.videos)})
+    run_parallel(opts.concurrency, opts.requests, cobalt)
+
+
+def wait_download(client, download_id, poll_interval):
+    while True:
+        response = client.call('GET', 'GET /api/download-status', f'/api/download-status/{download_id}')
+        status = response.json().get('status') if response is not None and response.ok else 'error'
+        if status in TERMINAL_STATUSES:
+            return status
+        time.sleep(poll_interval)
+
+
+def run_downloads(client, opts, payload):
+    def job(index):
+        started = time.perf_counter()
+        response = client.call('POST', 'POST /api/download', '/api/download',
+                               json={'url': video_url(10000 + index), **payload})
+        ok = response is not None and response.ok
+        if ok:
+            download_id = response.json()['download_id']
+            ok = wait_download(client, download_id, opts.poll_interval) == 'completed'
+            if ok:
+                response = client.call('GET', 'GET /api/download-file', f'/api/download-file/{download_id}',
+                                       stream=True)
+                ok = response is not None and response.ok
+        client.recorder.add('job (ponta a ponta)', time.perf_counter() - started, ok)
+    run_parallel(opts.concurrency, opts.jobs, job)
+
+
+def scenario_downloads(client, opts):
+    run_downloads(client, opts, {'format_id': '18', 'type': 'video', 'output_format': 'mp4'})
+
+
+def scenario_audio(client, opts):
+    run_downloads(client, opts, {'type': 'audio'})
+
+
+def scenario_passthrough(client, opts):
+    run_downloads(client, opts, {'type': 'audio', 'format_id': '140', 'output_format': 'm4a'})
+
+
+def scenario_polling(client, opts):
+    response = client.call('POST', 'POST /api/download', '/api/download',
+                           json={'url': video_url(20000), 'format_id': '18'})
+    download_id = response.json()['download_id']
+    wait_download(client, download_id, opts.poll_interval)
+    client.recorder.samples.clear()
+
+    def poll(_):
+        client.call('GET', 'GET /api/download-status', f'/api/download-status/{download_id}')
+    run_parallel(opts.concurrency, opts.requests, poll)
+
+
+SCENARIO_FUNCS = {
+    'info': scenario_info,
+    'fallback': scenario_info,
+    'downloads': scenario_downloads,
+    'polling': scenario_polling,
+    'cobalt': scenario_cobalt,
+    'audio': scenario_audio,
+    'passthrough': scenario_passthrough,
+}
+
+# Únicos arquivos do FakeUpstreams que os jobs de cada cenário podem buscar
+SCENARIO_MEDIA = {
+    'audio': ('audio.m4a', 'audio.webm'),
+    'passthrough': ('audio.m4a',),
+}
+
+
+def check_media(name, upstreams, before):
+    """Falhas do cenário: arquivos de mídia buscados que o formato pedido não usa"""
+    allowed = SCENARIO_MEDIA.get(name)
+    if allowed is None:
+        return []
+    return [f'{media} buscado {count - before.get(media, 0)}x'
+            for media, count in sorted(upstreams.media_requests.items())
+            if media not in allowed and count > before.get(media, 0)]
+
+
+def run_scenario(name, opts, upstreams, workdir):
+    extract_failure = 1.0 if name == 'fallback' else opts.extract_failure
+    server = ServerProcess(upstreams.url, opts.fixtures, workdir, opts.extract_latency, extract_failure)
+    try:
+        server.wait_ready()
+        recorder = Recorder()
+        client = LoadClient(server.url, recorder)
+        server.start_sampling()
+        media_before = dict(upstreams.media_requests)
+        started = time.perf_counter()
+        SCENARIO_FUNCS[name](client, opts)
+        elapsed = time.perf_counter() - started
+        peak_rss = server.stop_sampling()
+    finally:
+        server.stop()
+    failures = check_media(name, upstreams, media_before)
+    rows = []
+    for endpoint, samples in recorder.samples.items():
+        rows.append({
+            'scenario': name,
+            'endpoint': endpoint,
+            'count': len(samples),
+            'errors': recorder.errors.get(endpoint, 0),
+            'p50_ms': percentile(samples, 50) * 1000,
+            'p95_ms': percentile(samples, 95) * 1000,
+            'p99_ms': percentile(samples, 99) * 1000,
+            'per_second': len(samples) / elapsed if elapsed else 0.0,
+            'peak_rss_mb': peak_rss / 1024 / 1024,
+        })
+    if recorder.bytes:
+        rows.append({'scenario': name, 'endpoint': 'arquivos recebidos', 'count': 0, 'errors': 0,
+                     'p50_ms': 0, 'p95_ms': 0, 'p99_ms': 0,
+                     'per_second': recorder.bytes / elapsed / 1024 / 1024, 'peak_rss_mb': peak_rss / 1024 / 1024,
+                     'unit': 'MB/s'})
+    return rows, failures
+
+
+def print_rows(rows):
+    header = f"{'cenário':<10} {'endpoint':<28} {'n':>6} {'erros':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} " \
+             f"{'vazão':>12} {'RSS pico':>9}"
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        rate = f"{row['per_second']:.1f} {row.get('unit', 'req/s')}"
+        if row.get('unit'):
+            print(f"{row['scenario']:<10} {row['endpoint']:<28} {'':>6} {'':>6} {'':>9} {'':>9} {'':>9} "
+                  f"{rate:>12} {row['peak_rss_mb']:>7.1f}MB")
+            continue
+        print(f"{row['scenario']:<10} {row['endpoint']:<28} {row['count']:>6} {row['errors']:>6} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['p99_ms']:>9.1f} {rate:>12} "
+              f"{row['peak_rss_mb']:>7.1f}MB")
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Teste de carga local do VideoMax')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=200, help='requisições por cenário (info/polling/cobalt)')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--videos', type=int, default=20, help='vídeos distintos nas consultas')
+    parser.add_argument('--jobs', type=int, default=8, help='downloads nos cenários downloads/audio')
+    parser.add_argument('--poll-interval', type=float, default=0.25)
+    parser.add_argument('--extract-latency', type=float, default=0.3, help='segundos por extração do yt-dlp falso')
+    parser.add_argument('--extract-failure', type=float, default=0.0)
+    parser.add_argument('--piped-latency', type=float, default=0.2)
+    parser.add_argument('--piped-failure', type=float, default=0.1)
+    parser.add_argument('--cobalt-latency', type=float, default=0.3)
+    parser.add_argument('--cobalt-failure', type=float, default=0.1)
+    parser.add_argument('--media-rate', type=int, default=0, help='bytes/s por conexão de mídia (0 = sem limite)')
+    parser.add_argument('--fixtures', default=DEFAULT_FIXTURES, help='diretório com infos gravados (<id>.json)')
+    parser.add_argument('--json', help='grava os resultados neste arquivo')
+    parser.add_argument('--record', nargs='+', metavar='URL', help='grava infos reais e sai')
+    # Modo interno: processo do servidor
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--upstream', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    opts = parse_args(argv)
+    if opts.serve:
+        return serve(opts)
+    if opts.record:
+        for url in opts.record:
+            print(f"Gravado: {record_fixture(url, opts.fixtures)}")
+        return
+
+    scenarios = [name.strip() for name in opts.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Cenários desconhecidos: {', '.join(sorted(unknown))}")
+
+    workdir = tempfile.mkdtemp(prefix='videomax-bench-')
+    try:
+        real_media = generate_media(os.path.join(workdir, 'media'))
+        upstreams = FakeUpstreams(
+            os.path.join(workdir, 'media'),
+            piped=UpstreamBehavior(opts.piped_latency, opts.piped_latency / 2, opts.piped_failure),
+            cobalt=UpstreamBehavior(opts.cobalt_latency, opts.cobalt_latency / 2, opts.cobalt_failure),
+            media_rate=opts.media_rate,
+        ).start()
+        print(f"Mídia: {'ffmpeg' if real_media else 'bytes aleatórios (sem ffmpeg)'}; "
+              f"concorrência {opts.concurrency}; upstreams em {upstreams.url}\n")
+
+        rows = []
+        failures = []
+        for name in scenarios:
+            if name == 'audio' and not real_media:
+                print("audio: ignorado (ffmpeg não encontrado)")
+                continue
+            print(f"Rodando {name}...", flush=True)
+            scenario_rows, scenario_failures = run_scenario(name, opts, upstreams, workdir)
+            rows.extend(scenario_rows)
+            failures.extend(f'{name}: {failure}' for failure in scenario_failures)
+        upstreams.stop()
+        print()
+        print_rows(rows)
+        for failure in failures:
+            print(f"FALHA {failure}")
+        if opts.json:
+            with open(opts.json, 'w', encoding='utf-8') as f:
+                json.dump({'options': {k: v for k, v in vars(opts).items() if k not in ('serve', 'port')},
+                           'upstream_requests': upstreams.requests, 'results': rows, 'failures': failures},
+                          f, indent=2)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+Substitutos locais dos serviços externos usados pelo server.py
+
+- FakeUpstreams: servidor HTTP com a API do Piped (/piped/streams/<id>), a
+  do Cobalt (POST /cobalt/) e os arquivos de mídia (/media/<nome>, com
+  Range). Latência e taxa de falha são configuráveis por serviço.
+- generate_media: arquivos de mídia de teste. Com ffmpeg são vídeos/áudios
+  reais (testsrc + sine); sem ffmpeg são bytes aleatórios, suficientes para
+  os caminhos que não passam pelo ffmpeg.
+- StubExtractor: substituto de get_video_info_ytdlp que devolve infos
+  gravados (JSON em um diretório) ou o info sintético do
+  bench_video_info_payload, com as URLs apontando para /media.
+
+Uso direto (só o servidor falso): python bench/upstreams.py [porta]
+"""
+
+import copy
+import glob
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+MEDIA_FILES = {
+    # nome: (segundos, argumentos do ffmpeg, tamanho sem ffmpeg)
+    'muxed.mp4': (10, ['-f', 'lavfi', '-i', 'testsrc=size=640x360:rate=30', '-f', 'lavfi', '-i', 'sine=frequency=440',
+                       '-c:v', 'libx264', '-preset', 'ultrafast', '-c:a', 'aac', '-shortest'], 2 * 1024 * 1024),
+    'video.mp4': (10, ['-f', 'lavfi', '-i', 'testsrc=size=1280x720:rate=30',
+                       '-c:v', 'libx264', '-preset', 'ultrafast', '-an'], 4 * 1024 * 1024),
+    'audio.m4a': (10, ['-f', 'lavfi', '-i', 'sine=frequency=440', '-c:a', 'aac', '-b:a', '128k', '-vn'], 160 * 1024),
+    'audio.webm': (10, ['-f', 'lavfi', '-i', 'sine=frequency=440', '-c:a', 'libopus', '-b:a', '128k', '-vn'], 160 * 1024),
+}
+
+
+def generate_media(folder):
+    """Gera os arquivos de MEDIA_FILES que ainda não existem; retorna True se são mídia real"""
+    os.makedirs(folder, exist_ok=True)
+    ffmpeg = shutil.which('ffmpeg')
+    for name, (seconds, args, fallback_size) in MEDIA_FILES.items():
+        path = os.path.join(folder, name)
+        if os.path.exists(path):
+            continue
+        if ffmpeg:
+            subprocess.run([ffmpeg, '-y', '-loglevel', 'error', *args, '-t', str(seconds), path], check=True)
+        else:
+            with open(path, 'wb') as f:
+                f.write(os.urandom(fallback_size))
+    return ffmpeg is not None
+
+
+class UpstreamBehavior:
+    """Latência (segundos, com jitter) e taxa de falha de um serviço"""
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+
+    def delay(self):
+        wait = self.latency + random.uniform(0, self.jitter)
+        if wait > 0:
+            time.sleep(wait)
+
+    def fails(self):
+        return random.random() < self.failure_rate
+
+
+def piped_streams(video_id, media_base):
+    """Resposta /streams/<id> no formato do Piped"""
+    return {
+        'title': f'Vídeo {video_id}',
+        'duration': 10,
+        'views': 123456,
+        'uploader': 'Canal de teste',
+        'thumbnailUrl': '',
+        'videoStreams': [
+            {'quality': '360p', 'fps': 30, 'videoOnly': False, 'format': 'MPEG_4', 'url': f'{media_base}/muxed.mp4'},
+            {'quality': '720p', 'fps': 30, 'videoOnly': True, 'format': 'MPEG_4', 'url': f'{media_base}/video.mp4'},
+        ],
+        'audioStreams': [
+            {'bitrate': 128000, 'format': 'M4A', 'url': f'{media_base}/audio.m4a'},
+            {'bitrate': 135000, 'format': 'WEBMA_OPUS', 'url': f'{media_base}/audio.webm'},
+        ],
+    }
+
+
+class FakeUpstreams:
+    """Servidor HTTP local que faz o papel do Piped, do Cobalt e da CDN de mídia"""
+
+    def __init__(self, media_folder, port=0, piped=None, cobalt=None, media_rate=0):
+        self.media_folder = media_folder
+        self.piped = piped or UpstreamBehavior()
+        self.cobalt = cobalt or UpstreamBehavior()
+        # Bytes/s por conexão de mídia (0 = sem limite)
+        self.media_rate = media_rate
+        self.requests = {'piped': 0, 'cobalt': 0, 'media': 0}
+        # GETs por arquivo de mídia (para conferir o que cada job baixou)
+        self.media_requests = {}
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    @property
+    def media_base(self):
+        return f'{self.url}/media'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _handler(self):
+        upstreams = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                match = re.match(r'^/piped/streams/([\w-]+)$', self.path)
+                if match:
+                    upstreams.requests['piped'] += 1
+                    upstreams.piped.delay()
+                    if upstreams.piped.fails():
+                        return self.send_json(500, {'error': 'falha simulada'})
+                    return self.send_json(200, piped_streams(match.group(1), upstreams.media_base))
+                if self.path.startswith('/media/'):
+                    name = os.path.basename(self.path.split('?')[0])
+                    upstreams.requests['media'] += 1
+                    upstreams.media_requests[name] = upstreams.media_requests.get(name, 0) + 1
+                    return self.send_media(name, head=False)
+                self.send_json(404, {'error': 'não encontrado'})
+
+            def do_HEAD(self):
+                if self.path.startswith('/media/'):
+                    return self.send_media(os.path.basename(self.path.split('?')[0]), head=True)
+                self.send_json(404, {})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                if self.path.rstrip('/') != '/cobalt':
+                    return self.send_json(404, {'error': 'não encontrado'})
+                upstreams.requests['cobalt'] += 1
+                upstreams.cobalt.delay()
+                if upstreams.cobalt.fails():
+                    return self.send_json(500, {'status': 'error', 'error': {'code': 'simulated'}})
+                audio = payload.get('downloadMode') == 'audio'
+                return self.send_json(200, {
+                    'status': 'tunnel',
+                    'url': f"{upstreams.media_base}/{'audio.m4a' if audio else 'muxed.mp4'}",
+                    'filename': 'audio.mp3' if audio else 'video.mp4',
+                })
+
+            def send_media(self, name, head):
+                path = os.path.join(upstreams.media_folder, name)
+                if not os.path.isfile(path):
+                    return self.send_json(404, {'error': 'não encontrado'})
+                size = os.path.getsize(path)
+                start, end = 0, size - 1
+                match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+                if match and (match.group(1) or match.group(2)):
+                    if match.group(1):
+                        start = int(match.group(1))
+                        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                    else:
+                        start = max(0, size - int(match.group(2)))
+                    if start > end:
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{size}')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Accept-Ranges', 'bytes')
+                self.send_header('Content-Length', str(end - start + 1))
+                self.end_headers()
+                if head:
+                    return
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        chunk = f.read(min(64 * 1024, remaining))
+                        if not chunk:
+                            break
+                        self.wfile.write(chunk)
+                        remaining -= len(chunk)
+                        if upstreams.media_rate:
+                            time.sleep(len(chunk) / upstreams.media_rate)
+
+        return Handler
+
+
+def localize_info(info, video_id, media_base, duration=10):
+    """Aponta todos os formatos para os arquivos locais e remove o que exige a rede"""
+    info = copy.deepcopy(info)
+    formats = []
+    for fmt in info.get('formats', []):
+        has_video = fmt.get('vcodec', 'none') != 'none'
+        has_audio = fmt.get('acodec', 'none') != 'none'
+        if not has_video and not has_audio:
+            continue  # storyboards
+        if has_video and has_audio:
+            name = 'muxed.mp4'
+        elif has_video:
+            name = 'video.mp4'
+        else:
+            name = 'audio.webm' if fmt.get('ext') == 'webm' else 'audio.m4a'
+        fmt.pop('fragments', None)
+        fmt.pop('manifest_url', None)
+        fmt.pop('http_headers', None)
+        fmt['url'] = f'{media_base}/{name}'
+        fmt['protocol'] = 'http'
+        if name != 'video.mp4':
+            fmt['ext'] = name.rsplit('.', 1)[1]
+        formats.append(fmt)
+    info.update({
+        'id': video_id,
+        'title': f'{info.get("title", "Vídeo")} {video_id}',
+        'duration': duration,
+        'formats': formats,
+        'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+        'extractor': 'youtube',
+        'extractor_key': 'Youtube',
+    })
+    info.pop('requested_formats', None)
+    return info
+
+
+class StubExtractor:
+    """Substituto de get_video_info_ytdlp sem rede
+
+    Usa os infos gravados em fixtures_dir (<id>.json; um arquivo qualquer
+    serve de modelo para IDs sem gravação) ou o info sintético do
+    bench_video_info_payload. Como o extract_info real, devolve o info já
+    processado, com o formato padrão do yt-dlp (par vídeo+áudio) escolhido.
+    """
+
+    def __init__(self, media_base, fixtures_dir=None, behavior=None):
+        self.media_base = media_base
+        self.behavior = behavior or UpstreamBehavior()
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._templates = {}
+        for path in sorted(glob.glob(os.path.join(fixtures_dir, '*.json'))) if fixtures_dir else []:
+            with open(path, encoding='utf-8') as f:
+                self._templates[os.path.splitext(os.path.basename(path))[0]] = json.load(f)
+        if not self._templates:
+            from bench_video_info_payload import sample_info
+            self._templates['sample'] = sample_info(duration=10)
+
+    def __call__(self, url):
+        with self._lock:
+            self.calls += 1
+        self.behavior.delay()
+        if self.behavior.fails():
+            raise Exception('ERROR: falha simulada do extrator')
+        match = re.search(r'([a-zA-Z0-9_-]{11})', url)
+        video_id = match.group(1) if match else 'bench000000'
+        template = self._templates.get(video_id) or next(iter(self._templates.values()))
+        info = localize_info(template, video_id, self.media_base)
+        import yt_dlp
+        with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'format': 'bestvideo*+bestaudio/best'}) as ydl:
+            return ydl.process_ie_result(info, download=False)
+
+
+def record_fixture(url, fixtures_dir):
+    """Grava o info real de uma URL (precisa de rede) para uso posterior no StubExtractor"""
+    import yt_dlp
+    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True}) as ydl:
+        info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+    for key in ('requested_formats', 'requested_downloads', 'automatic_captions', 'subtitles', 'heatmap'):
+        info.pop(key, None)
+    os.makedirs(fixtures_dir, exist_ok=True)
+    path = os.path.join(fixtures_dir, f"{info['id']}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+    return path
+
+
+if __name__ == '__main__':
+    import tempfile
+    folder = os.path.join(tempfile.gettempdir(), 'videomax-bench-media')
+    real = generate_media(folder)
+    upstreams = FakeUpstreams(folder, port=int(sys.argv[1]) if len(sys.argv) > 1 else 8790).start()
+    print(f"Piped:  {upstreams.url}/piped")
+    print(f"Cobalt: {upstreams.url}/cobalt")
+    print(f"Mídia:  {upstreams.media_base} ({'ffmpeg' if real else 'bytes aleatórios'}, em {folder})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        upstreams.stop()
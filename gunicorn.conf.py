@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Configuração do Gunicorn para o VideoMax
+
+Workers 'gthread': cada processo atende várias requisições ao mesmo tempo em
+threads, então extrações lentas do yt-dlp não bloqueiam /api/health nem as
+consultas de status. Respostas longas (SSE, arquivos em crescimento, ZIPs e
+streams do FFmpeg) ocupam no máximo MAX_HELD_RESPONSES threads por worker
+(padrão: metade de GUNICORN_THREADS); além disso recebem 503. O trabalho
+pesado roda nos pools próprios do server.py (resolver_executor e
+download_scheduler).
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '10000')}"
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+
+# Com gthread o timeout vale para o heartbeat do worker, não para cada requisição
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 300))
+graceful_timeout = 30
+keepalive = 5
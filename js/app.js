@@ -132,13 +132,8 @@ class VideoDownloader {
     async getVideoInfo(url) {
         // Call backend API
         try {
-            const response = await fetch('/api/video-info', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json'
-                },
-                body: JSON.stringify({ url })
-            });
+            // GET: o navegador guarda a resposta e a revalida pelo ETag
+            const response = await fetch(`/api/video-info?url=${encodeURIComponent(url)}`);
             
             const data = await response.json();
             
@@ -190,7 +185,6 @@ class VideoDownloader {
                     views: 'N/A',
                     channel: 'YouTube',
                     use_cobalt: true,
-                    cobalt_url: data.download_url,
                     formats: {
                         video: [
                             {format_id: 'cobalt_best', quality: 'Melhor Qualidade', resolution: 'Auto', size: 'N/A', fps: 30, format: 'MP4', format_name: 'MP4 (Auto)', codec: 'h264'}
@@ -224,12 +218,27 @@ class VideoDownloader {
         this.videoChannel.innerHTML = `<i class="fas fa-user"></i> ${info.channel}`;
         
         // Generate video options
-        this.generateVideoOptions(info.formats.video);
+        this.generateVideoOptions(this.expandVideoFormats(info));
         
         // Generate audio options
         this.generateAudioOptions(info.formats.audio);
     }
 
+    expandVideoFormats(info) {
+        // Resposta compacta: uma entrada por qualidade com a lista de containers
+        const containers = {};
+        (info.containers || []).forEach(container => { containers[container.format] = container; });
+        info.formats.video = info.formats.video.flatMap(quality => quality.containers
+            ? quality.containers.map(ext => ({
+                ...quality,
+                format: ext,
+                format_name: containers[ext] ? containers[ext].name : ext,
+                codec: containers[ext] ? containers[ext].codec : 'h264'
+            }))
+            : [quality]);
+        return info.formats.video;
+    }
+
     generateVideoOptions(formats) {
         // Adicionar indicador de velocidade
         const addSpeedIndicator = (quality) => {
@@ -292,7 +301,7 @@ class VideoDownloader {
                 <div class="quality-info">
                     <div class="quality-badge">${format.quality}</div>
                     <div class="quality-details">
-                        <h5>${format.format} Audio</h5>
+                        <h5>${format.format_name || format.format + ' Audio'}</h5>
                         <div class="quality-specs">
                             <span><i class="fas fa-hdd"></i> ${format.size}</span>
                         </div>
@@ -348,12 +357,16 @@ class VideoDownloader {
                     format_id: format.format_id,
                     type: type,
                     output_format: format.format ? format.format.toLowerCase() : 'mp4',
-                    codec: format.codec || 'h264',
-                    use_cobalt: this.currentVideo.use_cobalt || false,
-                    cobalt_url: this.currentVideo.cobalt_url || ''
+                    codec: format.codec || 'h264'
                 })
             });
             
+            if (response.status === 429 || response.status === 503) {
+                const retryAfter = response.headers.get('Retry-After') || '30';
+                const busy = await response.json().catch(() => ({}));
+                throw new Error(busy.error || `Servidor ocupado, tente novamente em ${retryAfter}s`);
+            }
+            
             if (!response.ok) {
                 throw new Error('Erro ao iniciar download');
             }
@@ -364,13 +377,6 @@ class VideoDownloader {
                 throw new Error(data.error || 'Erro ao iniciar download');
             }
             
-            // Se for download direto via Cobalt, abrir URL
-            if (data.direct_url) {
-                this.showToast(`✅ Abrindo download...`, 'success');
-                window.open(data.direct_url, '_blank');
-                return;
-            }
-            
             // Monitorar progresso
             this.monitorDownload(data.download_id, format);
             
@@ -416,37 +422,58 @@ class VideoDownloader {
         progressCircle.style.strokeDasharray = circumference;
         progressCircle.style.strokeDashoffset = circumference;
         
+        // Atualiza a tela; retorna true enquanto o download não terminou
+        const handleStatus = (data) => {
+            if (data.status === 'queued') {
+                const position = data.queue_position ? ` (posição ${data.queue_position})` : '';
+                downloadStatus.textContent = `Na fila${position}...`;
+                return true;
+            } else if (data.status === 'downloading') {
+                const progress = data.progress || 0;
+                const offset = circumference - (progress / 100) * circumference;
+                progressCircle.style.strokeDashoffset = offset;
+                progressPercent.textContent = `${progress}%`;
+                const speed = data.speed ? ` (${(data.speed / 1048576).toFixed(1)} MB/s)` : '';
+                if (data.encoding === 'waiting') {
+                    downloadStatus.textContent = 'Aguardando conversão...';
+                } else if (data.encoding === 'running') {
+                    const encodeSpeed = data.encode_speed ? ` (${data.encode_speed}x)` : '';
+                    downloadStatus.textContent = `Convertendo...${encodeSpeed}`;
+                } else {
+                    downloadStatus.textContent = `Baixando... ${progress}%${speed}`;
+                }
+                return true;
+            } else if (data.status === 'completed') {
+                progressCircle.style.strokeDashoffset = 0;
+                progressPercent.textContent = '100%';
+                downloadStatus.innerHTML = '✅ <strong>Download Concluído!</strong>';
+                
+                setTimeout(() => {
+                    overlay.remove();
+                    this.showToast(`✅ Download concluído!`, 'success');
+                    // Iniciar download do arquivo
+                    window.location.href = `/api/download-file/${downloadId}`;
+                    
+                    // Recarregar a página para voltar ao início após 2 segundos
+                    setTimeout(() => {
+                        location.href = '/';
+                    }, 2000);
+                }, 1500);
+            } else if (data.status === 'error') {
+                overlay.remove();
+                this.showToast(`❌ Erro no download: ${data.error}`, 'error');
+            }
+            return false;
+        };
+        
+        // Fallback: consultar o status periodicamente
         const checkStatus = async () => {
             try {
                 const response = await fetch(`/api/download-status/${downloadId}`);
                 const data = await response.json();
                 
-                if (data.status === 'downloading') {
-                    const progress = data.progress || 0;
-                    const offset = circumference - (progress / 100) * circumference;
-                    progressCircle.style.strokeDashoffset = offset;
-                    progressPercent.textContent = `${progress}%`;
-                    downloadStatus.textContent = `Baixando... ${progress}%`;
-                    setTimeout(checkStatus, 500);
-                } else if (data.status === 'completed') {
-                    progressCircle.style.strokeDashoffset = 0;
-                    progressPercent.textContent = '100%';
-                    downloadStatus.innerHTML = '✅ <strong>Download Concluído!</strong>';
-                    
-                    setTimeout(() => {
-                        overlay.remove();
-                        this.showToast(`✅ Download concluído!`, 'success');
-                        // Iniciar download do arquivo
-                        window.location.href = `/api/download-file/${downloadId}`;
-                        
-                        // Recarregar a página para voltar ao início após 2 segundos
-                        setTimeout(() => {
-                            location.href = '/';
-                        }, 2000);
-                    }, 1500);
-                } else if (data.status === 'error') {
-                    overlay.remove();
-                    this.showToast(`❌ Erro no download: ${data.error}`, 'error');
+                if (handleStatus(data)) {
+                    setTimeout(checkStatus, data.status === 'queued' ? 1000 : 500);
                 }
             } catch (error) {
                 console.error('Error checking status:', error);
@@ -454,7 +481,24 @@ class VideoDownloader {
             }
         };
         
-        checkStatus();
+        if (!window.EventSource) {
+            checkStatus();
+            return;
+        }
+        
+        // Progresso enviado pelo servidor (SSE)
+        const events = new EventSource(`/api/download-events/${downloadId}`);
+        events.onmessage = (event) => {
+            if (!handleStatus(JSON.parse(event.data))) {
+                events.close();
+            }
+        };
+        events.onerror = () => {
+            // Conexão recusada/encerrada de vez: voltar para consultas periódicas
+            if (events.readyState === EventSource.CLOSED) {
+                checkStatus();
+            }
+        };
     }
 
     showBackendError() {
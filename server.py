@@ -4,21 +4,181 @@ VideoMax Backend - Sistema de Download de Vídeos
 Versão: 2.0.0 - Com fallback Piped e Cobalt
 """
 
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, request, jsonify, send_file, send_from_directory, Response, stream_with_context, g
 from flask_cors import CORS
+from werkzeug.http import http_date
+from werkzeug.wsgi import wrap_file
+from werkzeug.middleware.proxy_fix import ProxyFix
 import yt_dlp
+from yt_dlp.postprocessor import FFmpegMergerPP
+from yt_dlp.utils import prepend_extension
 import os
 import uuid
 import time
 import re
-from threading import Thread
+import copy
+import heapq
+import itertools
+import json
+import sqlite3
+import hashlib
+import gzip
+import zipfile
+import mimetypes
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Thread, Lock, Condition, BoundedSemaphore, local
+from urllib.parse import quote as url_quote, urlsplit
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import subprocess
 import shutil
 import requests
+from requests.adapters import HTTPAdapter
 
 app = Flask(__name__, static_folder='.')
 CORS(app)
 
+# Proxies reversos à frente do app (o Render usa 1) para obter o IP real do cliente
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+
+# Métricas no formato de texto do Prometheus (por processo)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+THROUGHPUT_BUCKETS = (64e3, 256e3, 1e6, 2.5e6, 5e6, 10e6, 25e6, 50e6, 100e6)
+
+def format_labels(labels):
+    """Renderiza {chave="valor"} com os escapes do Prometheus"""
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+class Counter:
+    """Contador monotônico com rótulos"""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+class Gauge:
+    """Valor instantâneo calculado na hora da coleta"""
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        try:
+            lines.append(f"{self.name} {self.callback()}")
+        except Exception as e:
+            print(f"Erro ao coletar {self.name}: {e}")
+        return lines
+
+class CallbackCounter(Gauge):
+    """Contador monotônico mantido por outro objeto, lido na hora da coleta"""
+
+    metric_type = 'counter'
+
+class Histogram:
+    """Histograma com rótulos; time() cronometra um bloco com perf_counter"""
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f"{self.name}_bucket{format_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Conjunto de métricas expostas em /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+EXTRACT_INFO_SECONDS = metrics.register(Histogram(
+    'videomax_extract_info_seconds', 'Duração do extract_info do yt-dlp'))
+RESOLVE_SECONDS = metrics.register(Histogram(
+    'videomax_resolve_seconds', 'Latência de cada tentativa de resolução por backend e resultado'))
+DOWNLOAD_THROUGHPUT = metrics.register(Histogram(
+    'videomax_download_throughput_bytes_per_second', 'Velocidade instantânea dos downloads', THROUGHPUT_BUCKETS))
+DOWNLOADED_BYTES = metrics.register(Counter(
+    'videomax_downloaded_bytes_total', 'Bytes baixados das origens'))
+POSTPROCESS_SECONDS = metrics.register(Histogram(
+    'videomax_postprocess_seconds', 'Duração dos pós-processadores do FFmpeg'))
+DOWNLOAD_JOBS = metrics.register(Counter(
+    'videomax_download_jobs_total', 'Jobs de download finalizados por resultado'))
+HTTP_REQUEST_SECONDS = metrics.register(Histogram(
+    'videomax_http_request_seconds', 'Latência das requisições por rota'))
+RATE_LIMITED_REQUESTS = metrics.register(Counter(
+    'videomax_rate_limited_requests_total', 'Requisições recusadas pelo limite de taxa ou de jobs'))
+
 print("=" * 50)
 print("VideoMax Backend v2.0.0 - Piped + Cobalt Fallback")
 print("=" * 50)
@@ -38,6 +198,181 @@ PIPED_INSTANCES = [
     "https://api.piped.yt",
 ]
 
+# Conexões HTTP com as APIs externas (pool por host com keep-alive)
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 10))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+
+class HttpClientPool:
+    """Uma requests.Session por host, reaproveitando conexões TCP/TLS entre chamadas"""
+
+    def __init__(self, pool_maxsize, connect_timeout, read_timeout):
+        self.pool_maxsize = pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._sessions = {}
+        self._lock = Lock()
+
+    def session(self, url):
+        """Sessão compartilhada (thread-safe) do host da URL"""
+        parts = urlsplit(url)
+        host = f"{parts.scheme}://{parts.netloc}"
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, pool_block=False)
+                session.mount(host, adapter)
+                self._sessions[host] = session
+            return session
+
+    def request(self, method, url, timeout=None, **kwargs):
+        """Faz a requisição; timeout numérico substitui só o tempo de leitura"""
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+        elif not isinstance(timeout, tuple):
+            timeout = (self.connect_timeout, timeout)
+        return self.session(url).request(method, url, timeout=timeout, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Conexões abertas x requisições feitas por host (a diferença foi reaproveitada)"""
+        with self._lock:
+            sessions = dict(self._sessions)
+        result = {}
+        for host, session in sessions.items():
+            connections = 0
+            requests_made = 0
+            pools = session.get_adapter(host).poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_made += pool.num_requests
+            result[host] = {
+                'connections': connections,
+                'requests': requests_made,
+                'reused': max(0, requests_made - connections),
+            }
+        return result
+
+http_client = HttpClientPool(HTTP_POOL_MAXSIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+# Circuit breaker das instâncias (falhas seguidas para abrir e segundos até testar de novo)
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 3))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', 60))
+# Peso da última medição nas médias móveis (EWMA) de sucesso e latência
+HEALTH_EWMA_ALPHA = float(os.environ.get('HEALTH_EWMA_ALPHA', 0.3))
+
+class InstanceHealth:
+    """Saúde das instâncias Piped/Cobalt: taxa de sucesso e latência (EWMA) com circuit breaker
+
+    Estados do circuito: 'closed' (em uso), 'open' (ignorada até passar
+    CIRCUIT_OPEN_SECONDS) e 'half_open' (uma única requisição de teste).
+    """
+
+    def __init__(self, failure_threshold, open_seconds, alpha):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.alpha = alpha
+        self._stats = {}
+        self._lock = Lock()
+
+    def _get(self, instance):
+        stats = self._stats.get(instance)
+        if stats is None:
+            stats = {
+                'state': 'closed',
+                'success_rate': 1.0,
+                'latency': None,
+                'consecutive_failures': 0,
+                'opened_at': None,
+                'probe_at': None,
+                'requests': 0,
+                'failures': 0,
+            }
+            self._stats[instance] = stats
+        return stats
+
+    def record(self, instance, ok, latency):
+        """Registra o resultado de uma requisição à instância"""
+        with self._lock:
+            stats = self._get(instance)
+            stats['requests'] += 1
+            stats['success_rate'] += self.alpha * ((1.0 if ok else 0.0) - stats['success_rate'])
+            if stats['latency'] is None:
+                stats['latency'] = latency
+            else:
+                stats['latency'] += self.alpha * (latency - stats['latency'])
+            stats['probe_at'] = None
+            if ok:
+                stats['consecutive_failures'] = 0
+                stats['state'] = 'closed'
+                stats['opened_at'] = None
+                return
+            stats['failures'] += 1
+            stats['consecutive_failures'] += 1
+            if stats['state'] == 'half_open' or stats['consecutive_failures'] >= self.failure_threshold:
+                if stats['state'] != 'open':
+                    print(f"Circuito aberto para {instance}")
+                stats['state'] = 'open'
+                stats['opened_at'] = time.time()
+
+    def _allow(self, stats):
+        if stats['state'] == 'closed':
+            return True
+        if stats['state'] == 'open' and time.time() - stats['opened_at'] >= self.open_seconds:
+            stats['state'] = 'half_open'
+        # Um teste por vez; um teste que nunca foi executado expira junto com o circuito
+        if stats['state'] == 'half_open':
+            now = time.time()
+            if stats['probe_at'] is None or now - stats['probe_at'] >= self.open_seconds:
+                stats['probe_at'] = now
+                return True
+        return False
+
+    def _score(self, instance):
+        stats = self._get(instance)
+        return (-round(stats['success_rate'], 2), stats['latency'] or 0.0)
+
+    def ranked(self, instances):
+        """Instâncias liberadas pelo circuit breaker, das mais saudáveis para as menos"""
+        with self._lock:
+            allowed = [instance for instance in instances if self._allow(self._get(instance))]
+            return sorted(allowed, key=self._score)
+
+    def ordered(self, instances):
+        """Todas as instâncias ordenadas por saúde (sem consumir testes do circuito)"""
+        with self._lock:
+            return sorted(instances, key=self._score)
+
+    def snapshot(self):
+        """Tabela atual de saúde por instância"""
+        with self._lock:
+            return {
+                instance: dict(stats, success_rate=round(stats['success_rate'], 3),
+                               latency=round(stats['latency'], 3) if stats['latency'] is not None else None)
+                for instance, stats in self._stats.items()
+            }
+
+instance_health = InstanceHealth(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS, HEALTH_EWMA_ALPHA)
+
+def tracked_call(instance, func, *args):
+    """Executa a consulta à instância registrando latência e resultado"""
+    started = time.monotonic()
+    try:
+        result = func(*args)
+    except Exception:
+        instance_health.record(instance, False, time.monotonic() - started)
+        raise
+    instance_health.record(instance, result is not None, time.monotonic() - started)
+    return result
+
 # Encontrar FFmpeg automaticamente
 def find_ffmpeg():
     """Encontra o executável do FFmpeg no sistema"""
@@ -61,55 +396,1387 @@ FFMPEG_LOCATION = find_ffmpeg()
 # Caminho para o arquivo de cookies do YouTube
 COOKIES_FILE = os.path.join(os.path.dirname(__file__), 'cookies.txt')
 
+# Instâncias do YoutubeDL reaproveitadas (ociosas por perfil e número de perfis)
+YDL_POOL_MAX_IDLE = int(os.environ.get('YDL_POOL_MAX_IDLE', 4))
+YDL_POOL_MAX_PROFILES = int(os.environ.get('YDL_POOL_MAX_PROFILES', 16))
+# Opções que mudam a cada job e são aplicadas na instância emprestada
+YDL_JOB_OPTIONS = ('format', 'outtmpl', 'progress_hooks', 'postprocessor_hooks',
+                   'ratelimit', 'concurrent_fragment_downloads')
+
+class YoutubeDLPool:
+    """Instâncias pré-aquecidas do YoutubeDL agrupadas por perfil de opções
+
+    Criar um YoutubeDL reprocessa as opções, registra extratores e
+    pós-processadores e recarrega o cookies.txt. Aqui cada instância é
+    emprestada a uma thread por vez (checkout) e devolvida ao final; só as
+    opções do job (YDL_JOB_OPTIONS e sobrescritas avulsas) são trocadas.
+    Instâncias criadas antes da última alteração do COOKIES_FILE são
+    descartadas no próximo checkout.
+    """
+
+    def __init__(self, max_idle, max_profiles):
+        self.max_idle = max_idle
+        self.max_profiles = max_profiles
+        self._idle = OrderedDict()
+        self._lock = Lock()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    @staticmethod
+    def _cookies_mtime():
+        try:
+            return os.path.getmtime(COOKIES_FILE)
+        except OSError:
+            return None
+
+    @staticmethod
+    def _profile_key(profile, params):
+        encoded = json.dumps(params, sort_keys=True, default=repr).encode('utf-8')
+        return f"{profile}:{hashlib.sha1(encoded).hexdigest()}"
+
+    def _create(self, params, cookies_mtime):
+        entry = {'progress_hooks': [], 'postprocessor_hooks': [], 'cookies_mtime': cookies_mtime}
+        # O YoutubeDL altera o dicionário recebido; usar uma cópia
+        ydl = yt_dlp.YoutubeDL(copy.deepcopy(params))
+        # Hooks fixos que repassam para os hooks do job atual
+        ydl.add_progress_hook(lambda d: [hook(d) for hook in entry['progress_hooks']])
+        ydl.add_postprocessor_hook(lambda d: [hook(d) for hook in entry['postprocessor_hooks']])
+        entry['ydl'] = ydl
+        return entry
+
+    def _discard(self, entry):
+        self.discarded += 1
+        ydl = entry['ydl']
+        # Não regravar o cookies.txt (isso invalidaria as outras instâncias)
+        ydl.params['cookiefile'] = None
+        try:
+            ydl.close()
+        except Exception as e:
+            print(f"Erro ao fechar YoutubeDL: {e}")
+
+    @contextmanager
+    def checkout(self, profile, params, **job):
+        """Empresta uma instância do perfil com as opções do job aplicadas"""
+        key = self._profile_key(profile, params)
+        cookies_mtime = self._cookies_mtime()
+        entry = None
+        stale = []
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle and entry is None:
+                candidate = idle.pop()
+                if candidate['cookies_mtime'] == cookies_mtime:
+                    entry = candidate
+                else:
+                    stale.append(candidate)
+        for candidate in stale:
+            self._discard(candidate)
+        if entry is None:
+            entry = self._create(params, cookies_mtime)
+            self.created += 1
+        else:
+            self.reused += 1
+        
+        ydl = entry['ydl']
+        restore = self._apply_job(entry, job)
+        ok = False
+        try:
+            yield ydl
+            ok = True
+        finally:
+            restore()
+            if ok:
+                self._checkin(key, entry)
+            else:
+                # Depois de um erro, não confiar no estado interno da instância
+                self._discard(entry)
+
+    def _apply_job(self, entry, job):
+        ydl = entry['ydl']
+        saved = {}
+        saved_outtmpl = ydl.params['outtmpl'].get('default')
+        saved_selector = ydl.format_selector
+        for option, value in job.items():
+            if option in ('progress_hooks', 'postprocessor_hooks'):
+                entry[option] = list(value)
+            elif option == 'outtmpl':
+                ydl.params['outtmpl']['default'] = value
+            else:
+                saved[option] = ydl.params.get(option)
+                ydl.params[option] = value
+                if option == 'format':
+                    ydl.format_selector = ydl.build_format_selector(value)
+        
+        def restore():
+            entry['progress_hooks'] = []
+            entry['postprocessor_hooks'] = []
+            ydl.params['outtmpl']['default'] = saved_outtmpl
+            ydl.format_selector = saved_selector
+            for option, value in saved.items():
+                if value is None:
+                    ydl.params.pop(option, None)
+                else:
+                    ydl.params[option] = value
+        return restore
+
+    def _checkin(self, key, entry):
+        discard = None
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            self._idle.move_to_end(key)
+            if len(idle) < self.max_idle:
+                idle.append(entry)
+            else:
+                discard = [entry]
+            while len(self._idle) > self.max_profiles:
+                _, evicted = self._idle.popitem(last=False)
+                discard = (discard or []) + evicted
+        for candidate in discard or []:
+            self._discard(candidate)
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(entries) for entries in self._idle.values())
+            profiles = len(self._idle)
+        return {
+            'profiles': profiles,
+            'idle': idle,
+            'created': self.created,
+            'reused': self.reused,
+            'discarded': self.discarded,
+        }
+
+ydl_pool = YoutubeDLPool(YDL_POOL_MAX_IDLE, YDL_POOL_MAX_PROFILES)
+
+# Orçamento global de banda (bytes/s, 0 = sem limite) e de conexões de fragmentos
+EGRESS_BANDWIDTH_LIMIT = int(os.environ.get('EGRESS_BANDWIDTH_LIMIT', 0))
+MAX_FRAGMENT_CONNECTIONS = int(os.environ.get('MAX_FRAGMENT_CONNECTIONS', 16))
+MAX_FRAGMENTS_PER_JOB = 8
+# Cada processo publica no state store quantos streams baixa a cada tantos segundos;
+# registros sem renovação (processo morto) saem da conta
+EGRESS_SYNC_INTERVAL = float(os.environ.get('EGRESS_SYNC_INTERVAL', 2))
+EGRESS_STALE_AFTER = 3 * EGRESS_SYNC_INTERVAL
+# Processos do gunicorn (mesmo padrão do gunicorn.conf.py), para dividir a CPU das conversões
+BUDGET_WORKERS = max(1, int(os.environ.get('WEB_CONCURRENCY', 2)))
+
+class BandwidthBudget:
+    """Divide a banda e as conexões de fragmentos entre os downloads ativos de todos os processos
+
+    Cada processo publica no registry (o state store) quantos streams de
+    usuários está baixando e recebe a soma dos demais; a fatia de cada stream
+    é o total dividido pelos streams de todo o serviço. A cada job que entra
+    ou sai, e a cada sincronização, reescreve 'ratelimit' e
+    'concurrent_fragment_downloads' nas instâncias do yt-dlp em uso. O
+    ratelimit é lido a cada bloco baixado, então vale na hora; o número de
+    fragmentos vale a partir do próximo arquivo do job.
+    """
+
+    def __init__(self, bandwidth, connections, max_fragments, background_floor=0, registry=None):
+        self.bandwidth = bandwidth
+        self.connections = connections
+        self.max_fragments = max_fragments
+        self.background_floor = background_floor
+        self.registry = registry
+        self._jobs = {}
+        # Streams dos outros processos na última sincronização
+        self._remote_streams = 0
+        self._published = 0
+        self._lock = Lock()
+
+    @contextmanager
+    def share(self, download_id, ydl, background_rate=None):
+        """Registra o job; com background_rate ele fica fora da divisão e
+        cai para background_floor enquanto houver jobs de usuários"""
+        with self._lock:
+            self._jobs[download_id] = {'ydl': ydl, 'streams': 1, 'background': background_rate}
+            self._rebalance()
+        self.sync()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._jobs.pop(download_id, None)
+                self._rebalance()
+            self.sync()
+
+    @contextmanager
+    def parallel_streams(self, ydl, streams):
+        """O job baixa streams arquivos ao mesmo tempo e recebe uma fatia para cada um"""
+        with self._lock:
+            job = next((job for job in self._jobs.values() if job['ydl'] is ydl), None)
+            if job is not None:
+                job['streams'] = streams
+                self._rebalance()
+        if job is not None:
+            self.sync()
+        try:
+            yield
+        finally:
+            if job is not None:
+                with self._lock:
+                    job['streams'] = 1
+                    self._rebalance()
+                self.sync()
+
+    def promote(self, download_id):
+        """Um usuário passou a esperar pelo job de fundo: ele entra na divisão normal"""
+        with self._lock:
+            job = self._jobs.get(download_id)
+            if job is not None and job['background'] is not None:
+                job['background'] = None
+                self._rebalance()
+        self.sync()
+
+    def sync(self):
+        """Publica os streams deste processo e relê os dos demais no registry"""
+        if self.registry is None:
+            return
+        with self._lock:
+            if not self._jobs and not self._published:
+                return
+            streams = self._foreground_streams()
+        try:
+            remote = self.registry.egress_sync(process_owner(), streams, time.time() - EGRESS_STALE_AFTER)
+        except Exception as e:
+            print(f"Erro ao sincronizar o orçamento de banda: {e}")
+            return
+        with self._lock:
+            self._published = streams
+            if remote != self._remote_streams:
+                self._remote_streams = remote
+                self._rebalance()
+
+    def start_sync(self, interval):
+        """Thread que renova a publicação e acompanha os jobs dos outros processos"""
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.sync()
+        Thread(target=loop, daemon=True).start()
+
+    def _limits(self, streams):
+        fragments = max(1, min(self.max_fragments, self.connections // streams))
+        rate = self.bandwidth // streams if self.bandwidth else None
+        return rate, fragments
+
+    def _foreground_streams(self):
+        return sum(job['streams'] for job in self._jobs.values() if job['background'] is None)
+
+    def _rebalance(self):
+        streams = self._foreground_streams() + self._remote_streams
+        rate, fragments = self._limits(max(1, streams))
+        for job in self._jobs.values():
+            if job['background'] is not None:
+                # Jobs de fundo: uma conexão e banda própria, mínima se há usuários
+                job['ydl'].params['ratelimit'] = self.background_floor if streams else job['background'] or None
+                job['ydl'].params['concurrent_fragment_downloads'] = 1
+                continue
+            job['ydl'].params['ratelimit'] = rate
+            job['ydl'].params['concurrent_fragment_downloads'] = fragments
+
+    def stats(self):
+        with self._lock:
+            streams = self._foreground_streams()
+            rate, fragments = self._limits(max(1, streams + self._remote_streams))
+            return {
+                'active_jobs': len(self._jobs),
+                'background_jobs': sum(1 for job in self._jobs.values() if job['background'] is not None),
+                'streams': streams,
+                'global_streams': streams + self._remote_streams,
+                'bandwidth_limit': self.bandwidth or None,
+                'rate_per_stream': rate,
+                'fragments_per_stream': fragments,
+            }
+
+# Banda dos downloads antecipados (prefetch, 0 = sem teto) e o mínimo que eles mantêm enquanto usuários baixam
+PREFETCH_BANDWIDTH = int(os.environ.get('PREFETCH_BANDWIDTH', 2 * 1024 * 1024))
+PREFETCH_YIELD_BANDWIDTH = max(1024, int(os.environ.get('PREFETCH_YIELD_BANDWIDTH', 64 * 1024)))
+
 # Configurações
 DOWNLOAD_FOLDER = os.path.join(os.path.dirname(__file__), 'downloads')
 if not os.path.exists(DOWNLOAD_FOLDER):
     os.makedirs(DOWNLOAD_FOLDER)
 
-# Armazenar status dos downloads
-download_status = {}
+# Armazenamento do status dos downloads ('sqlite' compartilha entre workers do gunicorn)
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'sqlite').lower()
+# Fora do que serve_static publica (o banco tem IPs, chaves de API e URLs dos jobs)
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', os.path.join(os.path.dirname(__file__), 'data', 'videomax.db'))
+STATE_TTL = int(os.environ.get('STATE_TTL', 6 * 3600))
+STATE_PURGE_INTERVAL = 300
+# Validade máxima de um registro de download em andamento (protege contra workers mortos)
+FLIGHT_TTL = int(os.environ.get('FLIGHT_TTL', 3600))
+# Buckets de limite de taxa parados há mais que isso já estão cheios e são descartados
+RATE_BUCKET_IDLE = 3600
 
-def clean_old_files():
-    """Remove arquivos antigos (mais de 1 hora)"""
-    try:
-        current_time = time.time()
-        for filename in os.listdir(DOWNLOAD_FOLDER):
-            filepath = os.path.join(DOWNLOAD_FOLDER, filename)
-            if os.path.isfile(filepath):
-                file_age = current_time - os.path.getmtime(filepath)
-                if file_age > 3600:  # 1 hora
-                    os.remove(filepath)
-    except Exception as e:
-        print(f"Erro ao limpar arquivos: {e}")
+class StatusNotifier:
+    """Avisa as threads deste processo (ex.: streams SSE) que algum status mudou"""
 
-def get_video_info_cobalt(url):
-    """Obtém informações do vídeo usando a API do Cobalt"""
-    for instance in COBALT_INSTANCES:
+    def __init__(self):
+        self._cond = Condition()
+        self.version = 0
+
+    def notify(self):
+        with self._cond:
+            self.version += 1
+            self._cond.notify_all()
+
+    def wait(self, version, timeout):
+        """Espera uma mudança posterior a version (ou o timeout); retorna a versão atual"""
+        with self._cond:
+            if self.version == version:
+                self._cond.wait(timeout)
+            return self.version
+
+_process_owner = {}
+
+def process_owner():
+    """Identificador deste processo no state store (muda depois do fork do gunicorn)"""
+    pid = os.getpid()
+    if pid not in _process_owner:
+        _process_owner.clear()
+        _process_owner[pid] = f"{pid}-{uuid.uuid4().hex[:8]}"
+    return _process_owner[pid]
+
+class MemoryStateStore:
+    """Status dos downloads em memória (apenas para um único processo)"""
+
+    def __init__(self, ttl, notifier=None):
+        self.ttl = ttl
+        self.notifier = notifier
+        self._records = {}
+        self._flights = {}
+        self._buckets = {}
+        self._job_slots = {}
+        self._journal = {}
+        self._outputs = {}
+        self._output_pins = {}
+        self._egress = {}
+        self._lock = Lock()
+        self._last_purge = time.time()
+
+    def get(self, download_id):
+        with self._lock:
+            record = self._records.get(download_id)
+            if record is None or record[0] < time.time():
+                return None
+            return dict(record[1])
+
+    def set(self, download_id, status):
+        with self._lock:
+            self._records[download_id] = (time.time() + self.ttl, dict(status))
+        self._changed()
+        self._maybe_purge()
+
+    def update(self, download_id, **fields):
+        """Atualiza campos de um status existente (ignora IDs desconhecidos)"""
+        with self._lock:
+            record = self._records.get(download_id)
+            if record is None:
+                return
+            record[1].update(fields)
+            self._records[download_id] = (time.time() + self.ttl, record[1])
+        self._changed()
+
+    def delete(self, download_id):
+        with self._lock:
+            self._records.pop(download_id, None)
+
+    def claim_flight(self, job_key, download_id):
+        """Registra o download como líder do job ou retorna o líder já em andamento"""
+        now = time.time()
+        with self._lock:
+            flight = self._flights.get(job_key)
+            if flight is not None and flight[0] >= now:
+                return flight[1]
+            self._flights[job_key] = (now + FLIGHT_TTL, download_id)
+            return download_id
+
+    def release_flight(self, job_key, download_id):
+        """Libera o job se ele ainda pertencer a este download"""
+        with self._lock:
+            flight = self._flights.get(job_key)
+            if flight is not None and flight[1] == download_id:
+                del self._flights[job_key]
+
+    def take_token(self, bucket, capacity, rate, cost=1):
+        """Token bucket: retorna (permitido, segundos até haver fichas suficientes)"""
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(bucket, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[bucket] = (tokens, now)
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+    def acquire_job_slot(self, client, download_id, limit):
+        """Reserva uma vaga de job para o cliente; False se ele já está no limite"""
+        now = time.time()
+        with self._lock:
+            active = sum(1 for owner, expires_at in self._job_slots.values() if owner == client and expires_at >= now)
+            if active >= limit:
+                return False
+            self._job_slots[download_id] = (client, now + FLIGHT_TTL)
+            return True
+
+    def release_job_slot(self, download_id):
+        with self._lock:
+            self._job_slots.pop(download_id, None)
+
+    def journal_add(self, download_id, params, digest, owner):
+        """Registra o job no diário (parâmetros para retomá-lo depois de uma queda)"""
+        with self._lock:
+            self._journal[download_id] = {
+                'params': dict(params), 'digest': digest, 'owner': owner,
+                'heartbeat_at': time.time(), 'attempts': 0,
+            }
+
+    def journal_start(self, download_id):
+        """Conta mais uma tentativa de execução do job"""
+        with self._lock:
+            job = self._journal.get(download_id)
+            if job is not None:
+                job['attempts'] += 1
+                job['heartbeat_at'] = time.time()
+
+    def journal_finish(self, download_id):
+        with self._lock:
+            self._journal.pop(download_id, None)
+
+    def journal_release(self, download_id):
+        """Devolve o job para ser assumido por qualquer processo na próxima varredura"""
+        with self._lock:
+            job = self._journal.get(download_id)
+            if job is not None:
+                job['owner'] = ''
+                job['heartbeat_at'] = 0
+
+    def journal_heartbeat(self, owner):
+        """Renova todos os jobs deste processo"""
+        now = time.time()
+        with self._lock:
+            for job in self._journal.values():
+                if job['owner'] == owner:
+                    job['heartbeat_at'] = now
+
+    def journal_claim_stale(self, owner, stale_before):
+        """Assume os jobs sem heartbeat desde stale_before (o processo dono morreu)"""
+        now = time.time()
+        claimed = []
+        with self._lock:
+            for download_id, job in self._journal.items():
+                if job['heartbeat_at'] < stale_before:
+                    job['owner'] = owner
+                    job['heartbeat_at'] = now
+                    claimed.append({'download_id': download_id, 'params': dict(job['params']),
+                                    'attempts': job['attempts']})
+        return claimed
+
+    def journal_digests(self):
+        """Hashes dos jobs ainda no diário (seus arquivos temporários não são órfãos)"""
+        with self._lock:
+            return {job['digest'] for job in self._journal.values()}
+
+    def output_finish(self, digest, filename):
+        """Registra o arquivo final do job depois de todo o pós-processamento"""
+        with self._lock:
+            self._outputs[digest] = filename
+
+    def output_get(self, digest):
+        with self._lock:
+            return self._outputs.get(digest)
+
+    def output_forget(self, digest, filename):
+        """Esquece o arquivo do job (removido do disco) se ainda for o registrado"""
+        with self._lock:
+            if self._outputs.get(digest) == filename:
+                del self._outputs[digest]
+
+    def output_pin(self, digest, owner):
+        """Marca os arquivos do job como em uso pelo processo (escrita ou envio)"""
+        with self._lock:
+            self._output_pins[(digest, owner)] = time.time()
+
+    def output_unpin(self, digest, owner):
+        with self._lock:
+            self._output_pins.pop((digest, owner), None)
+
+    def output_pins_heartbeat(self, owner):
+        """Renova as marcas deste processo"""
+        now = time.time()
+        with self._lock:
+            for key in self._output_pins:
+                if key[1] == owner:
+                    self._output_pins[key] = now
+
+    def output_pinned(self, fresh_after):
+        """Hashes com arquivos em uso por algum processo vivo"""
+        with self._lock:
+            return {digest for (digest, _), updated_at in self._output_pins.items() if updated_at >= fresh_after}
+
+    def egress_sync(self, owner, streams, fresh_after):
+        """Publica os streams de download do processo; devolve os dos demais processos"""
+        with self._lock:
+            if streams:
+                self._egress[owner] = (streams, time.time())
+            else:
+                self._egress.pop(owner, None)
+            return sum(count for key, (count, updated_at) in self._egress.items()
+                       if key != owner and updated_at >= fresh_after)
+
+    def purge_expired(self):
+        """Remove registros expirados"""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (expires_at, _) in self._records.items() if expires_at < now]
+            for key in expired:
+                del self._records[key]
+            for key in [key for key, (expires_at, _) in self._flights.items() if expires_at < now]:
+                del self._flights[key]
+            for key in [key for key, (_, expires_at) in self._job_slots.items() if expires_at < now]:
+                del self._job_slots[key]
+            for key in [key for key, (_, updated_at) in self._buckets.items() if updated_at < now - RATE_BUCKET_IDLE]:
+                del self._buckets[key]
+            for key in [key for key, (_, updated_at) in self._egress.items() if updated_at < now - EGRESS_STALE_AFTER]:
+                del self._egress[key]
+            for key in [key for key, updated_at in self._output_pins.items() if updated_at < now - OUTPUT_PIN_STALE_AFTER]:
+                del self._output_pins[key]
+            self._last_purge = now
+        return len(expired)
+
+    def _maybe_purge(self):
+        if time.time() - self._last_purge > STATE_PURGE_INTERVAL:
+            self.purge_expired()
+
+    def _changed(self):
+        if self.notifier is not None:
+            self.notifier.notify()
+
+class SQLiteStateStore:
+    """Status dos downloads em SQLite (modo WAL), seguro entre processos"""
+
+    def __init__(self, path, ttl, notifier=None):
+        self.path = path
+        self.ttl = ttl
+        self.notifier = notifier
+        self._local = local()
+        self._last_purge = 0
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS downloads ('
+                'id TEXT PRIMARY KEY, data TEXT NOT NULL, '
+                'updated_at REAL NOT NULL, expires_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS downloads_expires ON downloads (expires_at)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS flights ('
+                'job_key TEXT PRIMARY KEY, download_id TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS rate_buckets ('
+                'bucket TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS job_slots ('
+                'download_id TEXT PRIMARY KEY, client TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS job_slots_client ON job_slots (client)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'download_id TEXT PRIMARY KEY, params TEXT NOT NULL, digest TEXT NOT NULL, '
+                'owner TEXT NOT NULL, heartbeat_at REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS outputs ('
+                'digest TEXT PRIMARY KEY, filename TEXT NOT NULL, completed_at REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS output_pins ('
+                'digest TEXT NOT NULL, owner TEXT NOT NULL, updated_at REAL NOT NULL, '
+                'PRIMARY KEY (digest, owner))'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS egress_streams ('
+                'owner TEXT PRIMARY KEY, streams INTEGER NOT NULL, updated_at REAL NOT NULL)'
+            )
+
+    def _connect(self):
+        # Uma conexão por thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=10000')
+            self._local.conn = conn
+        return conn
+
+    def get(self, download_id):
+        row = self._connect().execute(
+            'SELECT data FROM downloads WHERE id = ? AND expires_at >= ?',
+            (download_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, download_id, status):
+        now = time.time()
+        self._connect().execute(
+            'INSERT OR REPLACE INTO downloads (id, data, updated_at, expires_at) VALUES (?, ?, ?, ?)',
+            (download_id, json.dumps(status), now, now + self.ttl)
+        )
+        self._changed()
+        self._maybe_purge()
+
+    def update(self, download_id, **fields):
+        """Atualiza campos de um status existente (ignora IDs desconhecidos)"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM downloads WHERE id = ?', (download_id,)).fetchone()
+            if row is not None:
+                status = json.loads(row[0])
+                status.update(fields)
+                conn.execute(
+                    'UPDATE downloads SET data = ?, updated_at = ?, expires_at = ? WHERE id = ?',
+                    (json.dumps(status), now, now + self.ttl, download_id)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self._changed()
+
+    def delete(self, download_id):
+        self._connect().execute('DELETE FROM downloads WHERE id = ?', (download_id,))
+
+    def claim_flight(self, job_key, download_id):
+        """Registra o download como líder do job ou retorna o líder já em andamento"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
         try:
-            headers = {
-                'Accept': 'application/json',
-                'Content-Type': 'application/json',
+            row = conn.execute(
+                'SELECT download_id FROM flights WHERE job_key = ? AND expires_at >= ?',
+                (job_key, now)
+            ).fetchone()
+            if row is None:
+                conn.execute(
+                    'INSERT OR REPLACE INTO flights (job_key, download_id, expires_at) VALUES (?, ?, ?)',
+                    (job_key, download_id, now + FLIGHT_TTL)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return row[0] if row else download_id
+
+    def release_flight(self, job_key, download_id):
+        """Libera o job se ele ainda pertencer a este download"""
+        self._connect().execute(
+            'DELETE FROM flights WHERE job_key = ? AND download_id = ?',
+            (job_key, download_id)
+        )
+
+    def take_token(self, bucket, capacity, rate, cost=1):
+        """Token bucket: retorna (permitido, segundos até haver fichas suficientes)"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT tokens, updated_at FROM rate_buckets WHERE bucket = ?', (bucket,)
+            ).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_buckets (bucket, tokens, updated_at) VALUES (?, ?, ?)',
+                (bucket, tokens, now)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+    def acquire_job_slot(self, client, download_id, limit):
+        """Reserva uma vaga de job para o cliente; False se ele já está no limite"""
+        conn = self._connect()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            active = conn.execute(
+                'SELECT COUNT(*) FROM job_slots WHERE client = ? AND expires_at >= ?', (client, now)
+            ).fetchone()[0]
+            if active < limit:
+                conn.execute(
+                    'INSERT OR REPLACE INTO job_slots (download_id, client, expires_at) VALUES (?, ?, ?)',
+                    (download_id, client, now + FLIGHT_TTL)
+                )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return active < limit
+
+    def release_job_slot(self, download_id):
+        self._connect().execute('DELETE FROM job_slots WHERE download_id = ?', (download_id,))
+
+    def journal_add(self, download_id, params, digest, owner):
+        """Registra o job no diário (parâmetros para retomá-lo depois de uma queda)"""
+        self._connect().execute(
+            'INSERT OR REPLACE INTO jobs (download_id, params, digest, owner, heartbeat_at, attempts) '
+            'VALUES (?, ?, ?, ?, ?, 0)',
+            (download_id, json.dumps(params), digest, owner, time.time())
+        )
+
+    def journal_start(self, download_id):
+        """Conta mais uma tentativa de execução do job"""
+        self._connect().execute(
+            'UPDATE jobs SET attempts = attempts + 1, heartbeat_at = ? WHERE download_id = ?',
+            (time.time(), download_id)
+        )
+
+    def journal_finish(self, download_id):
+        self._connect().execute('DELETE FROM jobs WHERE download_id = ?', (download_id,))
+
+    def journal_release(self, download_id):
+        """Devolve o job para ser assumido por qualquer processo na próxima varredura"""
+        self._connect().execute("UPDATE jobs SET owner = '', heartbeat_at = 0 WHERE download_id = ?", (download_id,))
+
+    def journal_heartbeat(self, owner):
+        """Renova todos os jobs deste processo"""
+        self._connect().execute('UPDATE jobs SET heartbeat_at = ? WHERE owner = ?', (time.time(), owner))
+
+    def journal_claim_stale(self, owner, stale_before):
+        """Assume os jobs sem heartbeat desde stale_before (o processo dono morreu)"""
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT download_id, params, attempts FROM jobs WHERE heartbeat_at < ?', (stale_before,)
+            ).fetchall()
+            conn.executemany(
+                'UPDATE jobs SET owner = ?, heartbeat_at = ? WHERE download_id = ?',
+                [(owner, time.time(), row[0]) for row in rows]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return [{'download_id': row[0], 'params': json.loads(row[1]), 'attempts': row[2]} for row in rows]
+
+    def journal_digests(self):
+        """Hashes dos jobs ainda no diário (seus arquivos temporários não são órfãos)"""
+        return {row[0] for row in self._connect().execute('SELECT DISTINCT digest FROM jobs')}
+
+    def output_finish(self, digest, filename):
+        """Registra o arquivo final do job depois de todo o pós-processamento"""
+        self._connect().execute(
+            'INSERT OR REPLACE INTO outputs (digest, filename, completed_at) VALUES (?, ?, ?)',
+            (digest, filename, time.time())
+        )
+
+    def output_get(self, digest):
+        row = self._connect().execute('SELECT filename FROM outputs WHERE digest = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def output_forget(self, digest, filename):
+        """Esquece o arquivo do job (removido do disco) se ainda for o registrado"""
+        self._connect().execute('DELETE FROM outputs WHERE digest = ? AND filename = ?', (digest, filename))
+
+    def output_pin(self, digest, owner):
+        """Marca os arquivos do job como em uso pelo processo (escrita ou envio)"""
+        self._connect().execute(
+            'INSERT OR REPLACE INTO output_pins (digest, owner, updated_at) VALUES (?, ?, ?)',
+            (digest, owner, time.time())
+        )
+
+    def output_unpin(self, digest, owner):
+        self._connect().execute('DELETE FROM output_pins WHERE digest = ? AND owner = ?', (digest, owner))
+
+    def output_pins_heartbeat(self, owner):
+        """Renova as marcas deste processo"""
+        self._connect().execute('UPDATE output_pins SET updated_at = ? WHERE owner = ?', (time.time(), owner))
+
+    def output_pinned(self, fresh_after):
+        """Hashes com arquivos em uso por algum processo vivo"""
+        rows = self._connect().execute('SELECT DISTINCT digest FROM output_pins WHERE updated_at >= ?', (fresh_after,))
+        return {row[0] for row in rows}
+
+    def egress_sync(self, owner, streams, fresh_after):
+        """Publica os streams de download do processo; devolve os dos demais processos"""
+        conn = self._connect()
+        if streams:
+            conn.execute(
+                'INSERT OR REPLACE INTO egress_streams (owner, streams, updated_at) VALUES (?, ?, ?)',
+                (owner, streams, time.time())
+            )
+        else:
+            conn.execute('DELETE FROM egress_streams WHERE owner = ?', (owner,))
+        row = conn.execute(
+            'SELECT COALESCE(SUM(streams), 0) FROM egress_streams WHERE owner != ? AND updated_at >= ?',
+            (owner, fresh_after)
+        ).fetchone()
+        return row[0]
+
+    def purge_expired(self):
+        """Remove registros expirados"""
+        self._last_purge = time.time()
+        conn = self._connect()
+        cursor = conn.execute('DELETE FROM downloads WHERE expires_at < ?', (time.time(),))
+        conn.execute('DELETE FROM flights WHERE expires_at < ?', (time.time(),))
+        conn.execute('DELETE FROM job_slots WHERE expires_at < ?', (time.time(),))
+        conn.execute('DELETE FROM rate_buckets WHERE updated_at < ?', (time.time() - RATE_BUCKET_IDLE,))
+        conn.execute('DELETE FROM egress_streams WHERE updated_at < ?', (time.time() - EGRESS_STALE_AFTER,))
+        conn.execute('DELETE FROM output_pins WHERE updated_at < ?', (time.time() - OUTPUT_PIN_STALE_AFTER,))
+        return cursor.rowcount
+
+    def _maybe_purge(self):
+        if time.time() - self._last_purge > STATE_PURGE_INTERVAL:
+            self.purge_expired()
+
+    def _changed(self):
+        if self.notifier is not None:
+            self.notifier.notify()
+
+def create_state_store():
+    """Cria o backend de status configurado em STATE_BACKEND"""
+    if STATE_BACKEND == 'memory':
+        return MemoryStateStore(STATE_TTL, status_notifier)
+    os.makedirs(os.path.dirname(os.path.abspath(STATE_DB_PATH)), exist_ok=True)
+    return SQLiteStateStore(STATE_DB_PATH, STATE_TTL, status_notifier)
+
+status_notifier = StatusNotifier()
+state_store = create_state_store()
+
+bandwidth_budget = BandwidthBudget(
+    EGRESS_BANDWIDTH_LIMIT,
+    MAX_FRAGMENT_CONNECTIONS,
+    MAX_FRAGMENTS_PER_JOB,
+    PREFETCH_YIELD_BANDWIDTH,
+    state_store
+)
+bandwidth_budget.start_sync(EGRESS_SYNC_INTERVAL)
+
+# Último percentual gravado por download (evita escritas repetidas)
+last_progress = {}
+# Bytes baixados/total de cada arquivo do job (vídeo e áudio vêm em paralelo)
+progress_parts = {}
+# Jobs cujo arquivo temporário é a própria saída final (sem merge nem conversão)
+growing_downloads = set()
+
+# Limite de taxa por cliente (token bucket no armazenamento compartilhado entre workers)
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+# Requisições por minuto e rajada máxima de cada grupo de endpoints
+RATE_LIMITS = {
+    'info': (int(os.environ.get('RATE_LIMIT_INFO_PER_MINUTE', 30)), int(os.environ.get('RATE_LIMIT_INFO_BURST', 10))),
+    'download': (int(os.environ.get('RATE_LIMIT_DOWNLOAD_PER_MINUTE', 10)), int(os.environ.get('RATE_LIMIT_DOWNLOAD_BURST', 5))),
+    'cobalt': (int(os.environ.get('RATE_LIMIT_COBALT_PER_MINUTE', 10)), int(os.environ.get('RATE_LIMIT_COBALT_BURST', 5))),
+}
+# Jobs de um mesmo cliente na fila ou baixando ao mesmo tempo (0 = sem limite)
+MAX_JOBS_PER_CLIENT = int(os.environ.get('MAX_JOBS_PER_CLIENT', 3))
+# Chaves de API aceitas no cabeçalho X-API-Key (cada uma tem seus próprios limites)
+API_KEYS = {key.strip() for key in os.environ.get('API_KEYS', '').split(',') if key.strip()}
+
+class ClientQuotaError(Exception):
+    """O cliente já tem MAX_JOBS_PER_CLIENT jobs em andamento"""
+
+def client_id():
+    """Identifica o cliente: chave de API válida ou IP"""
+    api_key = request.headers.get('X-API-Key', '')
+    if api_key in API_KEYS:
+        return 'key:' + hashlib.sha1(api_key.encode('utf-8')).hexdigest()[:16]
+    return 'ip:' + (request.remote_addr or 'desconhecido')
+
+def rate_limited(group):
+    """Aplica o token bucket do grupo ao cliente; responde 429 com Retry-After quando vazio"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            per_minute, burst = RATE_LIMITS[group]
+            if RATE_LIMIT_ENABLED and per_minute > 0:
+                allowed, retry_after = state_store.take_token(f"{group}:{client_id()}", burst, per_minute / 60.0)
+                if not allowed:
+                    RATE_LIMITED_REQUESTS.inc(reason=group)
+                    response = jsonify({'error': 'Muitas requisições. Aguarde um pouco e tente novamente.'})
+                    response.headers['Retry-After'] = str(int(retry_after) + 1)
+                    return response, 429
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# Cache de metadados do yt-dlp (segundos de vida e número máximo de vídeos)
+INFO_CACHE_TTL = int(os.environ.get('INFO_CACHE_TTL', 1800))
+INFO_CACHE_MAX_ENTRIES = int(os.environ.get('INFO_CACHE_MAX_ENTRIES', 256))
+
+class MetadataCache:
+    """Cache LRU com expiração (TTL) para os dicionários de informação do yt-dlp"""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Retorna o valor em cache ou None se ausente/expirado"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def ttl_left(self, key):
+        """Segundos até a entrada expirar (None se ausente), sem contar como acesso"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return max(0.0, entry[0] - time.time())
+
+    def set(self, key, value):
+        """Armazena um valor, removendo os menos usados se passar do limite"""
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Contadores de uso do cache"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / total, 3) if total else 0.0,
             }
-            payload = {
-                'url': url,
-                'videoQuality': '1080',
-                'audioFormat': 'mp3',
-                'youtubeVideoCodec': 'h264',
+
+info_cache = MetadataCache(INFO_CACHE_TTL, INFO_CACHE_MAX_ENTRIES)
+
+# Fila de downloads (limite de jobs simultâneos e tamanho máximo da fila)
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 2))
+MAX_QUEUED_DOWNLOADS = int(os.environ.get('MAX_QUEUED_DOWNLOADS', 20))
+QUEUE_RETRY_AFTER = int(os.environ.get('QUEUE_RETRY_AFTER', 30))
+
+def busy_response(retry_after=QUEUE_RETRY_AFTER):
+    """Servidor sem capacidade (fila, resolução, stream ou resposta longa): 503 com Retry-After
+
+    Limites por cliente (taxa e jobs simultâneos) continuam respondendo 429.
+    """
+    response = jsonify({'error': 'Servidor ocupado. Tente novamente em instantes.'})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503
+
+# Prioridades da fila (menor valor sai primeiro)
+PRIORITY_AUDIO = 0
+PRIORITY_VIDEO = 1
+PRIORITY_CONVERT = 2
+
+class QueueFullError(Exception):
+    """A fila de downloads atingiu o limite configurado"""
+
+class DownloadScheduler:
+    """Pool limitado de workers com fila de prioridade
+
+    Dentro da mesma prioridade os clientes se revezam: o n-ésimo job em
+    andamento de um cliente fica atrás do primeiro job de cada outro cliente.
+    """
+
+    def __init__(self, max_workers, max_queued, on_queue_change=None):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.on_queue_change = on_queue_change
+        self._heap = []
+        self._seq = itertools.count()
+        self._owners = {}
+        self._cond = Condition()
+        self._workers = []
+        self.active = 0
+
+    def submit(self, job_id, priority, func, *args, owner=None):
+        """Enfileira um job e retorna sua posição na fila (1 = próximo)"""
+        with self._cond:
+            if len(self._heap) >= self.max_queued:
+                raise QueueFullError()
+            share = self._owners.get(owner, 0)
+            self._owners[owner] = share + 1
+            heapq.heappush(self._heap, (priority, share, next(self._seq), job_id, owner, func, args))
+            self._ensure_workers()
+            self._cond.notify()
+            position = self._position(job_id)
+        self._publish_positions()
+        return position
+
+    def position(self, job_id):
+        """Posição do job na fila ou None se já saiu dela"""
+        with self._cond:
+            return self._position(job_id)
+
+    def _position(self, job_id):
+        for index, entry in enumerate(sorted(self._heap)):
+            if entry[3] == job_id:
+                return index + 1
+        return None
+
+    def _publish_positions(self):
+        # Repassa as posições para o armazenamento compartilhado (outros workers)
+        if self.on_queue_change is None:
+            return
+        with self._cond:
+            order = [entry[3] for entry in sorted(self._heap)]
+        try:
+            self.on_queue_change(order)
+        except Exception as e:
+            print(f"Erro ao publicar posições da fila: {e}")
+
+    def stats(self):
+        """Estado atual da fila"""
+        with self._cond:
+            return {
+                'queued': len(self._heap),
+                'active': self.active,
+                'max_workers': self.max_workers,
+                'max_queued': self.max_queued,
             }
-            
-            api_url = f"{instance}/"
-            print(f"Tentando Cobalt: {instance}")
-            response = requests.post(api_url, json=payload, headers=headers, timeout=30)
-            print(f"Cobalt response status: {response.status_code}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                print(f"Cobalt response: {data}")
-                if data.get('status') in ['tunnel', 'redirect', 'stream']:
-                    return data
-            elif response.status_code == 401:
-                print(f"Cobalt {instance} requer autenticação, tentando próximo...")
+
+    def _ensure_workers(self):
+        # Threads criadas sob demanda (depois do fork dos workers do gunicorn)
+        while len(self._workers) < self.max_workers:
+            worker = Thread(target=self._worker_loop, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                _, _, _, job_id, owner, func, args = heapq.heappop(self._heap)
+                self.active += 1
+            self._publish_positions()
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"Erro no job {job_id}: {e}")
+            finally:
+                with self._cond:
+                    self.active -= 1
+                    if self._owners.get(owner, 0) > 1:
+                        self._owners[owner] -= 1
+                    else:
+                        self._owners.pop(owner, None)
+
+def publish_queue_positions(order):
+    """Grava a posição de cada job enfileirado no status compartilhado"""
+    for index, job_id in enumerate(order):
+        state_store.update(job_id, queue_position=index + 1)
+
+download_scheduler = DownloadScheduler(
+    MAX_CONCURRENT_DOWNLOADS, MAX_QUEUED_DOWNLOADS, on_queue_change=publish_queue_positions
+)
+
+def download_priority(download_type, output_format):
+    """Áudio é barato e passa na frente; conversões de vídeo vão por último"""
+    if download_type == 'audio':
+        return PRIORITY_AUDIO
+    if output_format != 'mp4':
+        return PRIORITY_CONVERT
+    return PRIORITY_VIDEO
+
+def download_job_key(url, format_id, download_type, output_format, codec):
+    """Chave que identifica downloads idênticos (mesmo vídeo e mesmo formato pedido)"""
+    if download_type == 'audio':
+        # O MP3 sempre sai do melhor áudio; o original (M4A/WebM) depende do stream escolhido
+        if output_format in AUDIO_PASSTHROUGH:
+            return f"{info_cache_key(url)}|audio|{format_id}|{output_format}"
+        return f"{info_cache_key(url)}|audio|bestaudio|mp3"
+    return f"{info_cache_key(url)}|video|{format_id}|{output_format}|{codec}"
+
+# Cache de arquivos prontos em DOWNLOAD_FOLDER (orçamento total em bytes)
+OUTPUT_CACHE_MAX_BYTES = int(os.environ.get('OUTPUT_CACHE_MAX_BYTES', 5 * 1024 * 1024 * 1024))
+# Arquivos acessados/escritos há menos que isso (segundos) nunca são removidos
+OUTPUT_CACHE_MIN_AGE = int(os.environ.get('OUTPUT_CACHE_MIN_AGE', 600))
+OUTPUT_CACHE_SWEEP_INTERVAL = int(os.environ.get('OUTPUT_CACHE_SWEEP_INTERVAL', 60))
+# Marcas de arquivo em uso que o processo dono não renova (o janitor renova a cada varredura) deixam de valer
+OUTPUT_PIN_STALE_AFTER = 3 * OUTPUT_CACHE_SWEEP_INTERVAL
+
+class OutputCache:
+    """Arquivos finalizados endereçados pelo job: "<título> [<hash>].<ext>"
+
+    O hash vem da chave do job (vídeo, formato, codec e container), então um
+    pedido repetido encontra o arquivo já pronto. Só vale o arquivo que o
+    job registrou no state store ao terminar: durante o remux/conversão a
+    pasta tem a origem e a saída pela metade com o mesmo hash. A ordem de
+    remoção usa o mtime, que é atualizado a cada acesso (LRU). Arquivos em
+    escrita ou envio ficam marcados no state store, então o janitor de
+    qualquer worker os respeita.
+    """
+
+    def __init__(self, folder, max_bytes, min_age, registry):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        self.registry = registry
+        self._pins = {}
+        self._lock = Lock()
+        self._janitor = None
+        # Total da última varredura (o janitor atualiza a cada OUTPUT_CACHE_SWEEP_INTERVAL)
+        self._usage = None
+        self.hits = 0
+        self.evictions = 0
+
+    @staticmethod
+    def digest(job_key):
+        """Hash curto usado no nome dos arquivos de um job"""
+        return hashlib.sha1(job_key.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def output_template(title, digest, infix=''):
+        """Template de saída do yt-dlp para o job (infix 'src.' = arquivo intermediário)"""
+        return f"{title.replace('%', '%%')} [{digest}].{infix}%(ext)s"
+
+    @staticmethod
+    def filename_for(title, digest, ext):
+        """Nome final do arquivo do job para uma extensão conhecida"""
+        return f"{title} [{digest}].{ext}"
+
+    @staticmethod
+    def digest_of(filename):
+        """Hash do job contido no nome do arquivo (ou None)"""
+        match = re.search(r'\[([0-9a-f]{16})\]', filename)
+        return match.group(1) if match else None
+
+    @staticmethod
+    def display_name(filename):
+        """Nome entregue ao usuário (sem o hash)"""
+        match = re.match(r'^(.*) \[[0-9a-f]{16}\](\.[A-Za-z0-9]+)$', filename)
+        return match.group(1) + match.group(2) if match else filename
+
+    def lookup(self, digest):
+        """Retorna o nome do arquivo finalizado do job ou None"""
+        filename = self.registry.output_get(digest)
+        if filename is None:
+            return None
+        if not os.path.isfile(os.path.join(self.folder, filename)):
+            self.registry.output_forget(digest, filename)
+            return None
+        self.hits += 1
+        return filename
+
+    def finish(self, digest, filename):
+        """Marca o arquivo como saída completa do job (a partir daqui lookup o encontra)"""
+        self.registry.output_finish(digest, filename)
+
+    def discard_unfinished(self, digest, ext):
+        """Remove uma saída "[hash].<ext>" que o job não chegou a registrar
+
+        É o que sobra de um worker morto no meio do remux/conversão; sem ela,
+        o job retomado só pode terminar refazendo o pós-processamento.
+        """
+        pattern = re.compile(r'\[' + digest + r'\]\.' + re.escape(ext) + '$')
+        registered = self.registry.output_get(digest)
+        try:
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    if pattern.search(entry.name) and entry.name != registered and entry.is_file():
+                        os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    def touch(self, filename):
+        """Marca o arquivo como usado agora"""
+        try:
+            os.utime(os.path.join(self.folder, filename), None)
+        except OSError:
+            pass
+
+    def pin(self, digest):
+        """Protege os arquivos do job contra remoção (escrita ou envio em andamento)"""
+        with self._lock:
+            self._pins[digest] = self._pins.get(digest, 0) + 1
+            if self._pins[digest] == 1:
+                self.registry.output_pin(digest, process_owner())
+
+    def unpin(self, digest):
+        with self._lock:
+            count = self._pins.get(digest, 0) - 1
+            if count > 0:
+                self._pins[digest] = count
+            else:
+                self._pins.pop(digest, None)
+                self.registry.output_unpin(digest, process_owner())
+
+    @contextmanager
+    def pinned(self, digest):
+        self.pin(digest)
+        try:
+            yield
+        finally:
+            self.unpin(digest)
+
+    def _pinned_digests(self):
+        """Hashes protegidos por este ou por outro processo"""
+        with self._lock:
+            local_pins = set(self._pins)
+        return local_pins | self.registry.output_pinned(time.time() - OUTPUT_PIN_STALE_AFTER)
+
+    def usage(self):
+        """Total de bytes ocupados na pasta de downloads, da última varredura"""
+        if self._usage is None:
+            total = 0
+            with os.scandir(self.folder) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        total += entry.stat().st_size
+            self._usage = total
+        return self._usage
+
+    def enforce_budget(self):
+        """Remove os arquivos usados há mais tempo até caber no orçamento"""
+        files = []
+        total = 0
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.name))
+                    total += stat.st_size
+        if total <= self.max_bytes:
+            self._usage = total
+            return 0
+        removed = 0
+        now = time.time()
+        pinned = self._pinned_digests()
+        for mtime, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            # Nunca remover arquivos recentes (em escrita/envio) nem protegidos
+            if now - mtime < self.min_age or self.digest_of(name) in pinned:
                 continue
+            try:
+                os.remove(os.path.join(self.folder, name))
+                total -= size
+                removed += 1
+                if self.digest_of(name):
+                    self.registry.output_forget(self.digest_of(name), name)
+            except FileNotFoundError:
+                total -= size
+            except OSError as e:
+                print(f"Erro ao remover {name}: {e}")
+        self._usage = total
+        self.evictions += removed
+        return removed
+
+    def remove_orphans(self, active_digests, min_age):
+        """Remove arquivos de jobs que não estão mais ativos e não são saída registrada
+
+        Pega .part, .ytdl, .f137.mp4 e também a origem ou a saída pela metade
+        de um remux interrompido. Saídas completas ficam para o orçamento de
+        disco.
+        """
+        cutoff = time.time() - min_age
+        removed = 0
+        pinned = self._pinned_digests()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                digest = self.digest_of(entry.name)
+                if not digest or digest in active_digests or not entry.is_file():
+                    continue
+                if self.registry.output_get(digest) == entry.name:
+                    continue
+                if entry.stat().st_mtime > cutoff or digest in pinned:
+                    continue
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError as e:
+                    print(f"Erro ao remover {entry.name}: {e}")
+        return removed
+
+    def stats(self):
+        return {
+            'bytes': self.usage(),
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'evictions': self.evictions,
+        }
+
+    def start_janitor(self, interval):
+        """Inicia a thread que aplica o orçamento de disco periodicamente"""
+        if self._janitor is not None:
+            return
+        def loop():
+            while True:
+                try:
+                    self.registry.output_pins_heartbeat(process_owner())
+                    self.enforce_budget()
+                except Exception as e:
+                    print(f"Erro ao limpar arquivos: {e}")
+                time.sleep(interval)
+        self._janitor = Thread(target=loop, daemon=True)
+        self._janitor.start()
+
+output_cache = OutputCache(DOWNLOAD_FOLDER, OUTPUT_CACHE_MAX_BYTES, OUTPUT_CACHE_MIN_AGE, state_store)
+output_cache.start_janitor(OUTPUT_CACHE_SWEEP_INTERVAL)
+
+def fetch_cobalt_instance(instance, url, download_mode=None):
+    """Consulta uma instância do Cobalt; retorna os dados ou None"""
+    headers = {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+    }
+    payload = {
+        'url': url,
+        'videoQuality': '1080',
+        'audioFormat': 'mp3',
+        'youtubeVideoCodec': 'h264',
+    }
+    if download_mode:
+        payload['downloadMode'] = download_mode
+    
+    api_url = f"{instance}/"
+    print(f"Tentando Cobalt: {instance}")
+    response = http_client.post(api_url, json=payload, headers=headers, timeout=30)
+    print(f"Cobalt response status: {response.status_code}")
+    
+    if response.status_code == 200:
+        data = response.json()
+        print(f"Cobalt response: {data}")
+        if data.get('status') in ['tunnel', 'redirect', 'stream']:
+            return data
+    elif response.status_code == 401:
+        print(f"Cobalt {instance} requer autenticação, tentando próximo...")
+    return None
+
+def get_video_info_cobalt(url, download_mode=None):
+    """Obtém informações do vídeo usando a API do Cobalt"""
+    for instance in instance_health.ranked(COBALT_INSTANCES):
+        try:
+            data = tracked_call(instance, fetch_cobalt_instance, instance, url, download_mode)
+            if data:
+                return data
         except Exception as e:
             print(f"Erro Cobalt {instance}: {e}")
             continue
@@ -128,23 +1795,30 @@ def extract_video_id(url):
             return match.group(1)
     return None
 
+def fetch_piped_instance(instance, video_id):
+    """Consulta uma instância do Piped; retorna os dados ou None"""
+    api_url = f"{instance}/streams/{video_id}"
+    print(f"Tentando Piped: {instance}")
+    response = http_client.get(api_url, timeout=15)
+    print(f"Piped response status: {response.status_code}")
+    
+    if response.status_code == 200:
+        data = response.json()
+        if data.get('title'):
+            return data
+    return None
+
 def get_video_info_piped(url):
     """Obtém informações do vídeo usando a API do Piped"""
     video_id = extract_video_id(url)
     if not video_id:
         return None
     
-    for instance in PIPED_INSTANCES:
+    for instance in instance_health.ranked(PIPED_INSTANCES):
         try:
-            api_url = f"{instance}/streams/{video_id}"
-            print(f"Tentando Piped: {instance}")
-            response = requests.get(api_url, timeout=15)
-            print(f"Piped response status: {response.status_code}")
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('title'):
-                    return data
+            data = tracked_call(instance, fetch_piped_instance, instance, video_id)
+            if data:
+                return data
         except Exception as e:
             print(f"Erro Piped {instance}: {e}")
             continue
@@ -174,197 +1848,508 @@ def get_video_info_ytdlp(url):
     if os.path.exists(COOKIES_FILE) and os.path.getsize(COOKIES_FILE) > 100:
         ydl_opts['cookiefile'] = COOKIES_FILE
     
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    with ydl_pool.checkout('info', ydl_opts) as ydl:
         return ydl.extract_info(url, download=False)
 
-@app.route('/api/video-info', methods=['POST'])
+# Campos que a seleção de formato da extração copia para o info
+FORMAT_SELECTION_KEYS = ('requested_formats', 'requested_downloads', 'requested_subtitles', 'format', 'format_id',
+                         'url', 'ext', 'protocol', 'resolution', 'fragments', 'fragment_base_url', 'manifest_url',
+                         'downloader_options', 'http_headers', 'filesize_approx', 'stretched_ratio')
+
+def unselected_info(info):
+    """Remove do info o formato escolhido por extract_info
+
+    O yt-dlp copia o formato selecionado (ou o par vídeo+áudio, em
+    'requested_formats') para o próprio info. Processado de novo com outro
+    seletor, o que sobra desses campos vence: um job de áudio baixaria e
+    juntaria o par de vídeo inteiro.
+    """
+    if info.get('_type', 'video') != 'video':
+        return info
+    selected = info.get('requested_formats') or [
+        fmt for fmt in info.get('formats') or [] if fmt.get('format_id') == info.get('format_id')
+    ]
+    keys = set(FORMAT_SELECTION_KEYS)
+    for fmt in selected:
+        keys.update(fmt)
+    return {key: value for key, value in info.items() if key not in keys or key == 'formats'}
+
+def info_cache_key(url):
+    """Chave canônica do cache: ID do vídeo do YouTube ou a própria URL"""
+    return extract_video_id(url) or url.strip()
+
+# Extrações em andamento por chave (pedidos simultâneos do mesmo vídeo esperam a mesma)
+info_inflight = {}
+info_inflight_lock = Lock()
+
+def get_video_info_cached(url, refresh=False):
+    """Obtém informações do vídeo via yt-dlp reaproveitando o cache de metadados
+
+    Com refresh=True extrai de novo mesmo se houver entrada válida (renovação
+    antecipada), ainda juntando-se a uma extração já em andamento.
+    """
+    key = info_cache_key(url)
+    info = None if refresh else info_cache.get(key)
+    if info is not None:
+        return info
+    
+    with info_inflight_lock:
+        future = info_inflight.get(key)
+        leader = future is None
+        if leader:
+            future = info_inflight[key] = Future()
+    if not leader:
+        return future.result()
+    
+    try:
+        with EXTRACT_INFO_SECONDS.time(outcome='error') as labels:
+            info = unselected_info(get_video_info_ytdlp(url))
+            labels['outcome'] = 'success'
+        info_cache.set(key, info)
+        future.set_result(info)
+        return info
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with info_inflight_lock:
+            info_inflight.pop(key, None)
+
+# Resolução concorrente (yt-dlp, Piped e Cobalt disputam; vale a primeira resposta válida)
+RESOLVE_DEADLINE = float(os.environ.get('RESOLVE_DEADLINE', 45))
+# Vantagem dada ao yt-dlp (resultado mais completo) antes de disparar os fallbacks
+RESOLVE_YTDLP_HEAD_START = float(os.environ.get('RESOLVE_YTDLP_HEAD_START', 8))
+# Intervalo entre disparos de instâncias de fallback (hedged requests)
+RESOLVE_HEDGE_DELAY = float(os.environ.get('RESOLVE_HEDGE_DELAY', 1.5))
+RESOLVER_MAX_WORKERS = int(os.environ.get('RESOLVER_MAX_WORKERS', 16))
+# Resoluções aguardando ao mesmo tempo; acima disso /api/video-info responde 503 na hora
+MAX_PENDING_RESOLUTIONS = int(os.environ.get('MAX_PENDING_RESOLUTIONS', 64))
+
+resolver_executor = ThreadPoolExecutor(max_workers=RESOLVER_MAX_WORKERS, thread_name_prefix='resolver')
+resolution_slots = BoundedSemaphore(MAX_PENDING_RESOLUTIONS)
+
+def resolution_attempts(url):
+    """Lista (momento de disparo, origem, nome, função) de todas as tentativas"""
+    attempts = [(0.0, 'ytdlp', 'yt-dlp', lambda: get_video_info_cached(url))]
+    launch_at = RESOLVE_YTDLP_HEAD_START
+    video_id = extract_video_id(url)
+    if video_id:
+        for instance in instance_health.ranked(PIPED_INSTANCES):
+            attempts.append((launch_at, 'piped', instance,
+                             lambda instance=instance: tracked_call(instance, fetch_piped_instance, instance, video_id)))
+            launch_at += RESOLVE_HEDGE_DELAY
+    for instance in instance_health.ranked(COBALT_INSTANCES):
+        attempts.append((launch_at, 'cobalt', instance,
+                         lambda instance=instance: tracked_call(instance, fetch_cobalt_instance, instance, url)))
+        launch_at += RESOLVE_HEDGE_DELAY
+    return attempts
+
+def timed_attempt(source, func):
+    """Executa uma tentativa de resolução registrando latência e resultado"""
+    with RESOLVE_SECONDS.time(backend=source, outcome='error') as labels:
+        result = func()
+        labels['outcome'] = 'success' if result else 'empty'
+    return result
+
+def resolve_video_info(url, deadline=None):
+    """Dispara as tentativas escalonadas e retorna (origem, dados) da primeira válida
+
+    Uma tentativa que falha antecipa o disparo da próxima. As perdedoras ainda
+    não iniciadas são canceladas e as que já estão em andamento são ignoradas.
+    Retorna (None, None) se nada der certo antes do prazo.
+    """
+    started = time.monotonic()
+    deadline_at = started + (RESOLVE_DEADLINE if deadline is None else deadline)
+    pending = resolution_attempts(url)
+    running = {}
+    failures = 0
+    try:
+        while pending or running:
+            now = time.monotonic()
+            if now >= deadline_at:
+                print(f"Prazo de resolução esgotado para {url}")
+                break
+            # Disparar tentativas cujo horário chegou (ou a próxima, se nada está rodando)
+            while pending and (pending[0][0] <= now - started or not running or failures):
+                _, source, name, func = pending.pop(0)
+                running[resolver_executor.submit(timed_attempt, source, func)] = (source, name)
+                failures = max(0, failures - 1)
+            timeout = deadline_at - now
+            if pending:
+                timeout = min(timeout, max(0.0, started + pending[0][0] - now))
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                source, name = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Erro {name}: {e}")
+                    result = None
+                if result:
+                    print(f"Resolvido via {name} em {time.monotonic() - started:.2f}s")
+                    return source, result
+                failures += 1
+        return None, None
+    finally:
+        for future in running:
+            future.cancel()
+
+# Seleção de formatos: streams adaptativos (só vídeo) + melhor áudio compatível
+# Ordem de preferência do codec de vídeo para a mesma altura (H.264 remuxa em MP4/MOV/MKV)
+VIDEO_CODEC_PREFERENCE = {'h264': 3, 'vp9': 2, 'av1': 1}
+# Áudio que acompanha cada extensão de vídeo sem precisar recodificar no merge
+AUDIO_EXT_FOR_VIDEO = {'mp4': 'm4a', 'webm': 'webm'}
+
+def format_filesize(fmt):
+    """Tamanho conhecido ou estimado do formato (0 se desconhecido)"""
+    return fmt.get('filesize') or fmt.get('filesize_approx') or 0
+
+def best_audio_for(video, audio_formats):
+    """Melhor áudio para acompanhar o vídeo, preferindo o mesmo container"""
+    if not audio_formats:
+        return None
+    wanted = AUDIO_EXT_FOR_VIDEO.get(video.get('ext'))
+    matching = [fmt for fmt in audio_formats if fmt.get('ext') == wanted] or audio_formats
+    return max(matching, key=lambda fmt: (fmt.get('abr') or fmt.get('tbr') or 0))
+
+def select_video_qualities(info):
+    """Uma opção por altura: vídeo adaptativo + áudio, ou formato muxado quando não houver"""
+    formats = [fmt for fmt in info.get('formats', []) if fmt.get('format_id')]
+    audio_formats = [
+        fmt for fmt in formats
+        if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')
+    ]
+    
+    def rank(fmt):
+        return (
+            VIDEO_CODEC_PREFERENCE.get(codec_family(fmt.get('vcodec')), 0),
+            fmt.get('protocol', 'https') in ('https', 'http'),
+            fmt.get('fps') or 0,
+            fmt.get('tbr') or 0,
+        )
+    
+    adaptive = {}
+    muxed = {}
+    for fmt in formats:
+        height = fmt.get('height')
+        if not height or fmt.get('vcodec') in (None, 'none'):
+            continue
+        target = muxed if fmt.get('acodec') not in (None, 'none') else adaptive
+        if height not in target or rank(fmt) > rank(target[height]):
+            target[height] = fmt
+    
+    qualities = {}
+    for height, video in adaptive.items():
+        audio = best_audio_for(video, audio_formats)
+        if audio is None:
+            continue
+        qualities[height] = {
+            'format_id': f"{video['format_id']}+{audio['format_id']}",
+            'resolution': f"{video.get('width', 0)}x{height}",
+            'size': format_filesize(video) + format_filesize(audio),
+            'fps': video.get('fps') or 30,
+        }
+    for height, fmt in muxed.items():
+        qualities.setdefault(height, {
+            'format_id': fmt['format_id'],
+            'resolution': f"{fmt.get('width', 0)}x{height}",
+            'size': format_filesize(fmt),
+            'fps': fmt.get('fps') or 30,
+        })
+    return qualities
+
+# Containers oferecidos para cada qualidade de vídeo (uma vez por resposta, não por qualidade)
+OUTPUT_FORMATS = [
+    {'format': 'MP4', 'codec': 'h264', 'name': 'MP4 (H.264)'},
+    {'format': 'AVI', 'codec': 'xvid', 'name': 'AVI (Xvid)'},
+    {'format': 'MKV', 'codec': 'h264', 'name': 'MKV (H.264)'},
+    {'format': 'MOV', 'codec': 'h264', 'name': 'MOV (H.264)'},
+    {'format': 'WMV', 'codec': 'wmv2', 'name': 'WMV'},
+    {'format': 'FLV', 'codec': 'flv', 'name': 'FLV'},
+]
+OUTPUT_CONTAINERS = [fmt['format'] for fmt in OUTPUT_FORMATS]
+MAX_AUDIO_OPTIONS = 4
+
+def format_duration(seconds):
+    """Duração em m:ss"""
+    seconds = int(seconds or 0)
+    return f"{seconds // 60}:{str(seconds % 60).zfill(2)}"
+
+def build_video_info_payload(info):
+    """Resposta compacta do /api/video-info: uma entrada por qualidade com seus containers"""
+    video_formats = []
+    qualities = select_video_qualities(info)
+    for height in sorted(qualities, reverse=True):
+        fmt = qualities[height]
+        video_formats.append({
+            'format_id': fmt['format_id'],
+            'quality': f"{height}p",
+            'resolution': fmt['resolution'],
+            'size': format_size(fmt['size']) if fmt['size'] else 'N/A',
+            'fps': fmt['fps'],
+            'containers': OUTPUT_CONTAINERS,
+        })
+    
+    # MP3 com o bitrate limitado ao da melhor origem, depois os originais sem recodificar
+    audio_formats = []
+    formats = info.get('formats', [])
+    source = best_audio(formats)
+    if source:
+        bitrate = mp3_bitrate(audio_bitrate(source))
+        duration = info.get('duration') or 0
+        audio_formats.append({
+            'format_id': source['format_id'],
+            'quality': f"{bitrate}kbps",
+            'size': format_size(bitrate * 125 * duration) if duration else 'N/A',
+            'format': 'MP3'
+        })
+    for ext, passthrough in AUDIO_PASSTHROUGH.items():
+        fmt = best_audio(formats, ext)
+        if fmt:
+            audio_formats.append({
+                'format_id': fmt['format_id'],
+                'quality': f"{int(audio_bitrate(fmt))}kbps",
+                'size': format_size(format_filesize(fmt)),
+                'format': ext.upper(),
+                'format_name': passthrough['name'],
+            })
+    audio_formats = audio_formats[:MAX_AUDIO_OPTIONS]
+    
+    return {
+        'success': True,
+        'id': info.get('id', ''),
+        'title': info.get('title', 'Sem título'),
+        'thumbnail': info.get('thumbnail', ''),
+        'duration': format_duration(info.get('duration', 0)),
+        'views': format_views(info.get('view_count', 0)),
+        'channel': info.get('uploader', 'Desconhecido'),
+        'containers': OUTPUT_FORMATS,
+        'formats': {
+            'video': video_formats,
+            'audio': audio_formats
+        }
+    }
+
+# Respostas já serializadas (JSON e gzip) guardadas junto com o dicionário de informações
+info_response_cache = MetadataCache(INFO_CACHE_TTL, INFO_CACHE_MAX_ENTRIES)
+
+def encode_payload(payload):
+    """Serializa a resposta uma vez: corpo JSON, versão gzip e ETag"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return {
+        'body': body,
+        'gzip': gzip.compress(body, 6),
+        'etag': hashlib.sha1(body).hexdigest()[:20],
+    }
+
+def encoded_video_info(url, info):
+    """Resposta serializada do vídeo, reaproveitada enquanto o mesmo info estiver em cache"""
+    key = info_cache_key(url)
+    entry = info_response_cache.get(key)
+    if entry is None or entry['source'] is not info:
+        entry = dict(encode_payload(build_video_info_payload(info)), source=info)
+        info_response_cache.set(key, entry)
+    return entry
+
+def encoded_response(entry):
+    """Envia o corpo pronto (gzip se aceito); no GET, com ETag e 304 para If-None-Match
+
+    Navegadores não guardam nem revalidam respostas de POST: a validação só
+    vale para o GET /api/video-info?url=, que é o que o front-end usa.
+    """
+    headers = {'Vary': 'Accept-Encoding'}
+    if request.method == 'GET':
+        headers.update({'ETag': f'"{entry["etag"]}"', 'Cache-Control': 'private, max-age=60'})
+        if request.if_none_match.contains(entry['etag']):
+            return Response(status=304, headers=headers)
+    if request.accept_encodings['gzip'] > 0:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(entry['gzip'], mimetype='application/json', headers=headers)
+    return Response(entry['body'], mimetype='application/json', headers=headers)
+
+@app.route('/api/video-info', methods=['GET', 'POST'])
+@rate_limited('info')
 def get_video_info():
-    """Obtém informações do vídeo"""
+    """Obtém informações do vídeo (GET ?url= ou POST {"url": ...})"""
     try:
-        data = request.json
-        url = data.get('url', '')
+        if request.method == 'GET':
+            url = request.args.get('url', '')
+        else:
+            url = request.json.get('url', '')
         
         if not url:
             return jsonify({'error': 'URL não fornecida'}), 400
+        popularity.record(url)
         
-        info = None
-        use_cobalt = False
-        
-        # Primeiro tentar com yt-dlp
+        # yt-dlp, Piped e Cobalt disputam em paralelo no executor de resolução;
+        # esta thread só espera o resultado (com prazo total)
+        if not resolution_slots.acquire(blocking=False):
+            return busy_response()
         try:
-            info = get_video_info_ytdlp(url)
-        except Exception as e:
-            print(f"yt-dlp falhou: {e}")
-            info = None
+            source, result = resolve_video_info(url)
+        finally:
+            resolution_slots.release()
+        info = result if source == 'ytdlp' else None
         
-        # Se yt-dlp falhou, tentar Piped
-        if info is None:
-            print("Tentando fallback Piped...")
-            piped_result = get_video_info_piped(url)
-            if piped_result:
-                # Processar resultado do Piped
-                video_streams = piped_result.get('videoStreams', [])
-                audio_streams = piped_result.get('audioStreams', [])
-                
-                video_formats = []
-                audio_formats = []
-                
-                # Pegar streams de vídeo com áudio ou apenas vídeo
-                for stream in video_streams:
-                    if stream.get('videoOnly', False):
-                        continue
-                    quality = stream.get('quality', 'N/A')
-                    video_formats.append({
-                        'format_id': 'piped',
-                        'quality': quality,
-                        'resolution': quality,
-                        'size': 'N/A',
-                        'fps': stream.get('fps', 30),
-                        'format': 'MP4',
-                        'format_name': f'MP4 ({quality})',
-                        'codec': 'h264',
-                        'piped_url': stream.get('url', '')
-                    })
-                
-                # Pegar streams de áudio
-                for stream in audio_streams:
-                    bitrate = stream.get('bitrate', 0)
-                    if bitrate:
-                        audio_formats.append({
-                            'format_id': 'piped_audio',
-                            'quality': f'{bitrate // 1000}kbps',
-                            'size': 'N/A',
-                            'format': 'MP3',
-                            'piped_url': stream.get('url', '')
-                        })
-                
-                # Limitar e ordenar
-                video_formats = video_formats[:6]
-                audio_formats = sorted(audio_formats, key=lambda x: int(x['quality'].replace('kbps', '')), reverse=True)[:4]
-                
-                return jsonify({
-                    'success': True,
-                    'id': extract_video_id(url) or 'piped',
-                    'title': piped_result.get('title', 'Video'),
-                    'thumbnail': piped_result.get('thumbnailUrl', ''),
-                    'duration': str(piped_result.get('duration', 0) // 60) + ':' + str(piped_result.get('duration', 0) % 60).zfill(2),
-                    'views': format_views(piped_result.get('views', 0)),
-                    'channel': piped_result.get('uploader', 'YouTube'),
-                    'use_piped': True,
-                    'formats': {
-                        'video': video_formats if video_formats else [{'format_id': 'piped', 'quality': 'Melhor', 'resolution': 'Auto', 'size': 'N/A', 'fps': 30, 'format': 'MP4', 'format_name': 'MP4', 'codec': 'h264'}],
-                        'audio': audio_formats if audio_formats else [{'format_id': 'piped_audio', 'quality': '128kbps', 'size': 'N/A', 'format': 'MP3'}]
-                    }
-                })
-        
-        # Se Piped também falhou, tentar Cobalt
-        if info is None:
-            print("Tentando fallback Cobalt...")
-            cobalt_result = get_video_info_cobalt(url)
-            if cobalt_result and cobalt_result.get('status') in ['tunnel', 'redirect', 'stream']:
-                use_cobalt = True
-                # Retornar resultado simplificado do Cobalt
-                return jsonify({
-                    'success': True,
-                    'id': 'cobalt',
-                    'title': cobalt_result.get('filename', 'Video'),
-                    'thumbnail': '',
-                    'duration': 'N/A',
-                    'views': 'N/A',
-                    'channel': 'YouTube',
-                    'use_cobalt': True,
-                    'cobalt_url': cobalt_result.get('url', ''),
-                    'formats': {
-                        'video': [{'format_id': 'cobalt', 'quality': 'Melhor', 'resolution': 'Auto', 'size': 'N/A', 'fps': 30, 'format': 'MP4', 'format_name': 'MP4 (Cobalt)', 'codec': 'h264'}],
-                        'audio': [{'format_id': 'cobalt_audio', 'quality': '320kbps', 'size': 'N/A', 'format': 'MP3'}]
-                    }
-                })
-            else:
-                return jsonify({'error': 'Não foi possível obter informações do vídeo. Tente novamente mais tarde.'}), 400
-        
-        if info is None:
-            return jsonify({'error': 'Não foi possível obter informações do vídeo'}), 400
-        
-        # Processar formatos de vídeo com múltiplas opções de conversão
-        video_formats = []
-        audio_formats = []
-        
-        # Qualidades disponíveis
-        qualities = {}
-        
-        for fmt in info.get('formats', []):
-            if fmt.get('vcodec') != 'none' and fmt.get('acodec') != 'none':
-                # Formato com vídeo e áudio
-                height = fmt.get('height', 0)
-                if height and height not in qualities:
-                    quality = f"{height}p"
-                    qualities[height] = {
-                        'format_id': fmt['format_id'],
-                        'quality': quality,
-                        'resolution': f"{fmt.get('width', 0)}x{height}",
-                        'size': fmt.get('filesize_approx', 0) or fmt.get('filesize', 0) or 0,
-                        'fps': fmt.get('fps', 30),
-                    }
-        
-        # Criar opções para cada qualidade em múltiplos formatos
-        output_formats = [
-            {'ext': 'MP4', 'codec': 'h264', 'name': 'MP4 (H.264)'},
-            {'ext': 'AVI', 'codec': 'xvid', 'name': 'AVI (Xvid)'},
-            {'ext': 'MKV', 'codec': 'h264', 'name': 'MKV (H.264)'},
-            {'ext': 'MOV', 'codec': 'h264', 'name': 'MOV (H.264)'},
-            {'ext': 'WMV', 'codec': 'wmv2', 'name': 'WMV'},
-            {'ext': 'FLV', 'codec': 'flv', 'name': 'FLV'},
-        ]
-        
-        for height in sorted(qualities.keys(), reverse=True):
-            fmt = qualities[height]
-            for output_fmt in output_formats:
+        # Resultado do Piped
+        if source == 'piped':
+            piped_result = result
+            # Guardado para o download direto (o servidor baixa a URL do stream)
+            direct_source_cache.set(('piped', info_cache_key(url)), piped_result)
+            containers = direct_containers()
+            # Processar resultado do Piped
+            video_streams = piped_result.get('videoStreams', [])
+            audio_streams = piped_result.get('audioStreams', [])
+            
+            video_formats = []
+            audio_formats = []
+            
+            # Pegar streams de vídeo com áudio ou apenas vídeo
+            for stream in video_streams:
+                if stream.get('videoOnly', False):
+                    continue
+                quality = stream.get('quality', 'N/A')
                 video_formats.append({
-                    'format_id': fmt['format_id'],
-                    'quality': fmt['quality'],
-                    'resolution': fmt['resolution'],
-                    'size': format_size(fmt['size']) if fmt['size'] else 'N/A',
-                    'fps': fmt['fps'],
-                    'format': output_fmt['ext'],
-                    'format_name': output_fmt['name'],
-                    'codec': output_fmt['codec']
+                    'format_id': f'piped-{quality}',
+                    'quality': quality,
+                    'resolution': quality,
+                    'size': 'N/A',
+                    'fps': stream.get('fps', 30),
+                    'containers': containers
                 })
-        
-        # Formatos de áudio
-        for fmt in info.get('formats', []):
-            if fmt.get('acodec') != 'none' and fmt.get('vcodec') == 'none':
-                bitrate = fmt.get('abr', 0)
-                if bitrate and bitrate >= 128:
+            
+            # Áudio: MP3 limitado ao melhor stream e os originais (M4A/WebM) sem recodificar
+            audio_streams = [stream for stream in audio_streams if stream.get('bitrate')]
+            if audio_streams:
+                best = max(stream['bitrate'] for stream in audio_streams) // 1000
+                audio_formats.append({
+                    'format_id': 'piped_audio',
+                    'quality': f'{mp3_bitrate(best)}kbps',
+                    'size': 'N/A',
+                    'format': 'MP3'
+                })
+            for ext, passthrough in AUDIO_PASSTHROUGH.items():
+                matching = [stream for stream in audio_streams if stream_ext(stream, 'm4a') == ext]
+                if matching:
                     audio_formats.append({
-                        'format_id': fmt['format_id'],
-                        'quality': f"{int(bitrate)}kbps",
-                        'size': format_size(fmt.get('filesize_approx', 0) or fmt.get('filesize', 0) or 0),
-                        'format': 'MP3'
+                        'format_id': 'piped_audio',
+                        'quality': f"{max(stream['bitrate'] for stream in matching) // 1000}kbps",
+                        'size': 'N/A',
+                        'format': ext.upper(),
+                        'format_name': passthrough['name'],
                     })
+            
+            # Limitar
+            video_formats = video_formats[:6]
+            audio_formats = audio_formats[:MAX_AUDIO_OPTIONS]
+            
+            return jsonify({
+                'success': True,
+                'id': extract_video_id(url) or 'piped',
+                'title': piped_result.get('title', 'Video'),
+                'thumbnail': piped_result.get('thumbnailUrl', ''),
+                'duration': format_duration(piped_result.get('duration', 0)),
+                'views': format_views(piped_result.get('views', 0)),
+                'channel': piped_result.get('uploader', 'YouTube'),
+                'use_piped': True,
+                'containers': OUTPUT_FORMATS,
+                'formats': {
+                    'video': video_formats if video_formats else [{'format_id': 'piped', 'quality': 'Melhor', 'resolution': 'Auto', 'size': 'N/A', 'fps': 30, 'containers': containers}],
+                    'audio': audio_formats if audio_formats else [{'format_id': 'piped_audio', 'quality': '128kbps', 'size': 'N/A', 'format': 'MP3'}]
+                }
+            })
+    
+        # Resultado do Cobalt
+        if source == 'cobalt':
+            cobalt_result = result
+            direct_source_cache.set(('cobalt', 'auto', info_cache_key(url)), cobalt_result)
+            # Retornar resultado simplificado do Cobalt
+            return jsonify({
+                'success': True,
+                'id': 'cobalt',
+                'title': cobalt_result.get('filename', 'Video'),
+                'thumbnail': '',
+                'duration': 'N/A',
+                'views': 'N/A',
+                'channel': 'YouTube',
+                'use_cobalt': True,
+                'containers': OUTPUT_FORMATS,
+                'formats': {
+                    'video': [{'format_id': 'cobalt', 'quality': 'Melhor', 'resolution': 'Auto', 'size': 'N/A', 'fps': 30, 'containers': direct_containers()}],
+                    'audio': [{'format_id': 'cobalt_audio', 'quality': '320kbps', 'size': 'N/A', 'format': 'MP3'}]
+                }
+            })
         
-        # Remover duplicatas de áudio e limitar
-        seen = set()
-        audio_formats = [x for x in audio_formats if not (x['quality'] in seen or seen.add(x['quality']))]
-        audio_formats = sorted(audio_formats, key=lambda x: int(x['quality'].replace('kbps', '')), reverse=True)[:4]
+        if info is None:
+            return jsonify({'error': 'Não foi possível obter informações do vídeo. Tente novamente mais tarde.'}), 400
         
-        return jsonify({
-            'success': True,
-            'id': info.get('id', ''),
-            'title': info.get('title', 'Sem título'),
-            'thumbnail': info.get('thumbnail', ''),
-            'duration': str(int(info.get('duration', 0) // 60)) + ':' + str(int(info.get('duration', 0) % 60)).zfill(2),
-            'views': format_views(info.get('view_count', 0)),
-            'channel': info.get('uploader', 'Desconhecido'),
-            'formats': {
-                'video': video_formats,
-                'audio': audio_formats
-            }
-        })
+        # Pedidos repetidos do mesmo vídeo só copiam os bytes já serializados
+        return encoded_response(encoded_video_info(url, info))
     
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
+def start_download(url, format_id, download_type, output_format, codec, download_id=None, client=None):
+    """Cria (ou reaproveita) o job de download
+
+    Retorna o download_id a acompanhar e 'cached', 'attached' ou
+    'queue_position'. Levanta QueueFullError se a fila estiver cheia e
+    ClientQuotaError se o cliente já tiver MAX_JOBS_PER_CLIENT jobs ativos.
+    """
+    download_id = download_id or str(uuid.uuid4())
+    job_key = download_job_key(url, format_id, download_type, output_format, codec)
+    
+    # Se o mesmo vídeo/formato já está sendo baixado, acompanhar o job existente
+    # (antes do cache: durante o pós-processamento o arquivo ainda não está pronto)
+    leader_id = state_store.claim_flight(job_key, download_id)
+    if leader_id != download_id:
+        # Se for um prefetch deste processo, ele deixa de ser tratado como fundo
+        bandwidth_budget.promote(leader_id)
+        if leader_id.startswith('prefetch-'):
+            promoted_downloads.add(leader_id)
+        return {'download_id': leader_id, 'attached': True}
+    
+    # Arquivo já produzido antes: concluir na hora
+    cached_file = output_cache.lookup(output_cache.digest(job_key))
+    if cached_file:
+        state_store.release_flight(job_key, download_id)
+        output_cache.touch(cached_file)
+        state_store.set(download_id, {
+            'status': 'completed',
+            'progress': 100,
+            'filename': cached_file,
+            'cached': True
+        })
+        return {'download_id': download_id, 'cached': True}
+    
+    # Cada cliente tem um número limitado de jobs novos em andamento
+    if client and MAX_JOBS_PER_CLIENT and not state_store.acquire_job_slot(client, download_id, MAX_JOBS_PER_CLIENT):
+        state_store.release_flight(job_key, download_id)
+        raise ClientQuotaError()
+    
+    # Enfileirar o download no pool de workers (e no diário, para sobreviver a quedas)
+    state_store.set(download_id, {
+        'status': 'queued',
+        'progress': 0,
+        'filename': None
+    })
+    params = {
+        'url': url, 'format_id': format_id, 'download_type': download_type,
+        'output_format': output_format, 'codec': codec, 'job_key': job_key, 'client': client,
+    }
+    state_store.journal_add(download_id, params, output_cache.digest(job_key), process_owner())
+    try:
+        position = enqueue_download(download_id, params)
+    except QueueFullError:
+        state_store.delete(download_id)
+        state_store.journal_finish(download_id)
+        state_store.release_flight(job_key, download_id)
+        state_store.release_job_slot(download_id)
+        raise
+    return {'download_id': download_id, 'queue_position': position}
+
 @app.route('/api/download', methods=['POST'])
+@rate_limited('download')
 def download_video():
     """Inicia o download do vídeo"""
     try:
@@ -374,8 +2359,6 @@ def download_video():
         download_type = data.get('type', 'video')
         output_format = data.get('output_format', 'mp4').lower()
         codec = data.get('codec', 'h264')
-        use_cobalt = data.get('use_cobalt', False)
-        cobalt_url = data.get('cobalt_url', '')
         
         if not url:
             return jsonify({'error': 'URL não fornecida'}), 400
@@ -383,29 +2366,30 @@ def download_video():
         # Gerar ID único para o download
         download_id = str(uuid.uuid4())
         
-        # Se for download via Cobalt, retornar URL direta
-        if use_cobalt and cobalt_url:
-            return jsonify({
-                'success': True,
-                'download_id': download_id,
-                'message': 'Download via Cobalt',
-                'direct_url': cobalt_url
-            })
-        
-        # Iniciar download em thread separada
-        thread = Thread(target=process_download, args=(download_id, url, format_id, download_type, output_format, codec))
-        thread.start()
+        try:
+            started = start_download(url, format_id, download_type, output_format, codec, download_id, client_id())
+        except QueueFullError:
+            return busy_response()
+        except ClientQuotaError:
+            RATE_LIMITED_REQUESTS.inc(reason='jobs')
+            response = jsonify({'error': f'Você já tem {MAX_JOBS_PER_CLIENT} downloads em andamento. Aguarde algum terminar.'})
+            response.headers['Retry-After'] = str(QUEUE_RETRY_AFTER)
+            return response, 429
         
-        return jsonify({
-            'success': True,
-            'download_id': download_id,
-            'message': 'Download iniciado'
-        })
+        popularity.record(url, (download_type, format_id, output_format, codec))
+        if started.get('cached'):
+            message = 'Download concluído'
+        elif started.get('attached'):
+            message = 'Download já em andamento'
+        else:
+            message = 'Download iniciado'
+        return jsonify({'success': True, **started, 'message': message})
     
     except Exception as e:
         return jsonify({'error': str(e)}), 400
 
 @app.route('/api/cobalt-download', methods=['POST'])
+@rate_limited('cobalt')
 def cobalt_download():
     """Download direto via API do Cobalt"""
     try:
@@ -421,54 +2405,618 @@ def cobalt_download():
             'Content-Type': 'application/json',
         }
         
-        payload = {
-            'url': url,
-            'videoQuality': '1080',
-            'audioFormat': 'mp3',
-            'youtubeVideoCodec': 'h264',
-            'downloadMode': 'audio' if download_type == 'audio' else 'auto',
-        }
+        payload = {
+            'url': url,
+            'videoQuality': '1080',
+            'audioFormat': 'mp3',
+            'youtubeVideoCodec': 'h264',
+            'downloadMode': 'audio' if download_type == 'audio' else 'auto',
+        }
+        
+        # Tentar múltiplas instâncias (das mais saudáveis para as menos)
+        for instance in instance_health.ranked(COBALT_INSTANCES):
+            started = time.monotonic()
+            try:
+                api_url = f"{instance}/"
+                response = http_client.post(api_url, json=payload, headers=headers, timeout=30)
+                result = response.json() if response.status_code == 200 else {}
+                instance_health.record(
+                    instance,
+                    result.get('status') in ['tunnel', 'redirect', 'stream', 'picker'],
+                    time.monotonic() - started
+                )
+                
+                if response.status_code == 200:
+                    if result.get('status') in ['tunnel', 'redirect', 'stream']:
+                        return jsonify({
+                            'success': True,
+                            'download_url': result.get('url', ''),
+                            'filename': result.get('filename', 'video.mp4')
+                        })
+                    elif result.get('status') == 'picker':
+                        # Múltiplas opções disponíveis
+                        return jsonify({
+                            'success': True,
+                            'download_url': result.get('picker', [{}])[0].get('url', ''),
+                            'filename': 'video.mp4'
+                        })
+            except Exception as e:
+                instance_health.record(instance, False, time.monotonic() - started)
+                print(f"Cobalt {instance} falhou: {e}")
+                continue
+        
+        # Se Cobalt falhou, tentar Piped
+        piped_result = get_video_info_piped(url)
+        if piped_result:
+            streams = piped_result.get('audioStreams' if download_type == 'audio' else 'videoStreams', [])
+            if streams:
+                return jsonify({
+                    'success': True,
+                    'download_url': streams[0].get('url', ''),
+                    'filename': f"{piped_result.get('title', 'video')}.{'mp3' if download_type == 'audio' else 'mp4'}"
+                })
+        
+        return jsonify({'error': 'Falha ao obter link de download'}), 400
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+# Threads do FFmpeg por job (evita que conversões simultâneas disputem todos os núcleos)
+FFMPEG_THREADS_PER_JOB = int(os.environ.get(
+    'FFMPEG_THREADS_PER_JOB', max(1, (os.cpu_count() or 1) // max(1, MAX_CONCURRENT_DOWNLOADS))))
+
+# Famílias de codec a partir do vcodec/acodec do yt-dlp (ex.: 'avc1.640028' -> 'h264')
+CODEC_FAMILIES = {
+    'avc1': 'h264', 'avc3': 'h264', 'h264': 'h264',
+    'hev1': 'hevc', 'hvc1': 'hevc', 'hevc': 'hevc', 'h265': 'hevc',
+    'vp09': 'vp9', 'vp9': 'vp9', 'vp8': 'vp8', 'av01': 'av1', 'av1': 'av1',
+    'mp4v': 'mpeg4', 'mpeg4': 'mpeg4', 'xvid': 'mpeg4',
+    'mp4a': 'aac', 'aac': 'aac', 'mp3': 'mp3', 'opus': 'opus', 'vorbis': 'vorbis',
+    'ac-3': 'ac3', 'ec-3': 'eac3', 'flac': 'flac', 'alac': 'alac',
+}
+
+# Codecs que cada container aceita sem recodificar (None = qualquer um)
+CONTAINER_CODECS = {
+    'mp4': {'video': ('h264', 'hevc', 'av1', 'vp9', 'mpeg4'), 'audio': ('aac', 'mp3', 'opus', 'ac3', 'eac3', 'flac', 'alac')},
+    'mov': {'video': ('h264', 'hevc', 'mpeg4'), 'audio': ('aac', 'mp3', 'alac')},
+    'mkv': {'video': None, 'audio': None},
+    'webm': {'video': ('vp8', 'vp9', 'av1'), 'audio': ('opus', 'vorbis')},
+}
+
+# Codecs legados pedidos explicitamente (AVI/Xvid, WMV, FLV) sempre exigem recodificar
+VIDEO_ENCODERS = {
+    'h264': ['-c:v', 'libx264', '-preset', 'ultrafast'],
+    'xvid': ['-c:v', 'mpeg4', '-vtag', 'xvid', '-q:v', '4'],
+    'wmv2': ['-c:v', 'wmv2', '-q:v', '4'],
+    'flv': ['-c:v', 'flv', '-q:v', '4'],
+}
+AUDIO_ENCODERS = {
+    'mp4': ['-c:a', 'aac', '-b:a', '192k'],
+    'mov': ['-c:a', 'aac', '-b:a', '192k'],
+    'mkv': ['-c:a', 'aac', '-b:a', '192k'],
+    'avi': ['-c:a', 'libmp3lame', '-b:a', '192k'],
+    'wmv': ['-c:a', 'wmav2', '-b:a', '192k'],
+    'flv': ['-c:a', 'libmp3lame', '-b:a', '128k', '-ar', '44100'],
+}
+
+def codec_family(codec):
+    """Normaliza o nome do codec informado pelo yt-dlp ('none' = stream ausente)"""
+    if not codec:
+        return None
+    name = codec.split('.')[0].lower()
+    return CODEC_FAMILIES.get(name, name)
+
+def source_streams(info, format_id):
+    """(família do vídeo, família do áudio, extensão) do formato escolhido, se conhecidos"""
+    formats = {fmt.get('format_id'): fmt for fmt in info.get('formats', [])}
+    parts = [formats.get(part) for part in format_id.split('+')]
+    if not parts or None in parts:
+        return None, None, None
+    video = next((codec_family(fmt.get('vcodec')) for fmt in parts if fmt.get('vcodec') != 'none'), 'none')
+    audio = next((codec_family(fmt.get('acodec')) for fmt in parts if fmt.get('acodec') != 'none'), 'none')
+    # Formatos separados são unidos pelo yt-dlp num container próprio
+    ext = parts[0].get('ext') if len(parts) == 1 else None
+    return video, audio, ext
+
+def fits_container(family, allowed):
+    """O stream pode ser copiado para o container sem recodificar?"""
+    return family == 'none' or allowed is None or family in allowed
+
+def plan_transcode(info, format_id, output_format, codec, threads=FFMPEG_THREADS_PER_JOB):
+    """Decide entre manter o arquivo, remuxar (cópia dos streams) ou recodificar
+
+    Retorna o modo ('none', 'remux', 'convert_audio' ou 'convert') e as
+    opções de pós-processamento do yt-dlp. Só recodifica o stream que o
+    container de destino não aceita; AVI/Xvid, WMV e FLV são sempre
+    recodificados.
+    """
+    video, audio, ext = source_streams(info, format_id)
+    containers = CONTAINER_CODECS.get(output_format)
+    threads = ['-threads', str(threads)]
+    
+    if containers is None or codec in ('xvid', 'wmv2', 'flv'):
+        copy_video = copy_audio = False
+    elif video is None and output_format == 'mp4':
+        # Codec de origem desconhecido: MP4 segue sem pós-processamento, como antes
+        return {'mode': 'none', 'postprocessors': [], 'postprocessor_args': {}}
+    else:
+        copy_video = fits_container(video, containers['video'])
+        copy_audio = fits_container(audio, containers['audio'])
+    
+    if copy_video and copy_audio:
+        if ext == output_format:
+            return {'mode': 'none', 'postprocessors': [], 'postprocessor_args': {}}
+        return {
+            'mode': 'remux',
+            'postprocessors': [{'key': 'FFmpegVideoRemuxer', 'preferedformat': output_format}],
+            'postprocessor_args': {'videoremuxer': threads},
+        }
+    
+    video_args = ['-c:v', 'copy'] if copy_video else VIDEO_ENCODERS.get(codec, VIDEO_ENCODERS['h264'])
+    audio_args = ['-c:a', 'copy'] if copy_audio else AUDIO_ENCODERS.get(output_format, AUDIO_ENCODERS['mkv'])
+    return {
+        'mode': 'convert_audio' if copy_video else 'convert',
+        'postprocessors': [{'key': 'FFmpegVideoConvertor', 'preferedformat': output_format}],
+        'postprocessor_args': {'videoconvertor': video_args + audio_args + threads},
+    }
+
+# Áudio: entrega o stream original (M4A/AAC ou WebM/Opus) sem recodificar,
+# ou MP3 com bitrate limitado ao da origem
+AUDIO_PASSTHROUGH = {
+    'm4a': {'codec': 'aac', 'name': 'M4A (AAC, original)'},
+    'webm': {'codec': 'opus', 'name': 'WebM (Opus, original)'},
+}
+# Bitrates CBR do MP3; usa o primeiro que cobre o bitrate da origem
+MP3_BITRATES = (64, 96, 128, 160, 192, 256, 320)
+# Codificações simultâneas por processo (cada uma ocupa FFMPEG_THREADS_PER_JOB threads)
+MAX_CONCURRENT_ENCODES = int(os.environ.get(
+    'MAX_CONCURRENT_ENCODES', max(1, (os.cpu_count() or 1) // BUDGET_WORKERS // FFMPEG_THREADS_PER_JOB)))
+ENCODE_STATUS_INTERVAL = 1.0
+
+encode_slots = BoundedSemaphore(MAX_CONCURRENT_ENCODES)
+# Codificações de usuário aguardando vaga ou rodando; as de fundo (prefetch) cedem a vez a elas
+user_encodes = set()
+# Jobs de fundo que um usuário passou a acompanhar (não são mais interrompidos)
+promoted_downloads = set()
+
+class EncodePreempted(Exception):
+    """Codificação de fundo interrompida porque um usuário precisa da CPU"""
+
+def audio_bitrate(fmt):
+    """Bitrate do áudio em kbps (0 se desconhecido)"""
+    return fmt.get('abr') or fmt.get('tbr') or 0
+
+def mp3_bitrate(source_kbps):
+    """Bitrate do MP3 para uma origem: recodificar acima dela só aumenta o arquivo"""
+    if not source_kbps:
+        return MP3_BITRATES[-1]
+    return next((rate for rate in MP3_BITRATES if rate >= source_kbps), MP3_BITRATES[-1])
+
+def best_audio(formats, ext=None):
+    """Melhor formato só de áudio (opcionalmente de uma extensão); ignora as versões DRC"""
+    candidates = [fmt for fmt in formats
+                  if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')
+                  and (ext is None or fmt.get('ext') == ext)]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda fmt: (audio_bitrate(fmt), 'drc' not in str(fmt.get('format_id'))))
+
+def plan_audio(info, format_id, output_format):
+    """Escolhe o stream de áudio e se ele é entregue como está ou recodificado em MP3
+
+    Retorna {'mode': 'passthrough' | 'mp3', 'format': seletor do yt-dlp,
+    'ext': extensão final, 'bitrate': kbps do MP3}. Sem o codec nativo
+    pedido, cai para MP3.
+    """
+    formats = info.get('formats', [])
+    if output_format in AUDIO_PASSTHROUGH:
+        chosen = next((fmt for fmt in formats if fmt.get('format_id') == format_id
+                       and fmt.get('vcodec') == 'none' and fmt.get('ext') == output_format), None)
+        chosen = chosen or best_audio(formats, output_format)
+        if chosen:
+            return {'mode': 'passthrough', 'format': chosen['format_id'], 'ext': output_format, 'bitrate': None}
+    source = best_audio(formats)
+    if source is None:
+        return {'mode': 'mp3', 'format': 'bestaudio/best', 'ext': 'mp3', 'bitrate': MP3_BITRATES[-1]}
+    return {'mode': 'mp3', 'format': f"{source['format_id']}/bestaudio/best", 'ext': 'mp3',
+            'bitrate': mp3_bitrate(audio_bitrate(source))}
+
+def mp3_encoder_args(bitrate, threads):
+    return ['-vn', '-c:a', 'libmp3lame', '-b:a', f'{bitrate}k', '-threads', str(threads)]
+
+def lowest_priority():
+    """preexec_fn do FFmpeg de fundo: prioridade mínima de CPU"""
+    if hasattr(os, 'nice'):
+        os.nice(19)
+
+def encode_file(download_id, source_path, target_path, args, background=False):
+    """Roda o FFmpeg numa das vagas de codificação, publicando a velocidade no status
+
+    Remove a origem ao terminar. Retorna a velocidade média (segundos de
+    mídia por segundo de relógio) ou None se o FFmpeg não informou.
+
+    background=True (prefetch) não ocupa vaga: roda com prioridade mínima,
+    só começa sem codificação de usuário no processo e é interrompida
+    (EncodePreempted, origem mantida para a próxima tentativa) assim que
+    alguma aparece.
+    """
+    ffmpeg = ffmpeg_executable()
+    if not ffmpeg:
+        os.remove(source_path)
+        raise Exception('FFmpeg não encontrado para converter o arquivo')
+    # Saída temporária com a extensão final para o FFmpeg escolher o container
+    base, ext = os.path.splitext(target_path)
+    temp_path = f"{base}.tmp{ext}"
+    keep_source = False
+    background = background and download_id not in promoted_downloads
+    if background:
+        slot = nullcontext()
+    else:
+        slot = encode_slots
+        user_encodes.add(download_id)
+    state_store.update(download_id, encoding='waiting')
+    try:
+        with slot:
+            if background and user_encodes:
+                keep_source = True
+                raise EncodePreempted('Conversão antecipada adiada: há conversões de usuários')
+            state_store.update(download_id, encoding='running')
+            started = time.perf_counter()
+            process = subprocess.Popen(
+                [ffmpeg, '-y', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1',
+                 '-i', source_path, *args, temp_path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                preexec_fn=lowest_priority if background and os.name == 'posix' else None
+            )
+            media_seconds = 0.0
+            published = started
+            for line in process.stdout:
+                if background and user_encodes and download_id not in promoted_downloads:
+                    process.kill()
+                    process.wait()
+                    keep_source = True
+                    raise EncodePreempted('Conversão antecipada interrompida: há conversões de usuários')
+                key, _, value = line.strip().partition('=')
+                if key == 'out_time_us' and value.isdigit():
+                    media_seconds = int(value) / 1e6
+                elif key == 'progress':
+                    now = time.perf_counter()
+                    if now - published >= ENCODE_STATUS_INTERVAL and now > started:
+                        published = now
+                        state_store.update(download_id, encode_speed=round(media_seconds / (now - started), 1))
+            errors = process.stderr.read()
+            process.wait()
+            elapsed = time.perf_counter() - started
+            POSTPROCESS_SECONDS.observe(elapsed, postprocessor='encode')
+            if process.returncode != 0:
+                raise Exception(f"Erro na conversão: {errors.strip()[-300:]}")
+        os.replace(temp_path, target_path)
+        return round(media_seconds / elapsed, 1) if media_seconds and elapsed else None
+    finally:
+        user_encodes.discard(download_id)
+        if not keep_source:
+            os.remove(source_path)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+# Streams separados (vídeo + áudio) baixados ao mesmo tempo antes do merge
+stream_part_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS, thread_name_prefix='stream-part')
+
+def download_streams_parallel(ydl, info):
+    """Baixa as partes de um formato "vídeo+áudio" em paralelo
+
+    Os arquivos ficam nos mesmos caminhos que o yt-dlp usa para o merge
+    ("<nome>.f<id>.<ext>"); com 'overwrites' desligado ele os reaproveita e
+    só executa o merge (cópia de streams) e o pós-processamento.
+    """
+    selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
+    parts = selected.get('requested_formats') or []
+    if len(parts) < 2 or not FFmpegMergerPP(ydl).available:
+        return
+    base = os.path.splitext(ydl.prepare_filename(selected, 'temp'))[0]
+    os.makedirs(os.path.dirname(base) or '.', exist_ok=True)
+    
+    def fetch(part):
+        part_info = dict(selected)
+        del part_info['requested_formats']
+        part_info.update(part)
+        try:
+            return ydl.dl(prepend_extension(f"{base}.{part['ext']}", f"f{part['format_id']}", part['ext']), part_info)
+        except Exception as e:
+            # Não aborta: o yt-dlp baixa de novo (ou retoma) a parte que faltar
+            print(f"Falha no download paralelo do formato {part['format_id']}: {str(e)}")
+            return False
+    
+    with bandwidth_budget.parallel_streams(ydl, len(parts)):
+        futures = [stream_part_executor.submit(fetch, part) for part in parts[1:]]
+        fetch(parts[0])
+        wait(futures)
+
+# Downloads diretos (Piped/Cobalt): o servidor baixa a URL do stream em
+# segmentos paralelos e entrega pelo mesmo job, cache e conversão do yt-dlp
+DIRECT_CONNECTIONS = int(os.environ.get('DIRECT_CONNECTIONS', 4))
+DIRECT_SEGMENT_SIZE = int(os.environ.get('DIRECT_SEGMENT_SIZE', 4 * 1024 * 1024))
+DIRECT_SEGMENT_RETRIES = int(os.environ.get('DIRECT_SEGMENT_RETRIES', 5))
+DIRECT_CHUNK_SIZE = 256 * 1024
+# As URLs do Piped/Cobalt expiram: a resposta é reaproveitada só por pouco tempo
+DIRECT_SOURCE_TTL = int(os.environ.get('DIRECT_SOURCE_TTL', 600))
+# Codecs presumidos pela extensão (Piped/Cobalt entregam H.264/AAC em MP4 e VP9/Opus em WebM)
+DIRECT_SOURCE_CODECS = {
+    'mp4': ('avc1', 'mp4a'),
+    'webm': ('vp9', 'opus'),
+    'm4a': ('none', 'mp4a'),
+    'mp3': ('none', 'mp3'),
+}
+
+direct_source_cache = MetadataCache(DIRECT_SOURCE_TTL, INFO_CACHE_MAX_ENTRIES)
+
+def direct_containers():
+    """Containers oferecidos para o Piped/Cobalt: todos se houver FFmpeg para converter"""
+    return OUTPUT_CONTAINERS if ffmpeg_executable() else ['MP4']
+
+def is_direct_format(format_id):
+    """Formatos oferecidos pelo Piped ou pelo Cobalt (baixados sem o yt-dlp)"""
+    return format_id.startswith(('piped', 'cobalt'))
+
+def stream_ext(stream, default):
+    """Extensão de um stream do Piped pelo formato/mime informado"""
+    kind = (stream.get('format') or stream.get('mimeType') or '').upper()
+    return 'webm' if 'WEBM' in kind else default
+
+def resolve_direct_source(url, format_id, download_type, output_format=None):
+    """(URL do stream, extensão, título, kbps do áudio) de um formato do Piped/Cobalt
+
+    A URL é obtida pelo servidor (nunca a enviada pelo navegador) e a
+    resposta de /api/video-info é reaproveitada enquanto não expira.
+    """
+    key = info_cache_key(url)
+    if format_id.startswith('piped'):
+        data = direct_source_cache.get(('piped', key)) or get_video_info_piped(url)
+        if not data:
+            raise Exception('Piped indisponível para este vídeo')
+        direct_source_cache.set(('piped', key), data)
+        if download_type == 'audio':
+            # Maior bitrate, preferindo a extensão pedida quando é um áudio original
+            streams = sorted(data.get('audioStreams', []), reverse=True, key=lambda s: (
+                stream_ext(s, 'm4a') == output_format, s.get('bitrate', 0)))
+            default_ext = 'm4a'
+        else:
+            quality = format_id.partition('-')[2]
+            streams = [s for s in data.get('videoStreams', []) if not s.get('videoOnly', False)]
+            streams.sort(key=lambda s: s.get('quality') != quality)
+            default_ext = 'mp4'
+        if not streams or not streams[0].get('url'):
+            raise Exception('Stream não encontrado no Piped')
+        bitrate = streams[0].get('bitrate', 0) // 1000 if download_type == 'audio' else None
+        return streams[0]['url'], stream_ext(streams[0], default_ext), data.get('title', 'video'), bitrate
+    
+    mode = 'audio' if download_type == 'audio' else 'auto'
+    data = direct_source_cache.get(('cobalt', mode, key)) or get_video_info_cobalt(url, mode)
+    if not data or not data.get('url'):
+        raise Exception('Cobalt indisponível para este vídeo')
+    direct_source_cache.set(('cobalt', mode, key), data)
+    filename = data.get('filename') or ('audio.mp3' if mode == 'audio' else 'video.mp4')
+    title, _, ext = filename.rpartition('.')
+    return data['url'], ext.lower() or 'mp4', title or 'video', None
+
+class DirectTransfer:
+    """Baixa uma URL em segmentos paralelos (Range), com novas tentativas por segmento
+
+    'params' imita o de uma instância do yt-dlp para que o bandwidth_budget
+    ajuste a banda total ('ratelimit') e as conexões
+    ('concurrent_fragment_downloads'). Sem suporte a Range, ou com arquivo
+    pequeno, baixa numa conexão só.
+    """
+
+    def __init__(self, url, path, progress_hook):
+        self.url = url
+        self.path = path
+        self.progress_hook = progress_hook
+        self.params = {'ratelimit': None, 'concurrent_fragment_downloads': DIRECT_CONNECTIONS}
+        self.total = None
+        self.downloaded = 0
+        self.connections = 1
+        self._started = time.monotonic()
+        self._lock = Lock()
+
+    def probe(self):
+        """(tamanho ou None, aceita Range); usa GET de 1 byte porque túneis recusam HEAD"""
+        response = http_client.get(self.url, headers={'Range': 'bytes=0-0'}, stream=True)
+        try:
+            response.raise_for_status()
+            match = re.match(r'bytes 0-0/(\d+)$', response.headers.get('Content-Range', ''))
+            if response.status_code == 206 and match:
+                return int(match.group(1)), True
+            length = response.headers.get('Content-Length')
+            return (int(length) if length else None), False
+        finally:
+            response.close()
+
+    def run(self):
+        """Baixa para self.path (via .part); retorna o número de bytes"""
+        self.total, ranges = self.probe()
+        self._started = time.monotonic()
+        part = self.path + '.part'
+        if ranges and self.total > DIRECT_SEGMENT_SIZE:
+            self._segmented(part)
+        else:
+            self._single(part, ranges)
+        os.replace(part, self.path)
+        with self._lock:
+            self._report('finished')
+        return self.downloaded
+
+    def _segmented(self, part):
+        segments = [(start, min(start + DIRECT_SEGMENT_SIZE, self.total) - 1)
+                    for start in range(0, self.total, DIRECT_SEGMENT_SIZE)]
+        with open(part, 'wb') as f:
+            f.truncate(self.total)
+        pending = segments[::-1]
+        errors = []
+        self.connections = max(1, min(len(segments), DIRECT_CONNECTIONS,
+                                      self.params.get('concurrent_fragment_downloads') or 1))
+        
+        def worker():
+            with open(part, 'r+b') as f:
+                while not errors:
+                    with self._lock:
+                        if not pending:
+                            return
+                        start, end = pending.pop()
+                    try:
+                        self._fetch(f, start, end)
+                    except Exception as e:
+                        errors.append(e)
         
-        # Tentar múltiplas instâncias
-        for instance in COBALT_INSTANCES:
+        workers = [Thread(target=worker, daemon=True) for _ in range(self.connections)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _fetch(self, f, start, end):
+        """Baixa um segmento; uma falha retoma do último byte gravado"""
+        offset = start
+        for attempt in range(DIRECT_SEGMENT_RETRIES):
             try:
-                api_url = f"{instance}/"
-                response = requests.post(api_url, json=payload, headers=headers, timeout=30)
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    if result.get('status') in ['tunnel', 'redirect', 'stream']:
-                        return jsonify({
-                            'success': True,
-                            'download_url': result.get('url', ''),
-                            'filename': result.get('filename', 'video.mp4')
-                        })
-                    elif result.get('status') == 'picker':
-                        # Múltiplas opções disponíveis
-                        return jsonify({
-                            'success': True,
-                            'download_url': result.get('picker', [{}])[0].get('url', ''),
-                            'filename': 'video.mp4'
-                        })
+                response = http_client.get(self.url, headers={'Range': f'bytes={offset}-{end}'}, stream=True)
+                try:
+                    if response.status_code != 206 or not response.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                        raise Exception(f'resposta {response.status_code} sem o intervalo pedido')
+                    for chunk in response.iter_content(DIRECT_CHUNK_SIZE):
+                        chunk = chunk[:end + 1 - offset]
+                        f.seek(offset)
+                        f.write(chunk)
+                        offset += len(chunk)
+                        self._advance(len(chunk))
+                        if offset > end:
+                            return
+                finally:
+                    response.close()
+                raise Exception('conexão encerrada antes do fim')
             except Exception as e:
-                print(f"Cobalt {instance} falhou: {e}")
-                continue
-        
-        # Se Cobalt falhou, tentar Piped
-        piped_result = get_video_info_piped(url)
-        if piped_result:
-            streams = piped_result.get('audioStreams' if download_type == 'audio' else 'videoStreams', [])
-            if streams:
-                return jsonify({
-                    'success': True,
-                    'download_url': streams[0].get('url', ''),
-                    'filename': f"{piped_result.get('title', 'video')}.{'mp3' if download_type == 'audio' else 'mp4'}"
-                })
-        
-        return jsonify({'error': 'Falha ao obter link de download'}), 400
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 400
+                if attempt == DIRECT_SEGMENT_RETRIES - 1:
+                    raise Exception(f'Segmento {start}-{end} falhou: {e}')
+                print(f"Segmento {start}-{end}: tentativa {attempt + 1} falhou ({e}); retomando de {offset}")
+                time.sleep(min(2 ** attempt, 10))
+
+    def _single(self, part, ranges):
+        offset = 0
+        for attempt in range(DIRECT_SEGMENT_RETRIES):
+            if not ranges:
+                # Sem Range não dá para continuar: recomeça do zero
+                offset = 0
+                with self._lock:
+                    self.downloaded = 0
+            try:
+                headers = {'Range': f'bytes={offset}-'} if offset else {}
+                response = http_client.get(self.url, headers=headers, stream=True)
+                try:
+                    response.raise_for_status()
+                    if offset and (response.status_code != 206 or not response.headers.get('Content-Range', '').startswith(f'bytes {offset}-')):
+                        # O servidor ignorou o Range e mandou o arquivo inteiro: recomeça do zero
+                        offset = 0
+                        with self._lock:
+                            self.downloaded = 0
+                    length = response.headers.get('Content-Length')
+                    expected = self.total or (offset + int(length) if length else None)
+                    # Sem tamanho conhecido, só o fim do chunked garante que nada foi cortado
+                    chunked = 'chunked' in response.headers.get('Transfer-Encoding', '').lower()
+                    with open(part, 'r+b' if offset else 'wb') as f:
+                        f.seek(offset)
+                        f.truncate()
+                        for chunk in response.iter_content(DIRECT_CHUNK_SIZE):
+                            f.write(chunk)
+                            offset += len(chunk)
+                            self._advance(len(chunk))
+                finally:
+                    response.close()
+                complete = offset >= expected if expected is not None else chunked
+                if complete:
+                    return
+                raise Exception('conexão encerrada antes do fim')
+            except Exception as e:
+                if attempt == DIRECT_SEGMENT_RETRIES - 1:
+                    raise
+                print(f"Download direto: tentativa {attempt + 1} falhou ({e})")
+                time.sleep(min(2 ** attempt, 10))
+
+    def _advance(self, count):
+        with self._lock:
+            self.downloaded += count
+            self._report('downloading')
+            # 'ratelimit' vale para a soma das conexões (lido a cada bloco, como no yt-dlp)
+            rate = self.params.get('ratelimit')
+            wait_for = self.downloaded / rate - (time.monotonic() - self._started) if rate else 0
+        if wait_for > 0:
+            time.sleep(min(wait_for, 5))
+
+    def _report(self, status):
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        self.progress_hook({
+            'status': status,
+            'filename': self.path,
+            'downloaded_bytes': self.downloaded,
+            'total_bytes': self.total or 0,
+            'speed': self.downloaded / elapsed,
+        })
+
+def direct_conversion_args(ext, download_type, output_format, codec, threads, bitrate=None):
+    """Argumentos do FFmpeg para chegar ao formato pedido (None = arquivo já serve)"""
+    if download_type == 'audio':
+        if ext == 'mp3' or (output_format in AUDIO_PASSTHROUGH and ext == output_format):
+            return None
+        return mp3_encoder_args(mp3_bitrate(bitrate), threads)
+    vcodec, acodec = DIRECT_SOURCE_CODECS.get(ext, (None, None))
+    info = {'formats': [{'format_id': 'direct', 'ext': ext, 'vcodec': vcodec, 'acodec': acodec}]}
+    plan = plan_transcode(info, 'direct', output_format, codec, threads)
+    if plan['mode'] == 'none':
+        return None
+    if plan['mode'] == 'remux':
+        return ['-c', 'copy', '-threads', str(threads)]
+    return plan['postprocessor_args']['videoconvertor']
+
+def download_direct(download_id, url, format_id, download_type, output_format, codec, digest, background=False):
+    """Baixa um formato do Piped/Cobalt para o cache de arquivos; retorna o status final"""
+    source_url, ext, title, bitrate = resolve_direct_source(url, format_id, download_type, output_format)
+    clean_title = clean_filename(title)
+    target_ext = 'mp3' if download_type == 'audio' else output_format
+    threads = 1 if background else FFMPEG_THREADS_PER_JOB
+    args = direct_conversion_args(ext, download_type, output_format, codec, threads, bitrate)
+    final_name = output_cache.filename_for(clean_title, digest, target_ext if args else ext)
+    # Com conversão o original fica com nome de temporário ("[hash].src.<ext>")
+    source_path = os.path.join(DOWNLOAD_FOLDER, final_name if args is None else
+                               output_cache.filename_for(clean_title, digest, f'src.{ext}'))
+    
+    transfer = DirectTransfer(source_url, source_path, lambda d: update_progress(download_id, d))
+    with bandwidth_budget.share(download_id, transfer, PREFETCH_BANDWIDTH if background else None):
+        transfer.run()
+    
+    status = {
+        'status': 'completed',
+        'progress': 100,
+        'filename': final_name,
+        'source': 'piped' if format_id.startswith('piped') else 'cobalt',
+        'transcode': 'none' if args is None else 'convert',
+    }
+    if args is not None:
+        status['encode_speed'] = encode_file(download_id, source_path, os.path.join(DOWNLOAD_FOLDER, final_name), args,
+                                             background)
+    return status
+
+def needs_fixup(info, format_id):
+    """O yt-dlp reescreve o arquivo depois do download (FFmpegFixup*)?
+
+    Nesse caso o .part não é o arquivo final (ex.: M4A DASH do YouTube) e
+    não pode ser entregue enquanto cresce. Formato desconhecido conta como sim.
+    """
+    fmt = next((fmt for fmt in info.get('formats', []) if fmt.get('format_id') == format_id), None)
+    if fmt is None:
+        return True
+    return (fmt.get('container') == 'm4a_dash' or fmt.get('protocol') == 'm3u8_native'
+            or fmt.get('stretched_ratio') not in (1, None) or bool(info.get('is_live')))
 
 def clean_filename(filename):
     """Remove caracteres inválidos do nome do arquivo"""
@@ -482,41 +3030,68 @@ def clean_filename(filename):
         cleaned = cleaned[:200]
     return cleaned
 
-def process_download(download_id, url, format_id, download_type, output_format='mp4', codec='h264'):
-    """Processa o download em background"""
+def process_download(download_id, url, format_id, download_type, output_format='mp4', codec='h264', job_key=None,
+                     background=False):
+    """Processa o download em background
+
+    background=True marca um download antecipado (prefetch): banda limitada
+    por PREFETCH_BANDWIDTH e uma única thread de ffmpeg.
+    """
+    if job_key is None:
+        job_key = download_job_key(url, format_id, download_type, output_format, codec)
+    digest = output_cache.digest(job_key)
+    output_cache.pin(digest)
+    state_store.journal_start(download_id)
     try:
-        download_status[download_id] = {
+        # Outro pedido pode ter produzido o mesmo arquivo enquanto este esperava na fila
+        cached_file = output_cache.lookup(digest)
+        if cached_file:
+            output_cache.touch(cached_file)
+            state_store.set(download_id, {
+                'status': 'completed',
+                'progress': 100,
+                'filename': cached_file,
+                'cached': True
+            })
+            return
+        
+        state_store.set(download_id, {
             'status': 'downloading',
             'progress': 0,
             'filename': None
-        }
+        })
         
-        # Opções base para evitar bloqueio do YouTube
-        base_opts = {
-            'quiet': True,
-            'no_check_certificate': True,
-        }
+        # Formatos do Piped/Cobalt: baixados direto da URL do stream
+        if is_direct_format(format_id):
+            status = download_direct(download_id, url, format_id, download_type, output_format, codec, digest,
+                                     background)
+            output_cache.finish(digest, status['filename'])
+            state_store.set(download_id, status)
+            DOWNLOAD_JOBS.inc(outcome='completed')
+            return
         
-        # Usar cookies se o arquivo existir
-        if os.path.exists(COOKIES_FILE) and os.path.getsize(COOKIES_FILE) > 100:
-            base_opts['cookiefile'] = COOKIES_FILE
+        # Obter informações do vídeo (reaproveita o que /api/video-info já extraiu)
+        cached_info = get_video_info_cached(url)
+        video_title = cached_info.get('title', 'video')
+        clean_title = clean_filename(video_title)
         
-        # Primeiro, obter informações do vídeo para pegar o título
-        with yt_dlp.YoutubeDL(base_opts) as ydl_info:
-            info = ydl_info.extract_info(url, download=False)
-            video_title = info.get('title', 'video')
-            clean_title = clean_filename(video_title)
+        # Áudio: stream original (passthrough) ou origem para o MP3, sem baixar vídeo
+        audio_plan = plan_audio(cached_info, format_id, output_format) if download_type == 'audio' else None
         
-        # Configurar opções de download com o título limpo
-        filename = f"{clean_title}.%(ext)s"
+        # Nome endereçado pelo job: "<título> [<hash>].<ext>"; a origem do MP3 é intermediária
+        encode_later = audio_plan is not None and audio_plan['mode'] == 'mp3'
+        filename = output_cache.output_template(clean_title, digest, 'src.' if encode_later else '')
         output_path = os.path.join(DOWNLOAD_FOLDER, filename)
         
         ydl_opts = {
             'format': format_id,
             'outtmpl': output_path,
             'progress_hooks': [lambda d: update_progress(download_id, d)],
+            'postprocessor_hooks': [postprocess_timer()],
             # OTIMIZAÇÕES DE VELOCIDADE BALANCEADAS
-            'concurrent_fragment_downloads': 8,
+            # Banda e fragmentos são ajustados pelo bandwidth_budget enquanto o job roda
+            'ratelimit': None,
+            'concurrent_fragment_downloads': MAX_FRAGMENTS_PER_JOB,
             'http_chunk_size': 5242880,
             'buffersize': 32768,
             'retries': 50,
@@ -532,7 +3107,7 @@ def process_download(download_id, url, format_id, download_type, output_format='
             'prefer_ffmpeg': True,
             'continuedl': True,
             'noprogress': False,
-            'overwrites': True,
+            'overwrites': False,
         }
         
         # Usar cookies se o arquivo existir
@@ -543,74 +3118,676 @@ def process_download(download_id, url, format_id, download_type, output_format='
         if FFMPEG_LOCATION:
             ydl_opts['ffmpeg_location'] = FFMPEG_LOCATION
         
-        # Adicionar opções de conversão de formato
-        if download_type == 'video' and output_format != 'mp4':
-            ydl_opts['postprocessors'] = [{
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': output_format,
-            }]
-            # Otimizar FFmpeg para velocidade
-            ydl_opts['postprocessor_args'] = [
-                '-preset', 'ultrafast',
-                '-threads', '0',
-            ]
-        
-        # Adicionar opções para áudio
-        if download_type == 'audio':
-            ydl_opts['format'] = 'bestaudio/best'
-            ydl_opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '320',
-            }]
-            ydl_opts['postprocessor_args'] = [
-                '-threads', '0',
-            ]
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+        # Conversão de formato: remux (cópia) quando o container aceita os codecs de origem
+        transcode = None
+        if download_type == 'video':
+            transcode = plan_transcode(cached_info, format_id, output_format, codec,
+                                       1 if background else FFMPEG_THREADS_PER_JOB)
+            if transcode['postprocessors']:
+                ydl_opts['postprocessors'] = transcode['postprocessors']
+                ydl_opts['postprocessor_args'] = transcode['postprocessor_args']
+                # O FFmpeg escreve direto no arquivo final: uma saída pela metade de uma
+                # tentativa anterior sai, e a origem completa (se houver) é convertida de novo
+                output_cache.discard_unfinished(digest, output_format)
+            if transcode['mode'] == 'none' and '+' not in format_id and not needs_fixup(cached_info, format_id):
+                # O .part do yt-dlp já é o arquivo final: pode ser servido enquanto cresce
+                growing_downloads.add(download_id)
+        
+        # Áudio: o MP3 é codificado depois, fora da instância do yt-dlp e numa vaga de codificação
+        if audio_plan:
+            ydl_opts['format'] = audio_plan['format']
+            if audio_plan['mode'] == 'passthrough' and not needs_fixup(cached_info, audio_plan['format']):
+                growing_downloads.add(download_id)
+        
+        # Opções deste job; o restante define o perfil da instância reaproveitada
+        job_opts = {key: ydl_opts.pop(key) for key in YDL_JOB_OPTIONS if key in ydl_opts}
+        profile = 'audio' if download_type == 'audio' else 'download'
+        
+        background_rate = PREFETCH_BANDWIDTH if background else None
+        with ydl_pool.checkout(profile, ydl_opts, **job_opts) as ydl, \
+                bandwidth_budget.share(download_id, ydl, background_rate):
+            if cached_info.get('_type', 'video') == 'video':
+                if '+' in format_id:
+                    download_streams_parallel(ydl, cached_info)
+                # Baixar a partir do dicionário em cache, sem nova extração
+                info = ydl.process_ie_result(copy.deepcopy(cached_info), download=True)
+            else:
+                info = ydl.extract_info(url, download=True)
             filename = ydl.prepare_filename(info)
-            
-            # Ajustar extensão baseado no tipo
-            if download_type == 'audio':
-                filename = filename.rsplit('.', 1)[0] + '.mp3'
-            elif output_format != 'mp4':
-                filename = filename.rsplit('.', 1)[0] + '.' + output_format
-            
-            download_status[download_id] = {
-                'status': 'completed',
-                'progress': 100,
-                'filename': os.path.basename(filename)
-            }
+        
+        # Ajustar extensão baseado no tipo
+        if transcode and transcode['mode'] != 'none':
+            filename = filename.rsplit('.', 1)[0] + '.' + output_format
+        
+        status = {
+            'status': 'completed',
+            'progress': 100,
+            'filename': os.path.basename(filename)
+        }
+        if transcode:
+            status['transcode'] = transcode['mode']
+        if audio_plan:
+            status['transcode'] = 'none' if audio_plan['mode'] == 'passthrough' else 'mp3'
+        if encode_later:
+            final_name = output_cache.filename_for(clean_title, digest, 'mp3')
+            status.update(filename=final_name, bitrate=audio_plan['bitrate'], encode_speed=encode_file(
+                download_id, filename, os.path.join(DOWNLOAD_FOLDER, final_name),
+                mp3_encoder_args(audio_plan['bitrate'], 1 if background else FFMPEG_THREADS_PER_JOB), background
+            ))
+        output_cache.finish(digest, status['filename'])
+        state_store.set(download_id, status)
+        DOWNLOAD_JOBS.inc(outcome='completed')
     
+    except EncodePreempted as e:
+        state_store.set(download_id, {
+            'status': 'error',
+            'progress': 0,
+            'error': str(e),
+            'preempted': True
+        })
+        DOWNLOAD_JOBS.inc(outcome='preempted')
     except Exception as e:
-        download_status[download_id] = {
+        state_store.set(download_id, {
             'status': 'error',
             'progress': 0,
             'error': str(e)
+        })
+        DOWNLOAD_JOBS.inc(outcome='error')
+    finally:
+        last_progress.pop(download_id, None)
+        progress_parts.pop(download_id, None)
+        growing_downloads.discard(download_id)
+        promoted_downloads.discard(download_id)
+        state_store.release_job_slot(download_id)
+        output_cache.unpin(digest)
+        state_store.release_flight(job_key, download_id)
+        state_store.journal_finish(download_id)
+
+def enqueue_download(download_id, params):
+    """Coloca um job do diário na fila deste processo; retorna a posição"""
+    return download_scheduler.submit(
+        download_id,
+        download_priority(params['download_type'], params['output_format']),
+        process_download,
+        download_id, params['url'], params['format_id'], params['download_type'],
+        params['output_format'], params['codec'], params['job_key'],
+        owner=params.get('client')
+    )
+
+# Diário de jobs: processos que param de renovar seus jobs tiveram o worker morto
+JOB_HEARTBEAT_INTERVAL = 15
+JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', 90))
+# Tentativas (incluindo a original) antes de desistir de um job que derruba o worker
+MAX_JOB_ATTEMPTS = int(os.environ.get('MAX_JOB_ATTEMPTS', 3))
+# Temporários (.part, .ytdl, .f137.mp4...) sem job no diário e parados há mais que isso são removidos
+ORPHAN_MIN_AGE = int(os.environ.get('ORPHAN_MIN_AGE', 3600))
+ORPHAN_SWEEP_INTERVAL = 300
+
+def recover_jobs():
+    """Retoma os jobs de processos mortos; os que já falharam demais viram erro"""
+    recovered = 0
+    for job in state_store.journal_claim_stale(process_owner(), time.time() - JOB_STALE_AFTER):
+        download_id, params = job['download_id'], job['params']
+        if job['attempts'] >= MAX_JOB_ATTEMPTS:
+            print(f"Job {download_id} desistido após {job['attempts']} tentativas")
+            state_store.set(download_id, {
+                'status': 'error',
+                'error': 'Download interrompido repetidas vezes. Tente novamente.'
+            })
+            state_store.journal_finish(download_id)
+            state_store.release_flight(params['job_key'], download_id)
+            state_store.release_job_slot(download_id)
+            DOWNLOAD_JOBS.inc(outcome='abandoned')
+            continue
+        
+        state_store.set(download_id, {
+            'status': 'queued',
+            'progress': 0,
+            'filename': None,
+            'resumed': True
+        })
+        try:
+            # Mesmo nome de saída: o yt-dlp continua os .part existentes (continuedl)
+            enqueue_download(download_id, params)
+            recovered += 1
+        except QueueFullError:
+            state_store.journal_release(download_id)
+    if recovered:
+        print(f"{recovered} download(s) interrompido(s) retomado(s)")
+    return recovered
+
+def start_journal_keeper():
+    """Thread que renova os jobs deste processo, retoma jobs órfãos e limpa temporários"""
+    def loop():
+        last_gc = 0
+        while True:
+            try:
+                state_store.journal_heartbeat(process_owner())
+                recover_jobs()
+                if time.time() - last_gc > ORPHAN_SWEEP_INTERVAL:
+                    last_gc = time.time()
+                    output_cache.remove_orphans(state_store.journal_digests(), ORPHAN_MIN_AGE)
+            except Exception as e:
+                print(f"Erro no diário de jobs: {e}")
+            time.sleep(JOB_HEARTBEAT_INTERVAL)
+    Thread(target=loop, daemon=True).start()
+
+start_journal_keeper()
+
+# Prefetch: vídeos muito pedidos têm metadados renovados e o formato mais
+# pedido produzido antes do próximo usuário, só quando o processo está ocioso
+PREFETCH_ENABLED = os.environ.get('PREFETCH_ENABLED', '1') != '0'
+PREFETCH_INTERVAL = int(os.environ.get('PREFETCH_INTERVAL', 60))
+# Meia-vida (segundos) da contagem de pedidos e pedidos necessários para antecipar
+PREFETCH_HALF_LIFE = int(os.environ.get('PREFETCH_HALF_LIFE', 3600))
+PREFETCH_MIN_REQUESTS = float(os.environ.get('PREFETCH_MIN_REQUESTS', 3))
+PREFETCH_TOP = int(os.environ.get('PREFETCH_TOP', 20))
+PREFETCH_MAX_TRACKED = 1024
+# Metadados que expiram dentro desta margem (segundos) são renovados
+PREFETCH_REFRESH_MARGIN = int(os.environ.get('PREFETCH_REFRESH_MARGIN', 300))
+# Orçamentos: carga média por CPU e fração do OUTPUT_CACHE_MAX_BYTES já ocupada
+PREFETCH_MAX_LOAD = float(os.environ.get('PREFETCH_MAX_LOAD', 0.5))
+PREFETCH_DISK_SHARE = float(os.environ.get('PREFETCH_DISK_SHARE', 0.8))
+# Vídeos cuja antecipação falhou ficam de fora por este tempo (segundos)
+PREFETCH_RETRY_AFTER = 3600
+# Formato produzido quando ninguém baixou o vídeo ainda: MP3 (bitrate limitado ao da origem)
+PREFETCH_DEFAULT_FORMAT = ('audio', 'bestaudio', 'mp3', 'mp3')
+
+class PopularityTracker:
+    """Pedidos por vídeo (ID canônico) com decaimento exponencial
+
+    Cada processo conta os pedidos que atendeu; a produção antecipada é
+    deduplicada entre processos pelo claim_flight e pelo cache de arquivos.
+    """
+
+    def __init__(self, half_life, max_entries):
+        self.half_life = half_life
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def _decayed(self, entry, now):
+        return entry['score'] * 0.5 ** ((now - entry['updated_at']) / self.half_life)
+
+    def record(self, url, fmt=None):
+        """Conta um pedido; fmt = (tipo, format_id, container, codec) de um download"""
+        video_id = extract_video_id(url)
+        if not video_id:
+            return
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(video_id)
+            if entry is None:
+                entry = self._entries[video_id] = {'score': 0.0, 'updated_at': now, 'formats': {}}
+            entry['score'] = self._decayed(entry, now) + 1
+            entry['updated_at'] = now
+            entry['url'] = url
+            if fmt is not None:
+                entry['formats'][fmt] = entry['formats'].get(fmt, 0) + 1
+            self._entries.move_to_end(video_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def top(self, limit, min_score):
+        """Vídeos mais pedidos: [(video_id, url, formato mais pedido)]"""
+        now = time.time()
+        with self._lock:
+            ranked = [(round(self._decayed(entry, now), 2), video_id, entry) for video_id, entry in self._entries.items()]
+        ranked = sorted((item for item in ranked if item[0] >= min_score), key=lambda item: item[0], reverse=True)
+        result = []
+        for _, video_id, entry in ranked[:limit]:
+            formats = entry['formats']
+            fmt = max(formats, key=formats.get) if formats else PREFETCH_DEFAULT_FORMAT
+            result.append((video_id, entry['url'], fmt))
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {'tracked': len(self._entries)}
+
+class Prefetcher:
+    """Thread que usa a capacidade ociosa para antecipar o trabalho dos vídeos populares"""
+
+    def __init__(self, tracker, interval):
+        self.tracker = tracker
+        self.interval = interval
+        self._failed = {}
+        self._thread = None
+        self.refreshed = 0
+        self.produced = 0
+        self.preempted = 0
+        self.skipped_busy = 0
+
+    def idle(self):
+        """Nada na fila, worker livre, nenhuma conversão de usuário e CPU abaixo do orçamento"""
+        queue = download_scheduler.stats()
+        if queue['queued'] or queue['active'] >= queue['max_workers'] or user_encodes:
+            return False
+        try:
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        except (AttributeError, OSError):
+            load = 0.0
+        return load < PREFETCH_MAX_LOAD
+
+    def run_once(self):
+        """Um ciclo: renova metadados perto de expirar e produz no máximo um arquivo"""
+        if not self.idle():
+            self.skipped_busy += 1
+            return
+        now = time.time()
+        self._failed = {video_id: at for video_id, at in self._failed.items() if at > now - PREFETCH_RETRY_AFTER}
+        candidates = [item for item in self.tracker.top(PREFETCH_TOP, PREFETCH_MIN_REQUESTS)
+                      if item[0] not in self._failed]
+        
+        for video_id, url, _ in candidates:
+            ttl_left = info_cache.ttl_left(info_cache_key(url))
+            if ttl_left is not None and ttl_left > PREFETCH_REFRESH_MARGIN:
+                continue
+            if not self.idle():
+                return
+            try:
+                get_video_info_cached(url, refresh=True)
+                self.refreshed += 1
+            except Exception as e:
+                print(f"Prefetch: erro ao renovar {video_id}: {e}")
+                self._failed[video_id] = now
+        
+        # Produção só com folga no disco e sem nenhum download de usuário em andamento
+        if output_cache.usage() > OUTPUT_CACHE_MAX_BYTES * PREFETCH_DISK_SHARE:
+            return
+        for video_id, url, fmt in candidates:
+            if video_id in self._failed or download_scheduler.stats()['active'] or not self.idle():
+                return
+            if self.produce(video_id, url, fmt):
+                return
+
+    def produce(self, video_id, url, fmt):
+        """Produz o arquivo do formato se ainda não existe; True se um job rodou"""
+        job_key = download_job_key(url, *fmt)
+        if output_cache.lookup(output_cache.digest(job_key)):
+            return False
+        download_id = f"prefetch-{uuid.uuid4()}"
+        if state_store.claim_flight(job_key, download_id) != download_id:
+            return False
+        print(f"Prefetch: produzindo {video_id} ({fmt[0]} {fmt[2]})")
+        process_download(download_id, url, *fmt, job_key=job_key, background=True)
+        status = state_store.get(download_id) or {}
+        if status.get('status') == 'completed':
+            self.produced += 1
+        elif status.get('preempted'):
+            # Cedeu a CPU a um usuário: tenta de novo num próximo ciclo ocioso
+            self.preempted += 1
+        else:
+            print(f"Prefetch: erro ao produzir {video_id}: {status.get('error')}")
+            self._failed[video_id] = time.time()
+        return True
+
+    def stats(self):
+        return {
+            'enabled': PREFETCH_ENABLED,
+            **self.tracker.stats(),
+            'refreshed': self.refreshed,
+            'produced': self.produced,
+            'preempted': self.preempted,
+            'skipped_busy': self.skipped_busy,
+            'failed': len(self._failed),
         }
 
+    def start(self):
+        if self._thread is not None:
+            return
+        def loop():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.run_once()
+                except Exception as e:
+                    print(f"Erro no prefetch: {e}")
+        self._thread = Thread(target=loop, daemon=True)
+        self._thread.start()
+
+popularity = PopularityTracker(PREFETCH_HALF_LIFE, PREFETCH_MAX_TRACKED)
+prefetcher = Prefetcher(popularity, PREFETCH_INTERVAL)
+if PREFETCH_ENABLED:
+    prefetcher.start()
+
+def postprocess_timer():
+    """Hook do yt-dlp que mede a duração de cada pós-processador"""
+    started = {}
+    def hook(d):
+        name = d.get('postprocessor', 'unknown')
+        if d['status'] == 'started':
+            started[name] = time.perf_counter()
+        elif d['status'] == 'finished' and name in started:
+            POSTPROCESS_SECONDS.observe(time.perf_counter() - started.pop(name), postprocessor=name)
+    return hook
+
 def update_progress(download_id, d):
-    """Atualiza progresso do download"""
-    if d['status'] == 'downloading':
-        downloaded = d.get('downloaded_bytes', 0)
+    """Atualiza progresso e velocidade do download (somando as partes baixadas em paralelo)"""
+    parts = progress_parts.setdefault(download_id, {})
+    name = d.get('filename')
+    if d['status'] == 'finished':
+        total = d.get('total_bytes') or d.get('downloaded_bytes') or 0
+        # O yt-dlp repete 'finished' para partes que já estavam no disco
+        if not parts.get(name, (0, 0, False, 0))[2]:
+            DOWNLOADED_BYTES.inc(total)
+        parts[name] = (total, total, True, 0)
+    elif d['status'] == 'downloading':
         total = d.get('total_bytes', 0) or d.get('total_bytes_estimate', 0)
-        
-        if total > 0:
-            progress = int((downloaded / total) * 100)
-            download_status[download_id]['progress'] = progress
+        if name not in parts and download_id in growing_downloads and d.get('tmpfilename'):
+            state_store.update(download_id, partial_file=os.path.basename(d['tmpfilename']))
+        parts[name] = (d.get('downloaded_bytes', 0), total, False, d.get('speed') or 0)
+    else:
+        return
+    
+    snapshot = list(parts.values())
+    known = [(done, total) for done, total, _, _ in snapshot if total > 0]
+    if known:
+        progress = min(100, int(sum(done for done, _ in known) * 100 / sum(total for _, total in known)))
+        # Só grava no armazenamento quando o percentual muda
+        if last_progress.get(download_id) != progress:
+            last_progress[download_id] = progress
+            speed = int(sum(speed for _, _, finished, speed in snapshot if not finished))
+            state_store.update(download_id, progress=progress, speed=speed)
+            if d.get('speed'):
+                DOWNLOAD_THROUGHPUT.observe(d['speed'])
 
 @app.route('/api/download-status/<download_id>', methods=['GET'])
 def get_download_status(download_id):
     """Obtém status do download"""
-    status = download_status.get(download_id, {'status': 'not_found'})
-    return jsonify(status)
+    return jsonify(current_status(download_id))
+
+def current_status(download_id):
+    """Status do download com a posição na fila atualizada"""
+    status = state_store.get(download_id) or {'status': 'not_found'}
+    if status['status'] == 'queued':
+        # Posição ao vivo quando o job está na fila deste processo
+        position = download_scheduler.position(download_id)
+        if position is not None:
+            status['queue_position'] = position
+    else:
+        status.pop('queue_position', None)
+    return status
+
+# Progresso via Server-Sent Events
+SSE_MIN_INTERVAL = float(os.environ.get('SSE_MIN_INTERVAL', 0.25))
+# Releitura do armazenamento (mudanças feitas por outros workers não geram aviso local)
+SSE_POLL_INTERVAL = float(os.environ.get('SSE_POLL_INTERVAL', 1.0))
+SSE_HEARTBEAT_INTERVAL = 15
+# Depois disso o stream é encerrado e o EventSource do navegador reconecta sozinho
+SSE_MAX_DURATION = int(os.environ.get('SSE_MAX_DURATION', 300))
+TERMINAL_STATUSES = ('completed', 'error', 'not_found')
+
+# Respostas que prendem uma thread do gunicorn por muito tempo (SSE, arquivo em
+# crescimento, ZIP de lote, stream do FFmpeg); as demais threads do worker
+# ficam livres para health, video-info e status
+MAX_HELD_RESPONSES = int(os.environ.get(
+    'MAX_HELD_RESPONSES', max(1, int(os.environ.get('GUNICORN_THREADS', 64)) // 2)))
+
+class HeldResponseSlots:
+    """Vagas para respostas longas, com contagem legível pelo health"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._lock = Lock()
+
+    def acquire(self):
+        """Ocupa uma vaga; False se todas estão em uso"""
+        with self._lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active = max(0, self.active - 1)
+
+    def stats(self):
+        with self._lock:
+            return {'max': self.limit, 'active': self.active}
+
+held_response_slots = HeldResponseSlots(MAX_HELD_RESPONSES)
+
+def held_response(build):
+    """Monta a resposta longa numa das vagas (liberada ao fim do envio) ou responde 503"""
+    if not held_response_slots.acquire():
+        return busy_response()
+    try:
+        response = build()
+    except BaseException:
+        held_response_slots.release()
+        raise
+    if isinstance(response, tuple):
+        # Erro antes do corpo longo: nada a segurar
+        held_response_slots.release()
+        return response
+    on_body_close(response, held_response_slots.release)
+    return response
+
+@app.route('/api/download-events/<download_id>', methods=['GET'])
+def download_events(download_id):
+    """Envia o status do download por SSE quando ele muda (no máximo a cada SSE_MIN_INTERVAL)"""
+    def generate():
+        started = time.monotonic()
+        last_payload = None
+        last_status = None
+        last_sent = 0.0
+        version = status_notifier.version
+        yield 'retry: 2000\n\n'
+        while time.monotonic() - started < SSE_MAX_DURATION:
+            status = current_status(download_id)
+            payload = json.dumps(status, sort_keys=True)
+            now = time.monotonic()
+            if payload != last_payload:
+                # Mudança de estado sai na hora; só progresso respeita o intervalo mínimo
+                wait_for = SSE_MIN_INTERVAL - (now - last_sent)
+                if status['status'] == last_status and wait_for > 0:
+                    time.sleep(wait_for)
+                    continue
+                yield f"data: {payload}\n\n"
+                last_payload = payload
+                last_status = status['status']
+                last_sent = time.monotonic()
+                if status['status'] in TERMINAL_STATUSES:
+                    return
+            elif now - last_sent >= SSE_HEARTBEAT_INTERVAL:
+                yield ': ping\n\n'
+                last_sent = now
+            version = status_notifier.wait(version, SSE_POLL_INTERVAL)
+    
+    # Sem vaga, o EventSource fecha e o front-end volta a consultar o status
+    return held_response(lambda: Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    ))
+
+# Formatos que o FFmpeg consegue gerar direto num pipe (sem seek no arquivo de saída)
+STREAM_CONTAINERS = {
+    # Bitrate do MP3 limitado ao da origem (plan_audio), como nos jobs
+    'mp3': {'args': ['-vn', '-c:a', 'libmp3lame', '-f', 'mp3'], 'mimetype': 'audio/mpeg'},
+    'mp4': {'args': ['-c', 'copy', '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4'], 'mimetype': 'video/mp4'},
+    'mov': {'args': ['-c', 'copy', '-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mov'], 'mimetype': 'video/quicktime'},
+    'mkv': {'args': ['-c', 'copy', '-f', 'matroska'], 'mimetype': 'video/x-matroska'},
+}
+# Protocolos que o FFmpeg lê direto da URL do formato
+STREAM_PROTOCOLS = ('http', 'https', 'm3u8', 'm3u8_native')
+MAX_CONCURRENT_STREAMS = int(os.environ.get('MAX_CONCURRENT_STREAMS', 4))
+STREAM_CHUNK_SIZE = 64 * 1024
+
+stream_slots = BoundedSemaphore(MAX_CONCURRENT_STREAMS)
+
+def ffmpeg_executable():
+    """Caminho do executável do FFmpeg (ou None se não instalado)"""
+    if FFMPEG_LOCATION:
+        return os.path.join(FFMPEG_LOCATION, 'ffmpeg')
+    return shutil.which('ffmpeg')
+
+def select_stream_inputs(info, format_id, download_type):
+    """Escolhe os formatos de origem (com URL direta) para o modo streaming"""
+    formats = {fmt.get('format_id'): fmt for fmt in info.get('formats', [])}
+    # Mesmo áudio que os jobs usam (o bitrate do MP3 é calculado a partir dele)
+    audio_source = best_audio(info.get('formats', []))
+    
+    if download_type == 'audio':
+        selected = [audio_source] if audio_source else []
+    else:
+        selected = [formats.get(part) for part in format_id.split('+')]
+        if selected and selected[0] and selected[0].get('acodec') == 'none' and len(selected) == 1 and audio_source:
+            # Vídeo sem áudio: juntar com o melhor áudio disponível
+            selected.append(audio_source)
+    
+    if not selected or any(fmt is None or not fmt.get('url') for fmt in selected):
+        return None
+    if any(fmt.get('protocol', 'https') not in STREAM_PROTOCOLS for fmt in selected):
+        return None
+    return selected
+
+def build_stream_command(inputs, container, bitrate=None):
+    """Monta a linha de comando do FFmpeg que escreve o resultado em stdout (bitrate: kbps do MP3)"""
+    command = [ffmpeg_executable(), '-hide_banner', '-loglevel', 'error', '-nostdin']
+    for fmt in inputs:
+        headers = ''.join(f"{key}: {value}\r\n" for key, value in (fmt.get('http_headers') or {}).items())
+        if headers:
+            command += ['-headers', headers]
+        command += ['-i', fmt['url']]
+    for index in range(len(inputs)):
+        command += ['-map', str(index)]
+    if bitrate:
+        command += ['-b:a', f'{bitrate}k']
+    return command + STREAM_CONTAINERS[container]['args'] + ['pipe:1']
+
+def attachment_header(filename):
+    """Content-Disposition com suporte a nomes não-ASCII"""
+    fallback = filename.encode('ascii', 'ignore').decode('ascii') or 'download'
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{url_quote(filename)}"
+
+# Envio delegado ao proxy da frente: 'X-Accel-Redirect' (nginx) ou 'X-Sendfile' (Apache/lighttpd)
+SENDFILE_HEADER = os.environ.get('SENDFILE_HEADER', '')
+# Location interna do nginx que aponta para DOWNLOAD_FOLDER (só para X-Accel-Redirect)
+SENDFILE_PREFIX = os.environ.get('SENDFILE_PREFIX', '/internal-downloads/')
+# Espera entre leituras de um arquivo que ainda está sendo baixado
+GROWING_FILE_POLL_INTERVAL = 0.5
+
+def file_etag(stat, digest=None):
+    """ETag forte: hash do job (quando houver) + tamanho + data de modificação"""
+    return f"{digest or 'f'}-{stat.st_size:x}-{int(stat.st_mtime):x}"
+
+def read_range(source, length):
+    """Lê no máximo length bytes a partir da posição atual e fecha o arquivo"""
+    try:
+        while length > 0:
+            chunk = source.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        source.close()
+
+def file_response(filepath, download_name, digest=None):
+    """Resposta com ETag/Last-Modified e Range (uma faixa); usa sendfile sempre que possível"""
+    stat = os.stat(filepath)
+    etag = file_etag(stat, digest)
+    mimetype = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    headers = {
+        'Content-Disposition': attachment_header(download_name),
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': 'private, no-cache',
+    }
+    
+    if SENDFILE_HEADER:
+        # O proxy trata Range/ETag e envia o arquivo sem passar pelo Python
+        name = os.path.basename(filepath)
+        headers[SENDFILE_HEADER] = SENDFILE_PREFIX + url_quote(name) if SENDFILE_HEADER == 'X-Accel-Redirect' else filepath
+        return Response(status=200, mimetype=mimetype, headers=headers)
+    
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=headers)
+    
+    status, start, length = 200, 0, stat.st_size
+    requested = request.range
+    if_range = request.if_range
+    # If-Range: só honrar o Range se o arquivo ainda for o mesmo
+    if requested and ('If-Range' not in request.headers or if_range.etag == etag
+                      or (if_range.date and if_range.date.timestamp() >= int(stat.st_mtime))):
+        bounds = requested.range_for_length(stat.st_size)
+        if bounds is None:
+            headers['Content-Range'] = f"bytes */{stat.st_size}"
+            return Response(status=416, headers=headers)
+        start, stop = bounds
+        status, length = 206, stop - start
+        headers['Content-Range'] = requested.to_content_range_header(stat.st_size)
+    
+    if request.method == 'HEAD':
+        response = Response(status=status, mimetype=mimetype, headers=headers)
+        response.content_length = length
+        return response
+    
+    source = open(filepath, 'rb')
+    source.seek(start)
+    if start + length == stat.st_size:
+        # Até o fim do arquivo: o gunicorn envia com sendfile() a partir da posição atual
+        response = Response(wrap_file(request.environ, source, STREAM_CHUNK_SIZE), status=status,
+                            mimetype=mimetype, headers=headers, direct_passthrough=True)
+    else:
+        response = Response(read_range(source, length), status=status, mimetype=mimetype, headers=headers)
+    response.content_length = length
+    return response
+
+def growing_file_response(download_id, source, download_name):
+    """Envia um arquivo que o yt-dlp ainda está escrevendo, acompanhando até o fim do job"""
+    def generate():
+        version = status_notifier.version
+        with source:
+            while True:
+                chunk = source.read(STREAM_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                    continue
+                status = state_store.get(download_id) or {'status': 'not_found'}
+                if status['status'] == 'completed':
+                    # O .part foi renomeado para o nome final; o descritor aberto continua válido
+                    while True:
+                        chunk = source.read(STREAM_CHUNK_SIZE)
+                        if not chunk:
+                            return
+                        yield chunk
+                if status['status'] in TERMINAL_STATUSES:
+                    # Falhou no meio: encerrar sem o terminador do chunked, o cliente vê o corte
+                    raise IOError(f"Download {download_id} interrompido")
+                version = status_notifier.wait(version, GROWING_FILE_POLL_INTERVAL)
+    
+    response = Response(stream_with_context(generate()),
+                        mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream')
+    response.headers['Content-Disposition'] = attachment_header(download_name)
+    response.headers['Accept-Ranges'] = 'none'
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/api/download-file/<download_id>', methods=['GET'])
 def download_file(download_id):
-    """Baixa o arquivo"""
+    """Baixa o arquivo (com retomada via Range; enquanto baixa, se o formato permitir)"""
     try:
-        status = download_status.get(download_id)
+        status = state_store.get(download_id)
+        if status and status['status'] == 'downloading' and status.get('partial_file'):
+            try:
+                source = open(os.path.join(DOWNLOAD_FOLDER, status['partial_file']), 'rb')
+            except OSError:
+                # Ainda não começou ou acabou de ser renomeado: reler o status
+                status = state_store.get(download_id)
+            else:
+                download_name = output_cache.display_name(status['partial_file'][:-len('.part')])
+                response = held_response(lambda: growing_file_response(download_id, source, download_name))
+                if isinstance(response, tuple):
+                    source.close()
+                return response
+        
         if not status or status['status'] != 'completed':
             return jsonify({'error': 'Download não encontrado ou não completo'}), 404
         
@@ -620,11 +3797,386 @@ def download_file(download_id):
         if not os.path.exists(filepath):
             return jsonify({'error': 'Arquivo não encontrado'}), 404
         
-        return send_file(filepath, as_attachment=True)
+        # Proteger o arquivo contra o limpador enquanto é enviado
+        output_cache.touch(filename)
+        digest = output_cache.digest_of(filename)
+        response = file_response(filepath, output_cache.display_name(filename), digest)
+        if digest and response.status_code in (200, 206) and request.method != 'HEAD':
+            output_cache.pin(digest)
+            on_body_close(response, lambda: output_cache.unpin(digest))
+        return response
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/download-stream', methods=['GET'])
+@rate_limited('download')
+def download_stream():
+    """Envia o arquivo enquanto é baixado/convertido, sem esperar o job terminar"""
+    url = request.args.get('url', '')
+    download_type = request.args.get('type', 'video')
+    format_id = request.args.get('format_id', 'best')
+    output_format = 'mp3' if download_type == 'audio' else request.args.get('output_format', 'mp4').lower()
+    codec = request.args.get('codec', 'h264')
+    tee_to_cache = request.args.get('cache', '1') != '0'
+    
+    if not url:
+        return jsonify({'error': 'URL não fornecida'}), 400
+    if output_format not in STREAM_CONTAINERS:
+        return jsonify({'error': f'Formato {output_format} não suporta streaming, use /api/download'}), 400
+    if not ffmpeg_executable():
+        return jsonify({'error': 'FFmpeg não disponível no servidor'}), 503
+    
+    job_key = download_job_key(url, format_id, download_type, output_format, codec)
+    digest = output_cache.digest(job_key)
+    
+    # Arquivo já pronto no cache: enviar direto
+    cached_file = output_cache.lookup(digest)
+    if cached_file:
+        output_cache.touch(cached_file)
+        response = send_file(os.path.join(DOWNLOAD_FOLDER, cached_file), as_attachment=True,
+                             download_name=output_cache.display_name(cached_file))
+        output_cache.pin(digest)
+        on_body_close(response, lambda: output_cache.unpin(digest))
+        return response
+    
+    try:
+        info = get_video_info_cached(url)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    
+    inputs = select_stream_inputs(info, format_id, download_type)
+    if not inputs:
+        return jsonify({'error': 'Formato não disponível para streaming, use /api/download'}), 409
+    bitrate = plan_audio(info, format_id, output_format)['bitrate'] if download_type == 'audio' else None
+    
+    def build():
+        if not stream_slots.acquire(blocking=False):
+            return busy_response()
+        
+        title = clean_filename(info.get('title', 'video'))
+        final_path = os.path.join(DOWNLOAD_FOLDER, output_cache.filename_for(title, digest, output_format))
+        part_path = final_path + '.stream.part'
+        
+        try:
+            process = subprocess.Popen(build_stream_command(inputs, output_format, bitrate),
+                                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except Exception as e:
+            stream_slots.release()
+            return jsonify({'error': str(e)}), 500
+        
+        def generate():
+            output_cache.pin(digest)
+            cache_file = open(part_path, 'wb') if tee_to_cache else None
+            finished = False
+            try:
+                while True:
+                    chunk = process.stdout.read1(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if cache_file:
+                        cache_file.write(chunk)
+                    yield chunk
+                finished = process.wait() == 0
+            finally:
+                # Cliente desconectou ou FFmpeg falhou: encerrar o processo
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+                process.stdout.close()
+                if cache_file:
+                    cache_file.close()
+                    if finished:
+                        os.replace(part_path, final_path)
+                        output_cache.finish(digest, os.path.basename(final_path))
+                    else:
+                        os.remove(part_path)
+                output_cache.unpin(digest)
+                stream_slots.release()
+        
+        return Response(
+            stream_with_context(generate()),
+            mimetype=STREAM_CONTAINERS[output_format]['mimetype'],
+            headers={'Content-Disposition': attachment_header(f"{title}.{output_format}")}
+        )
+    
+    return held_response(build)
+
+# Lotes: várias URLs (ou uma playlist) baixadas como jobs comuns e entregues num ZIP
+MAX_BATCH_ITEMS = int(os.environ.get('MAX_BATCH_ITEMS', 50))
+# Jobs de um mesmo lote na fila/baixando ao mesmo tempo
+BATCH_PARALLELISM = int(os.environ.get('BATCH_PARALLELISM', 2))
+MAX_ACTIVE_BATCHES = int(os.environ.get('MAX_ACTIVE_BATCHES', 4))
+BATCH_DEFAULT_HEIGHT = 720
+
+batch_executor = ThreadPoolExecutor(max_workers=MAX_ACTIVE_BATCHES, thread_name_prefix='batch')
+
+def expand_playlist(url):
+    """Lista os vídeos de uma playlist/canal com extração rasa (sem abrir cada vídeo)"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'playlistend': MAX_BATCH_ITEMS,
+        'no_check_certificate': True,
+        'socket_timeout': 30,
+    }
+    if os.path.exists(COOKIES_FILE) and os.path.getsize(COOKIES_FILE) > 100:
+        ydl_opts['cookiefile'] = COOKIES_FILE
+    
+    with ydl_pool.checkout('playlist', ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+    
+    entries = info.get('entries') if info.get('_type') == 'playlist' else [info]
+    items = []
+    for entry in entries or []:
+        entry_url = entry and (entry.get('webpage_url') or entry.get('url'))
+        if entry_url:
+            items.append({'url': entry_url, 'title': entry.get('title')})
+    return items[:MAX_BATCH_ITEMS], info.get('title')
+
+def batch_format(download_type, max_height):
+    """Seletor do yt-dlp usado para todos os vídeos do lote"""
+    if download_type == 'audio':
+        return 'bestaudio/best'
+    return f"bv*[height<={max_height}]+ba/b[height<={max_height}]/b"
+
+def run_batch(batch_id, playlist_url, options):
+    """Expande o lote e alimenta a fila com no máximo BATCH_PARALLELISM jobs por vez"""
+    try:
+        if playlist_url:
+            items, title = expand_playlist(playlist_url)
+            if not items:
+                state_store.update(batch_id, status='error', error='Nenhum vídeo encontrado na playlist')
+                return
+            state_store.update(batch_id, status='running', title=title, items=items)
+        items = state_store.get(batch_id)['items']
+        
+        version = status_notifier.version
+        pending = list(range(len(items)))
+        while pending:
+            active = sum(
+                1 for item in items
+                if item.get('download_id') and current_status(item['download_id'])['status'] not in TERMINAL_STATUSES
+            )
+            while pending and active < BATCH_PARALLELISM:
+                index = pending[0]
+                try:
+                    started = start_download(items[index]['url'], **options)
+                    items[index]['download_id'] = started['download_id']
+                    active += 1
+                except (QueueFullError, ClientQuotaError):
+                    break
+                except Exception as e:
+                    items[index]['error'] = str(e)
+                pending.pop(0)
+                state_store.update(batch_id, items=items)
+            if pending:
+                version = status_notifier.wait(version, SSE_POLL_INTERVAL)
+    except Exception as e:
+        print(f"Erro no lote {batch_id}: {str(e)}")
+        state_store.update(batch_id, status='error', error=str(e))
+
+def batch_status(batch_id):
+    """Status do lote com o progresso somado de todos os itens"""
+    batch = state_store.get(batch_id)
+    if not batch:
+        return None
+    
+    items = []
+    counts = {'completed': 0, 'failed': 0}
+    progress = 0
+    for item in batch.get('items', []):
+        if item.get('download_id'):
+            status = current_status(item['download_id'])
+        elif item.get('error'):
+            status = {'status': 'error', 'error': item['error']}
+        else:
+            status = {'status': 'pending', 'progress': 0}
+        if status['status'] == 'completed':
+            counts['completed'] += 1
+        elif status['status'] in ('error', 'not_found'):
+            counts['failed'] += 1
+        progress += 100 if status['status'] == 'completed' else status.get('progress', 0)
+        items.append({
+            'url': item['url'],
+            'title': item.get('title'),
+            'download_id': item.get('download_id'),
+            'status': status['status'],
+            'progress': status.get('progress', 0),
+            'filename': status.get('filename'),
+            'error': status.get('error'),
+        })
+    
+    total = len(items)
+    state = batch['status']
+    if state == 'running' and total and counts['completed'] + counts['failed'] == total:
+        state = 'completed'
+    return {
+        'status': state,
+        'title': batch.get('title'),
+        'error': batch.get('error'),
+        'total': total,
+        'completed': counts['completed'],
+        'failed': counts['failed'],
+        'progress': int(progress / total) if total else 0,
+        'items': items,
+    }
+
+@app.route('/api/batch', methods=['POST'])
+@rate_limited('download')
+def create_batch():
+    """Inicia o download de uma lista de URLs ou de uma playlist"""
+    try:
+        data = request.json or {}
+        urls = [url.strip() for url in data.get('urls') or [] if isinstance(url, str) and url.strip()]
+        playlist_url = (data.get('playlist_url') or '').strip()
+        download_type = data.get('type', 'video')
+        output_format = 'mp3' if download_type == 'audio' else data.get('output_format', 'mp4').lower()
+        max_height = int(data.get('max_height', BATCH_DEFAULT_HEIGHT))
+        
+        if not urls and not playlist_url:
+            return jsonify({'error': 'Informe uma lista de URLs ou uma playlist'}), 400
+        if len(urls) > MAX_BATCH_ITEMS:
+            return jsonify({'error': f'Máximo de {MAX_BATCH_ITEMS} vídeos por lote'}), 400
+        
+        batch_id = str(uuid.uuid4())
+        state_store.set(batch_id, {
+            'type': 'batch',
+            'status': 'expanding' if playlist_url else 'running',
+            'items': [{'url': url} for url in urls],
+        })
+        options = {
+            'format_id': batch_format(download_type, max_height),
+            'download_type': download_type,
+            'output_format': output_format,
+            'codec': data.get('codec', 'h264'),
+            'client': client_id(),
+        }
+        batch_executor.submit(run_batch, batch_id, None if urls else playlist_url, options)
+        
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'total': len(urls) or None,
+            'message': 'Lote iniciado'
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/batch-status/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    """Obtém o status agregado do lote"""
+    status = batch_status(batch_id)
+    if status is None:
+        return jsonify({'status': 'not_found'})
+    return jsonify(status)
+
+class ZipStream:
+    """Saída sem seek para o zipfile: guarda os bytes escritos até serem enviados"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def unique_archive_name(name, used):
+    """Evita nomes repetidos dentro do ZIP ("nome (2).mp4")"""
+    base, ext = os.path.splitext(name)
+    candidate = name
+    counter = 2
+    while candidate in used:
+        candidate = f"{base} ({counter}){ext}"
+        counter += 1
+    used.add(candidate)
+    return candidate
+
+@app.route('/api/batch-file/<batch_id>', methods=['GET'])
+def download_batch_file(batch_id):
+    """Envia os arquivos do lote num ZIP montado durante o envio
+
+    Itens ainda em andamento entram no ZIP assim que terminam; nada é
+    gravado em disco além dos próprios arquivos baixados.
+    """
+    status = batch_status(batch_id)
+    if status is None:
+        return jsonify({'error': 'Lote não encontrado'}), 404
+    
+    def generate():
+        archive = ZipStream()
+        sent = set()
+        names = set()
+        version = status_notifier.version
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+            while True:
+                current = batch_status(batch_id)
+                if current is None:
+                    break
+                for index, item in enumerate(current['items']):
+                    if index in sent or item['status'] not in TERMINAL_STATUSES:
+                        continue
+                    sent.add(index)
+                    if item['status'] != 'completed':
+                        continue
+                    filepath = os.path.join(DOWNLOAD_FOLDER, item['filename'])
+                    with output_cache.pinned(output_cache.digest_of(item['filename'])):
+                        try:
+                            source = open(filepath, 'rb')
+                        except OSError:
+                            continue
+                        output_cache.touch(item['filename'])
+                        entry = zipfile.ZipInfo(
+                            unique_archive_name(output_cache.display_name(item['filename']), names),
+                            time.localtime(os.path.getmtime(filepath))[:6]
+                        )
+                        with source, zf.open(entry, 'w', force_zip64=True) as dest:
+                            while True:
+                                chunk = source.read(STREAM_CHUNK_SIZE)
+                                if not chunk:
+                                    break
+                                dest.write(chunk)
+                                yield archive.drain()
+                        yield archive.drain()
+                if current['status'] in ('completed', 'error'):
+                    break
+                version = status_notifier.wait(version, SSE_POLL_INTERVAL)
+        yield archive.drain()
+    
+    def build():
+        response = Response(stream_with_context(generate()), mimetype='application/zip')
+        response.headers['Content-Disposition'] = attachment_header(f"videomax-{batch_id[:8]}.zip")
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return held_response(build)
+
+def on_body_close(response, callback):
+    """Executa callback quando o servidor WSGI terminar de enviar o corpo da resposta"""
+    if not response.direct_passthrough:
+        response.call_on_close(callback)
+        return
+    # send_file entrega o file_wrapper direto ao servidor (sendfile), sem passar
+    # pelos callbacks da resposta; encadear no close() do próprio wrapper
+    body = response.response
+    original_close = getattr(body, 'close', None)
+    def close():
+        try:
+            if original_close is not None:
+                original_close()
+        finally:
+            callback()
+    body.close = close
+
 def format_views(views):
     """Formata número de visualizações"""
     if views >= 1000000:
@@ -646,22 +4198,92 @@ def format_size(size):
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Verifica se o servidor está funcionando"""
-    return jsonify({'status': 'ok', 'message': 'VideoMax Backend Online'})
+    return jsonify({
+        'status': 'ok',
+        'message': 'VideoMax Backend Online',
+        'info_cache': info_cache.stats(),
+        'download_queue': download_scheduler.stats(),
+        'output_cache': output_cache.stats(),
+        'http_pools': http_client.stats(),
+        'info_responses': info_response_cache.stats(),
+        'ydl_pool': ydl_pool.stats(),
+        'bandwidth': bandwidth_budget.stats(),
+        'prefetch': prefetcher.stats(),
+        'held_responses': held_response_slots.stats(),
+    })
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            route=request.url_rule.rule if request.url_rule else 'unmatched',
+            method=request.method,
+            status=response.status_code,
+        )
+    return response
+
+metrics.register(Gauge('videomax_queue_depth', 'Jobs aguardando na fila',
+                       lambda: download_scheduler.stats()['queued']))
+metrics.register(Gauge('videomax_active_jobs', 'Jobs de download em execução',
+                       lambda: download_scheduler.stats()['active']))
+metrics.register(Gauge('videomax_download_folder_bytes', 'Bytes ocupados em DOWNLOAD_FOLDER (última varredura)',
+                       output_cache.usage))
+metrics.register(CallbackCounter('videomax_info_cache_hits_total', 'Acertos do cache de metadados',
+                                 lambda: info_cache.hits))
+metrics.register(CallbackCounter('videomax_info_cache_misses_total', 'Falhas do cache de metadados',
+                                 lambda: info_cache.misses))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas no formato de texto do Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Token para os endpoints administrativos (se vazio, ficam abertos)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+def admin_authorized():
+    """Confere o token administrativo enviado no cabeçalho X-Admin-Token"""
+    return not ADMIN_TOKEN or request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+
+@app.route('/api/admin/instances', methods=['GET'])
+def admin_instances():
+    """Tabela de saúde das instâncias Piped/Cobalt"""
+    if not admin_authorized():
+        return jsonify({'error': 'Não autorizado'}), 401
+    return jsonify({
+        'piped': PIPED_INSTANCES,
+        'cobalt': COBALT_INSTANCES,
+        'order': {
+            'piped': instance_health.ordered(PIPED_INSTANCES),
+            'cobalt': instance_health.ordered(COBALT_INSTANCES),
+        },
+        'instances': instance_health.snapshot(),
+    })
 
 @app.route('/')
 def index():
     """Serve a página principal"""
     return send_from_directory('.', 'index.html')
 
+# Únicos caminhos publicados: a pasta do projeto também tem o código, cookies.txt e dados
+STATIC_DIRS = ('css', 'js')
+STATIC_FILES = ('index.html',)
+
 @app.route('/<path:path>')
 def serve_static(path):
     """Serve arquivos estáticos"""
+    normalized = os.path.normpath(path).replace(os.sep, '/')
+    if normalized not in STATIC_FILES and normalized.split('/', 1)[0] not in STATIC_DIRS:
+        return jsonify({'error': 'Arquivo não encontrado'}), 404
     return send_from_directory('.', path)
 
 if __name__ == '__main__':
-    # Limpar arquivos antigos ao iniciar
-    clean_old_files()
-    
     # Pegar porta do ambiente (para Render/Heroku) ou usar 5000
     port = int(os.environ.get('PORT', 5000))
     